@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+"""
+AFC自身开销基准测试
+使用 benchmarks/fake_tools.py 中的假fastboot/adb/flash_tool（可设置延迟和吞吐量），不需要连接设备，
+把AFC的开销与设备速度分开测量。场景：
+- compile    生成的1万行脚本的解析/编译耗时，计划缓存未命中和命中时的加载耗时
+- dispatch   每条脚本命令的调度开销（内置命令）与每次外部工具调用的开销
+- flash_all  多个目录的FLASH_ALL（模拟吞吐量下扣除传输时间后的开销），以及增量模式全部跳过时的耗时
+- fanout     多设备并行执行同一脚本的耗时与单台设备的对比
+- streaming  sparse扫描/分片、gzip/xz解压读取，以及通过fastboot-TCP发送的吞吐量
+- edl        通过EDL（Sahara + Firehose，fake_tools.FakeFirehoseTarget）刷写/读取的吞吐量，以及在模拟链路速度下的效率
+- startup    以新进程运行只有PRINT的脚本（main.py --timings）的冷启动/热启动耗时，超过 STARTUP_BUDGET_MS 时退出码1
+结果写入JSON，--compare 与之前的结果对比，超过阈值的退化会被标出（退出码1）
+用法: python benchmarks/bench_afc.py --json result.json [--compare baseline.json] [--quick]
+"""
+
+import argparse
+import contextlib
+import gzip
+import json
+import lzma
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_tools  # noqa: E402
+
+# 默认规模；--quick 时缩小，便于在CI中快速运行
+SIZES = {
+    'script_lines': 10000, 'dispatch_steps': 5000, 'tool_calls': 30,
+    'flash_dirs': 4, 'image_mb': 8, 'fake_mbps': 400.0,
+    'devices': 8, 'stream_mb': 256, 'edl_mb': 256, 'startup_runs': 5,
+}
+QUICK = {
+    'script_lines': 10000, 'dispatch_steps': 1000, 'tool_calls': 10,
+    'flash_dirs': 2, 'image_mb': 2, 'fake_mbps': 400.0,
+    'devices': 4, 'stream_mb': 64, 'edl_mb': 64, 'startup_runs': 3,
+}
+# 冷启动（状态目录为空：没有计划缓存和签名缓存）运行一个PRINT脚本的总耗时上限，包括解释器启动
+STARTUP_BUDGET_MS = 300
+IMAGES = ('boot', 'system', 'vendor', 'recovery', 'dtbo', 'vbmeta')
+
+
+@contextlib.contextmanager
+def quiet():
+    """屏蔽被测代码的输出"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def best_of(func: Callable[[], None], repeat: int = 3) -> float:
+    """多次运行取最短耗时（秒）"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def make_executor(script: Path, tools_dir: Path, serial=None):
+    import main
+
+    with quiet():
+        executor = main.FastbootExecutor(str(script), serial=serial)
+    executor.tools_dir = tools_dir
+    executor.native_adb = False
+    return executor
+
+
+def generate_script(lines: int) -> str:
+    """生成含变量赋值、变量引用、注释和多种命令的脚本"""
+    out = []
+    templates = [
+        "VAR{m}=value_{i}",
+        "PRINT(line {i} $VAR{m})",
+        "FLASH(boot, images/boot_{m}.img)",
+        "# comment {i}",
+        "WAIT(0)",
+        "OEM(device-info)",
+        "FLASH_IF_CHANGED($VAR{m}, \"images/$VAR{m}.img\")",
+        "REBOOT(bootloader)",
+    ]
+    for i in range(lines):
+        out.append(templates[i % len(templates)].format(i=i, m=i % 50))
+    return '\n'.join(out) + '\n'
+
+
+def scenario_compile(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    from commands.script_plan import compile_script, load_plan
+
+    script = work / 'compile.AFC'
+    content = generate_script(sizes['script_lines'])
+    script.write_text(content, encoding='utf-8')
+    executor = make_executor(script, tools_dir)
+    commands = executor.commands
+
+    compile_s = best_of(lambda: compile_script(content, commands))
+    cache_dir = work / 'plans'
+
+    def cold():
+        for item in cache_dir.glob('*.plan'):
+            item.unlink()
+        load_plan(script, commands, cache_dir)
+    cold_s = best_of(cold)
+    warm_s = best_of(lambda: load_plan(script, commands, cache_dir))
+    return {
+        'lines': sizes['script_lines'],
+        'compile_ms': round(compile_s * 1000, 2),
+        'lines_per_sec': round(sizes['script_lines'] / compile_s),
+        'load_plan_cold_ms': round(cold_s * 1000, 2),
+        'load_plan_cached_ms': round(warm_s * 1000, 2),
+    }
+
+
+def scenario_dispatch(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    steps = sizes['dispatch_steps']
+    script = work / 'dispatch.AFC'
+    script.write_text(''.join(f"PRINT({i})\n" for i in range(steps)), encoding='utf-8')
+    executor = make_executor(script, tools_dir)
+    with quiet():
+        executor.execute_script()  # 预热计划缓存
+        builtin_s = best_of(executor.execute_script)
+
+    calls = sizes['tool_calls']
+    tools_script = work / 'tools.AFC'
+    tools_script.write_text("DEVICES()\n" * calls, encoding='utf-8')
+    tool_executor = make_executor(tools_script, tools_dir)
+    with quiet():
+        tool_s = best_of(tool_executor.execute_script, repeat=1)
+
+    # 直接启动假工具的耗时，作为外部工具调用开销的参照
+    fastboot = [str(p) for p in tools_dir.glob('fastboot*')][0]
+    raw_s = best_of(lambda: [subprocess.run([fastboot, 'devices'], capture_output=True) for _ in range(calls)],
+                    repeat=1)
+    return {
+        'builtin_steps': steps,
+        'per_builtin_step_us': round(builtin_s / steps * 1e6, 2),
+        'tool_calls': calls,
+        'per_tool_call_ms': round(tool_s / calls * 1000, 2),
+        'raw_spawn_ms': round(raw_s / calls * 1000, 2),
+        'tool_call_overhead_ms': round((tool_s - raw_s) / calls * 1000, 2),
+    }
+
+
+def _write_images(directory: Path, size: int) -> int:
+    directory.mkdir(parents=True, exist_ok=True)
+    block = os.urandom(1024 * 1024)
+    for name in IMAGES:
+        with open(directory / f"{name}.img", 'wb') as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(os.urandom(size % len(block) + 4096))
+    return sum((directory / f"{name}.img").stat().st_size for name in IMAGES)
+
+
+def scenario_flash_all(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    total = 0
+    lines = []
+    for index in range(sizes['flash_dirs']):
+        total += _write_images(work / f"rom{index}", sizes['image_mb'] * 1024 * 1024)
+        lines.append(f"FLASH_ALL(rom{index})\n")
+    script = work / 'flash_all.AFC'
+    script.write_text(''.join(lines), encoding='utf-8')
+
+    executor = make_executor(script, tools_dir)
+    with quiet():
+        wall = best_of(executor.execute_script, repeat=1)
+    images = sizes['flash_dirs'] * len(IMAGES)
+    transfer = total / 1024 / 1024 / sizes['fake_mbps']
+
+    incremental = make_executor(script, tools_dir, 'FAKE0000')  # 刷写记录按序列号区分设备
+    incremental.incremental = True
+    with quiet():
+        incremental.execute_script()  # 第一次记录刷写内容
+        skip_s = best_of(incremental.execute_script)
+    return {
+        'images': images,
+        'total_mb': round(total / 1024 / 1024, 1),
+        'wall_s': round(wall, 3),
+        'simulated_transfer_s': round(transfer, 3),
+        'overhead_per_image_ms': round((wall - transfer) / images * 1000, 2),
+        'incremental_all_skipped_ms': round(skip_s * 1000, 2),
+    }
+
+
+def scenario_fanout(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    from commands.fleet import run_fleet
+
+    _write_images(work / 'fanout', 1024 * 1024)
+    script = work / 'fanout.AFC'
+    script.write_text("DEVICES()\nFLASH(boot, fanout/boot.img)\nFLASH(dtbo, fanout/dtbo.img)\nREBOOT()\n",
+                      encoding='utf-8')
+    single = make_executor(script, tools_dir, 'FAKE0000')
+    with quiet():
+        single_s = best_of(single.execute_script, repeat=1)
+
+    serials = [f"FAKE{i:04d}" for i in range(sizes['devices'])]
+    with quiet():
+        start = time.perf_counter()
+        results = run_fleet(lambda serial: make_executor(script, tools_dir, serial), serials,
+                            len(serials), work / 'fanout_logs')
+        fleet_s = time.perf_counter() - start
+    return {
+        'devices': len(serials),
+        'single_device_s': round(single_s, 3),
+        'fleet_s': round(fleet_s, 3),
+        'parallel_efficiency': round(single_s / fleet_s, 3) if fleet_s else 0.0,
+        'all_ok': all(r.success for r in results),
+    }
+
+
+def scenario_streaming(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    from bench_sparse import make_image
+    from commands.fastboot_protocol import FastbootClient, open_transport
+    from commands.image_source import READ_SIZE, ImageSource, PipelineReader
+    from commands.sparse import SparseImage
+
+    size = sizes['stream_mb'] * 1024 * 1024
+    mb = size / 1024 / 1024
+    raw = work / 'stream.img'
+    make_image(raw, size, segment=16 * 1024 * 1024)
+    result: Dict[str, float] = {'image_mb': round(mb, 1)}
+
+    image = SparseImage.from_raw(raw)
+    scan_s = best_of(lambda: SparseImage.from_raw(raw), repeat=1)
+    pieces = image.split(max(size // 4, 4 * 1024 * 1024))
+
+    def emit():
+        for piece in pieces:
+            for _ in image.iter_piece(piece):
+                pass
+    result['sparse_scan_mbps'] = round(mb / scan_s, 1)
+    result['sparse_emit_mbps'] = round(mb / best_of(emit, repeat=1), 1)
+
+    for codec, suffix, opener in (('gzip', '.gz', lambda p: gzip.open(p, 'wb', compresslevel=1)),
+                                  ('xz', '.xz', lambda p: lzma.open(p, 'wb', preset=0))):
+        packed = work / f"stream.img{suffix}"
+        with open(raw, 'rb') as src, opener(packed) as dst:
+            while True:
+                data = src.read(READ_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+
+        def read_all(packed=packed, codec=codec):
+            with PipelineReader(ImageSource(packed, None, codec).open()) as reader:
+                while reader.read(READ_SIZE):
+                    pass
+        result[f'{codec}_read_mbps'] = round(mb / best_of(read_all, repeat=1), 1)
+
+    with fake_tools.FakeFastbootTcp(max_download=max(size // 4, 4 * 1024 * 1024)) as server:
+        def send():
+            client = FastbootClient(open_transport(server.target))
+            try:
+                with quiet():
+                    client.flash_file('system', raw)
+            finally:
+                client.close()
+        result['tcp_flash_mbps'] = round(mb / best_of(send, repeat=1), 1)
+    return result
+
+
+def scenario_edl(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    from commands.edl_protocol import Channel, connect, open_transport
+
+    size = sizes['edl_mb'] * 1024 * 1024
+    mb = size / 1024 / 1024
+    sector = 4096
+    package = work / 'edl'
+    package.mkdir()
+    fake_tools.make_loader(package / 'prog_firehose_ddr.elf')
+    block = os.urandom(1024 * 1024)
+    with open(package / 'system.img', 'wb') as f:
+        for _ in range(size // len(block)):
+            f.write(block)
+    (package / 'rawprogram0.xml').write_text(
+        '<?xml version="1.0" ?>\n<data>\n'
+        f'  <program SECTOR_SIZE_IN_BYTES="{sector}" filename="system.img" label="system" '
+        f'num_partition_sectors="{size // sector}" physical_partition_number="0" start_sector="6"/>\n'
+        '</data>\n', encoding='utf-8')
+    disk = work / 'lun0.bin'
+    with open(disk, 'wb') as f:
+        f.truncate(size + 64 * sector)
+    script = work / 'edl.AFC'
+    result: Dict[str, float] = {'image_mb': round(mb, 1)}
+
+    for key, mbps in (('', 0.0), ('link_', sizes['fake_mbps'])):
+        with fake_tools.FakeFirehoseTarget([disk], sector, mbps=mbps) as target:
+            script.write_text(f"EDL_PORT={target.target}\nFLASHEDL(edl)\n", encoding='utf-8')
+            executor = make_executor(script, tools_dir)
+            with quiet():
+                executor.execute_script()  # 第一次执行包括Sahara上传引导程序
+                flash_s = best_of(executor.execute_script, repeat=2)
+            if not key:
+                client = connect(Channel(open_transport(target.target)), None, 'ufs')
+                sink = open(os.devnull, 'wb')
+                try:
+                    read_s = best_of(lambda: client.read(sector, 0, 6, size // sector, sink), repeat=2)
+                finally:
+                    sink.close()
+                    client.close()
+                result['flash_mbps'] = round(mb / flash_s, 1)
+                result['read_mbps'] = round(mb / read_s, 1)
+            else:
+                result['link_mbps'] = mbps
+                result['link_flash_mbps'] = round(mb / flash_s, 1)
+                result['link_efficiency'] = round(mb / flash_s / mbps, 3)
+    return result
+
+
+def _spawn_main(script: Path, state_dir: Path) -> Tuple[float, str]:
+    env = dict(os.environ, AFC_STATE_DIR=str(state_dir))
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, str(ROOT / 'main.py'), '--timings', str(script)], env=env,
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True, encoding='utf-8')
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py 返回 {result.returncode}: {result.stderr.strip()}")
+    return elapsed, result.stderr
+
+
+def scenario_startup(work: Path, tools_dir: Path, sizes: dict) -> dict:
+    script = work / 'startup.AFC'
+    script.write_text("PRINT(hello)\n", encoding='utf-8')
+    repeat = sizes['startup_runs']
+    # 每次冷启动使用新的状态目录；热启动复用最后一个（计划和签名已缓存）
+    cold = [_spawn_main(script, work / f'state{i}') for i in range(repeat)]
+    warm = [_spawn_main(script, work / f'state{repeat - 1}') for _ in range(repeat)]
+    python_s = best_of(lambda: subprocess.run([sys.executable, '-c', 'pass']), repeat=repeat)
+
+    cold_s = min(elapsed for elapsed, _ in cold)
+    imported = re.search(r'已导入的commands模块\((\d+)\)', cold[0][1])
+    return {
+        'cold_ms': round(cold_s * 1000, 1),
+        'warm_ms': round(min(elapsed for elapsed, _ in warm) * 1000, 1),
+        'python_ms': round(python_s * 1000, 1),
+        'commands_imported': int(imported.group(1)) if imported else -1,
+        'budget': STARTUP_BUDGET_MS,
+        'within_budget': cold_s * 1000 <= STARTUP_BUDGET_MS,
+    }
+
+
+SCENARIOS = {
+    'compile': scenario_compile,
+    'dispatch': scenario_dispatch,
+    'flash_all': scenario_flash_all,
+    'fanout': scenario_fanout,
+    'streaming': scenario_streaming,
+    'edl': scenario_edl,
+    'startup': scenario_startup,
+}
+
+# 指标名后缀 -> 是否越大越好
+HIGHER_IS_BETTER = ('_mbps', '_per_sec', '_efficiency')
+LOWER_IS_BETTER = ('_ms', '_us', '_s')
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """与基线对比，返回超过阈值的退化说明"""
+    regressions = []
+    for scenario, metrics in current['results'].items():
+        base = baseline.get('results', {}).get(scenario, {})
+        for key, value in metrics.items():
+            old = base.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)) or isinstance(value, bool):
+                continue
+            if old <= 0:
+                continue
+            if key.endswith(HIGHER_IS_BETTER):
+                change = (old - value) / old
+            elif key.endswith(LOWER_IS_BETTER):
+                change = (value - old) / old
+            else:
+                continue
+            mark = "退化" if change > threshold else ""
+            print(f"  {scenario}.{key:<28} {old:>12} -> {value:<12} {change * 100:+6.1f}% {mark}")
+            if mark:
+                regressions.append(f"{scenario}.{key}: {old} -> {value}")
+    return regressions
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def run(names: List[str], sizes: dict, workdir: Path) -> dict:
+    tools_dir = fake_tools.install(workdir / 'tools', {
+        'AFC_FAKE_MBPS': str(sizes['fake_mbps']),
+        'AFC_FAKE_DEVICES': ','.join(f"FAKE{i:04d}" for i in range(sizes['devices'])),
+    })
+    os.environ['AFC_STATE_DIR'] = str(workdir / 'state')
+    results = {}
+    for name in names:
+        scenario_dir = workdir / name
+        scenario_dir.mkdir()
+        print(f"运行场景 {name}...", file=sys.stderr)
+        start = time.perf_counter()
+        results[name] = SCENARIOS[name](scenario_dir, tools_dir, sizes)
+        results[name]['scenario_s'] = round(time.perf_counter() - start, 3)
+    return {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sizes': sizes,
+        'results': results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="AFC自身开销基准测试（使用假工具，不连接设备）")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"逗号分隔的场景（默认全部: {','.join(SCENARIOS)}）")
+    parser.add_argument('--quick', action='store_true', help="缩小规模，快速运行")
+    parser.add_argument('--json', help="把结果写入JSON文件")
+    parser.add_argument('--compare', metavar='BASELINE', help="与之前的JSON结果对比")
+    parser.add_argument('--threshold', type=float, default=0.2, help="判定为退化的变化比例（默认0.2）")
+    parser.add_argument('--workdir', help="生成文件的目录（默认临时目录）")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"未知的场景: {', '.join(unknown)}")
+    sizes = dict(QUICK if args.quick else SIZES)
+    if args.workdir:
+        Path(args.workdir).mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as tmp:
+        report = run(names, sizes, Path(tmp))
+
+    for scenario, metrics in report['results'].items():
+        print(f"[{scenario}]")
+        for key, value in metrics.items():
+            print(f"  {key:>28}: {value}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"结果已写入: {args.json}")
+    over_budget = [name for name, metrics in report['results'].items() if metrics.get('within_budget') is False]
+    if over_budget:
+        print(f"超出耗时上限: {', '.join(over_budget)}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"与 {args.compare}（{baseline.get('revision', '?')}）对比:")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"发现 {len(regressions)} 项超过 {args.threshold * 100:.0f}% 的退化")
+            sys.exit(1)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+工具查找开销基准测试
+在临时目录中生成与tools相似的结构（Mbin下大量文件），比较原来每次调用都exists()+rglob的查找方式
+与工具注册表的单次调用开销，以及冷启动（扫描目录）和命中持久化索引时的首次查找耗时
+用法: python benchmarks/bench_tools.py --files 500 --calls 200
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from commands.tools import ToolRegistry  # noqa: E402
+
+
+def legacy_find_tool(tools_dir: Path, tool_name: str) -> Optional[Path]:
+    """原FastbootExecutor._find_tool的实现"""
+    for ext in ['.exe', '.bat', '.cmd', '']:
+        tool_path = tools_dir / f"{tool_name}{ext}"
+        if tool_path.exists():
+            return tool_path
+    for item in tools_dir.rglob(f"{tool_name}*"):
+        if item.is_file():
+            return item
+    return None
+
+
+def make_tools(root: Path, files: int) -> None:
+    for name in ('adb.exe', 'fastboot.exe', 'AdbWinApi.dll', 'AdbWinUsbApi.dll'):
+        (root / name).write_bytes(b'')
+    mbin = root / 'Mbin'
+    for i in range(files):
+        sub = mbin / f"lib{i % 10}"
+        sub.mkdir(parents=True, exist_ok=True)
+        (sub / f"module_{i}.dll").write_bytes(b'')
+    (mbin / 'flash_tool.exe').write_bytes(b'')
+
+
+def per_call_us(func, calls: int) -> float:
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def run(files: int, calls: int, workdir: Path) -> dict:
+    tools_dir = workdir / 'tools'
+    tools_dir.mkdir()
+    make_tools(tools_dir, files)
+    index_file = workdir / 'state' / 'tool_index.json'
+
+    # run_spflashtool_command 的查找：flash_tool 然后 Mbin
+    def legacy_spflash():
+        return legacy_find_tool(tools_dir, 'flash_tool') or legacy_find_tool(tools_dir, 'Mbin')
+
+    start = time.perf_counter()
+    cold = ToolRegistry(tools_dir, index_file)
+    cold.find('flash_tool')
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    warm = ToolRegistry(tools_dir, index_file)
+    warm.find('flash_tool')
+    warm_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        'tool_files': files + 5,
+        'legacy_fastboot_us': round(per_call_us(lambda: legacy_find_tool(tools_dir, 'fastboot'), calls), 2),
+        'legacy_spflash_us': round(per_call_us(legacy_spflash, max(1, calls // 10)), 2),
+        'registry_fastboot_us': round(per_call_us(lambda: warm.find('fastboot'), calls), 3),
+        'registry_spflash_us': round(per_call_us(lambda: warm.find('flash_tool') or warm.find('Mbin'), calls), 3),
+        'first_lookup_cold_ms': round(cold_ms, 2),
+        'first_lookup_indexed_ms': round(warm_ms, 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="工具查找开销基准测试")
+    parser.add_argument('--files', type=int, default=500, help="Mbin下生成的文件数")
+    parser.add_argument('--calls', type=int, default=200, help="每种方式的调用次数")
+    parser.add_argument('--json', help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run(args.files, args.calls, Path(tmp))
+
+    for key, value in result.items():
+        print(f"{key:>24}: {value}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
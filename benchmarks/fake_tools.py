@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+"""
+基准测试用的假fastboot/adb/flash_tool
+输出格式与真实工具一致（fastboot的Sending/Writing/OKAY行、adb devices列表、SPFlashTool的百分比进度），
+不连接任何设备；延迟和吞吐量由环境变量控制，用于单独测量AFC自身的开销
+- AFC_FAKE_LATENCY   每次调用的固定延迟（秒，默认0）
+- AFC_FAKE_MBPS      刷写/推送的模拟吞吐量（MB/s，默认0表示不限）
+- AFC_FAKE_DEVICES   devices 列出的序列号（逗号分隔，默认 FAKE0001）
+- AFC_FAKE_MAX_DOWNLOAD  getvar max-download-size 的值（默认512M）
+install(目录) 生成可执行的包装脚本；FakeFastbootTcp 是进程内的fastboot-TCP服务；
+FakeAdbServer 是进程内的adb server（host协议、shell v2/v1、sync push/pull/stat）；
+FakeFirehoseTarget 是进程内的EDL设备（Sahara + Firehose，TCP），每个LUN由一个文件模拟
+用法（单独运行）: python benchmarks/fake_tools.py fastboot devices
+"""
+
+import os
+import re
+import socketserver
+import struct
+import xml.etree.ElementTree as ET
+import zlib
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+TOOLS = ('fastboot', 'adb', 'flash_tool')
+
+
+def _env_float(name: str, default: float = 0.0) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _devices():
+    return [s for s in os.environ.get('AFC_FAKE_DEVICES', 'FAKE0001').split(',') if s]
+
+
+def _transfer(size: int) -> float:
+    """按模拟吞吐量等待，返回用时"""
+    mbps = _env_float('AFC_FAKE_MBPS')
+    seconds = size / 1024 / 1024 / mbps if mbps > 0 else 0.0
+    if seconds:
+        time.sleep(seconds)
+    return seconds
+
+
+def _strip_serial(args):
+    if len(args) >= 2 and args[0] == '-s':
+        return args[2:]
+    return args
+
+
+def fake_fastboot(args) -> int:
+    args = _strip_serial(args)
+    err = sys.stderr
+    if not args:
+        print("usage: fastboot [OPTION...] COMMAND...", file=err)
+        return 1
+    command = args[0]
+    if command == 'devices':
+        for serial in _devices():
+            print(f"{serial}\tfastboot")
+        return 0
+    start = time.monotonic()
+    if command == 'flash' and len(args) >= 3:
+        partition, image = args[1], args[2]
+        try:
+            size = os.path.getsize(image)
+        except OSError:
+            print(f"fastboot: error: cannot load '{image}': No such file or directory", file=err)
+            return 1
+        elapsed = _transfer(size)
+        print(f"Sending '{partition}' ({size // 1024} KB)".ljust(50) + f"OKAY [{elapsed:7.3f}s]", file=err)
+        print(f"Writing '{partition}'".ljust(50) + "OKAY [  0.000s]", file=err)
+    elif command == 'getvar' and len(args) >= 2:
+        value = os.environ.get('AFC_FAKE_MAX_DOWNLOAD', hex(512 * 1024 * 1024)) \
+            if args[1] == 'max-download-size' else 'fake'
+        print(f"{args[1]}: {value}", file=err)
+    elif command in ('erase', 'format'):
+        print(f"Erasing '{args[-1]}'".ljust(50) + "OKAY [  0.000s]", file=err)
+    elif command in ('reboot', 'reboot-bootloader', 'oem', 'flashing', 'boot'):
+        print("".ljust(50) + "OKAY [  0.000s]", file=err)
+    else:
+        print(f"fastboot: usage: unknown command {command}", file=err)
+        return 1
+    print(f"Finished. Total time: {time.monotonic() - start:.3f}s", file=err)
+    return 0
+
+
+def fake_adb(args) -> int:
+    args = _strip_serial(args)
+    if not args:
+        return 1
+    command = args[0]
+    if command == 'devices':
+        print("List of devices attached")
+        for serial in _devices():
+            print(f"{serial}\tdevice")
+        print()
+    elif command == 'push' and len(args) >= 3:
+        size = os.path.getsize(args[1]) if os.path.isfile(args[1]) else 0
+        elapsed = _transfer(size)
+        rate = size / 1024 / 1024 / elapsed if elapsed else 0.0
+        print(f"{args[1]}: 1 file pushed, 0 skipped. {rate:.1f} MB/s ({size} bytes in {elapsed:.3f}s)")
+    elif command in ('shell', 'exec-out'):
+        print(' '.join(args[1:]))
+    elif command in ('reboot', 'wait-for-device', 'start-server', 'kill-server'):
+        pass
+    else:
+        print(f"adb: unknown command {command}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def fake_flash_tool(args) -> int:
+    print("Connecting to BROM...")
+    print("Scanning USB port...")
+    print("Download DA now...")
+    mbps = _env_float('AFC_FAKE_MBPS')
+    for percent in range(0, 101, 10):
+        print(f"Download Flash {percent}%")
+        if mbps > 0:
+            time.sleep(0.01)
+    print("All command exec done!")
+    return 0
+
+
+def main(argv) -> int:
+    if not argv or argv[0] not in TOOLS:
+        print(f"用法: fake_tools.py {{{'|'.join(TOOLS)}}} 参数...", file=sys.stderr)
+        return 2
+    latency = _env_float('AFC_FAKE_LATENCY')
+    if latency:
+        time.sleep(latency)
+    handler = {'fastboot': fake_fastboot, 'adb': fake_adb, 'flash_tool': fake_flash_tool}[argv[0]]
+    return handler(argv[1:])
+
+
+def install(tools_dir: Path, env: Optional[Dict[str, str]] = None) -> Path:
+    """在tools_dir中生成fastboot/adb/flash_tool包装脚本，env为写入脚本的环境变量"""
+    tools_dir = Path(tools_dir)
+    tools_dir.mkdir(parents=True, exist_ok=True)
+    script = Path(__file__).resolve()
+    for tool in TOOLS:
+        if os.name == 'nt':
+            sets = ''.join(f"set {k}={v}\r\n" for k, v in (env or {}).items())
+            (tools_dir / f"{tool}.bat").write_text(
+                f"@echo off\r\n{sets}\"{sys.executable}\" \"{script}\" {tool} %*\r\n", encoding='utf-8')
+        else:
+            exports = ''.join(f"export {k}='{v}'\n" for k, v in (env or {}).items())
+            path = tools_dir / tool
+            path.write_text(f"#!/bin/sh\n{exports}exec '{sys.executable}' '{script}' {tool} \"$@\"\n",
+                            encoding='utf-8')
+            path.chmod(0o755)
+    return tools_dir
+
+
+class FakeFastbootTcp:
+    """
+    进程内的fastboot-TCP服务：按mbps限速（0为不限），commands 记录收到的命令（不含数据）
+    keep_data为False时下载的数据直接丢弃；为True时flash把数据写入 partitions[分区]，sparse数据按chunk展开
+    """
+
+    def __init__(self, max_download: int = 512 * 1024 * 1024, mbps: float = 0.0, keep_data: bool = False):
+        self.max_download = max_download
+        self.mbps = mbps
+        self.keep_data = keep_data
+        self.bytes_received = 0
+        self.flashes = 0
+        self.commands: List[str] = []
+        self.partitions: Dict[str, bytearray] = {}
+        self._lock = threading.Lock()
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def _read(self, size: int) -> bytes:
+                data = bytearray()
+                while len(data) < size:
+                    chunk = self.request.recv(min(size - len(data), 1 << 20))
+                    if not chunk:
+                        raise EOFError
+                    data += chunk
+                return bytes(data)
+
+            def _packet(self) -> bytes:
+                return self._read(struct.unpack('>Q', self._read(8))[0])
+
+            def _send(self, data: bytes) -> None:
+                self.request.sendall(struct.pack('>Q', len(data)) + data)
+
+            def handle(self) -> None:
+                if self._read(4) != b'FB01':
+                    return
+                self.request.sendall(b'FB01')
+                self.download = b''
+                try:
+                    while True:
+                        command = self._packet().decode('utf-8', 'replace')
+                        with owner._lock:
+                            owner.commands.append(command)
+                        if command == 'getvar:max-download-size':
+                            self._send(b'OKAY0x%x' % owner.max_download)
+                        elif command.startswith('getvar:'):
+                            self._send(b'OKAYfake')
+                        elif command.startswith('download:'):
+                            owner._download(self, int(command[9:], 16))
+                        elif command.startswith('flash:'):
+                            with owner._lock:
+                                owner.flashes += 1
+                                if owner.keep_data:
+                                    owner._write(command[6:], self.download)
+                            self._send(b'OKAY')
+                        elif command.startswith('erase:'):
+                            with owner._lock:
+                                owner.partitions.pop(command[6:], None)
+                            self._send(b'OKAY')
+                        elif command.startswith('reboot'):
+                            self._send(b'OKAY')
+                            return
+                        else:
+                            self._send(b'OKAY')
+                except (EOFError, ConnectionError):
+                    pass
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _download(self, handler, size: int) -> None:
+        if size > self.max_download:
+            handler._send(b'FAILdata too large')
+            return
+        handler._send(b'DATA%08x' % size)
+        received = 0
+        data = bytearray()
+        start = time.monotonic()
+        while received < size:
+            packet = handler._packet()
+            received += len(packet)
+            if self.keep_data:
+                data += packet
+        handler.download = bytes(data)
+        if self.mbps > 0:
+            delay = size / 1024 / 1024 / self.mbps - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        with self._lock:
+            self.bytes_received += received
+        handler._send(b'OKAY')
+
+    def _write(self, partition: str, data: bytes) -> None:
+        """与设备一样处理flash：raw数据整体替换分区，sparse数据只写入RAW/FILL chunk覆盖的块"""
+        if data[:4] != struct.pack('<I', 0xED26FF3A):
+            self.partitions[partition] = bytearray(data)
+            return
+        _magic, _major, _minor, file_hdr_sz, chunk_hdr_sz, block_size, total_blocks, total_chunks, _crc = \
+            struct.unpack_from('<IHHHHIIII', data)
+        image = self.partitions.setdefault(partition, bytearray())
+        if len(image) < total_blocks * block_size:
+            image.extend(bytes(total_blocks * block_size - len(image)))
+        pos, offset = file_hdr_sz, 0
+        for _ in range(total_chunks):
+            chunk_type, _reserved, blocks, total_sz = struct.unpack_from('<HHII', data, pos)
+            body = data[pos + chunk_hdr_sz:pos + total_sz]
+            length = blocks * block_size
+            if chunk_type == 0xCAC1:
+                image[offset:offset + length] = body
+            elif chunk_type == 0xCAC2:
+                image[offset:offset + length] = body[:4] * (length // 4)
+            offset += length
+            pos += total_sz
+
+    @property
+    def target(self) -> str:
+        return f"tcp:127.0.0.1:{self.port}"
+
+    def __enter__(self) -> 'FakeFastbootTcp':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeAdbServer:
+    """
+    进程内的adb server：host:devices、host:transport、shell,v2:（可关闭以模拟旧设备）、shell:、reboot:、sync:
+    设备上的文件保存在 files（路径 -> 内容），dirs 为已存在的目录；shell(命令) 返回 (退出码, 输出)
+    与adbd一样，sync中SEND/RECV失败后关闭连接
+    """
+
+    def __init__(self, serials: Optional[List[str]] = None, shell_v2: bool = True):
+        self.serials = list(serials or ['FAKE0001'])
+        self.shell_v2 = shell_v2
+        self.files: Dict[str, bytes] = {}
+        self.dirs = {'/', '/sdcard', '/data/local/tmp'}
+        self.readonly = {'/system'}
+        self.commands: List[str] = []
+        self.connections = 0
+        self._lock = threading.Lock()
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def _read(self, size: int) -> bytes:
+                data = bytearray()
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise EOFError
+                    data += chunk
+                return bytes(data)
+
+            def _request(self) -> str:
+                return self._read(int(self._read(4), 16)).decode('utf-8')
+
+            def _fail(self, message: str) -> None:
+                data = message.encode('utf-8')
+                self.request.sendall(b'FAIL%04x' % len(data) + data)
+
+            def handle(self) -> None:
+                with owner._lock:
+                    owner.connections += 1
+                try:
+                    request = self._request()
+                    if request == 'host:devices':
+                        text = ''.join(f"{serial}\tdevice\n" for serial in owner.serials).encode('utf-8')
+                        self.request.sendall(b'OKAY%04x' % len(text) + text)
+                        return
+                    if request.startswith('host:transport:') and request[15:] not in owner.serials:
+                        self._fail(f"device '{request[15:]}' not found")
+                        return
+                    if not request.startswith('host:transport'):
+                        self._fail(f"unknown host service {request}")
+                        return
+                    self.request.sendall(b'OKAY')
+                    owner._service(self, self._request())
+                except (EOFError, ConnectionError):
+                    pass
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def shell(self, command: str) -> Tuple[int, bytes]:
+        """模拟设备上的shell：exit N、false、cat 文件，其余命令原样回显"""
+        if command.startswith('exit '):
+            return int(command[5:]), b''
+        if command == 'false':
+            return 1, b''
+        if command.startswith('cat '):
+            path = command[4:]
+            if path in self.files:
+                return 0, self.files[path]
+            return 1, f"cat: {path}: No such file or directory\n".encode('utf-8')
+        return 0, f"{command}\n".encode('utf-8')
+
+    def _service(self, handler, service: str) -> None:
+        with self._lock:
+            self.commands.append(service)
+        if service.startswith('shell,v2'):
+            if not self.shell_v2:
+                handler._fail('closed')
+                return
+            handler.request.sendall(b'OKAY')
+            code, output = self.shell(service.split(':', 1)[1])
+            handler.request.sendall(bytes([1]) + struct.pack('<I', len(output)) + output
+                                    + bytes([3]) + struct.pack('<I', 1) + bytes([code & 0xff]))
+        elif service.startswith('shell:'):
+            handler.request.sendall(b'OKAY')
+            command, marker = service[6:], '; echo __AFC_RC=$?'
+            if command.endswith(marker):
+                code, output = self.shell(command[:-len(marker)])
+                if not command.startswith('exit '):
+                    output += f"__AFC_RC={code}\n".encode('ascii')
+            else:
+                output = self.shell(command)[1]
+            handler.request.sendall(output)
+        elif service.startswith('reboot:'):
+            handler.request.sendall(b'OKAY')
+        elif service == 'sync:':
+            handler.request.sendall(b'OKAY')
+            while self._sync(handler):
+                pass
+        else:
+            handler._fail(f"unknown service {service}")
+
+    def _sync(self, handler) -> bool:
+        """处理一个sync请求，返回连接是否仍可继续使用"""
+        header = handler._read(8)
+        sid, length = header[:4], struct.unpack('<I', header[4:])[0]
+        if sid == b'QUIT':
+            return False
+        path = handler._read(length).decode('utf-8')
+
+        def fail(message: str) -> bool:
+            data = message.encode('utf-8')
+            handler.request.sendall(b'FAIL' + struct.pack('<I', len(data)) + data)
+            return False
+
+        if sid == b'STAT':
+            if path.rstrip('/') in self.dirs or path == '/':
+                reply = (0o040755, 4096, 0)
+            elif path in self.files:
+                reply = (0o100644, len(self.files[path]), 0)
+            else:
+                reply = (0, 0, 0)
+            handler.request.sendall(b'STAT' + struct.pack('<III', *reply))
+            return True
+        if sid == b'SEND':
+            path = path.rsplit(',', 1)[0]
+            data = bytearray()
+            while True:
+                header = handler._read(8)
+                sid, length = header[:4], struct.unpack('<I', header[4:])[0]
+                if sid == b'DONE':
+                    break
+                data += handler._read(length)
+            parent = path.rsplit('/', 1)[0] or '/'
+            if parent in self.readonly or parent not in self.dirs:
+                return fail(f"couldn't create file: {path}")
+            if path in self.dirs:
+                return fail(f"{path} is a directory")
+            self.files[path] = bytes(data)
+            handler.request.sendall(b'OKAY' + struct.pack('<I', 0))
+            return True
+        if sid == b'RECV':
+            if path not in self.files:
+                return fail(f"remote object '{path}' does not exist")
+            data = self.files[path]
+            for start in range(0, len(data), 64 * 1024):
+                chunk = data[start:start + 64 * 1024]
+                handler.request.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+            handler.request.sendall(b'DONE' + struct.pack('<I', 0))
+            return True
+        return fail(f"unknown sync request {sid!r}")
+
+    def __enter__(self) -> 'FakeAdbServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def make_loader(path: Path, size: int = 256 * 1024) -> Path:
+    """生成FakeFirehoseTarget可以接收的引导程序：ELF64头、两个PT_LOAD段"""
+    segments = [os.urandom(size - size // 8), os.urandom(size // 8)]
+    header = bytearray(64)
+    header[:6] = b'\x7fELF\x02\x01'
+    struct.pack_into('<Q', header, 0x20, 64)
+    struct.pack_into('<HH', header, 0x36, 56, len(segments))
+    offset, table = 4096, b''
+    for segment in segments:
+        table += struct.pack('<IIQQQQQQ', 1, 5, offset, 0, 0, len(segment), len(segment), 4096)
+        offset += len(segment)
+    data = bytes(header) + table
+    Path(path).write_bytes(data + bytes(4096 - len(data)) + b''.join(segments))
+    return Path(path)
+
+
+class FakeFirehoseTarget:
+    """
+    进程内的EDL设备：连接后先进行Sahara握手，按ELF程序头请求引导程序（READ_DATA_64），之后进入Firehose；
+    支持 nop/configure/program/read/erase/patch/setbootablestoragedrive/power，LUN n 的数据保存在 disks[n]，
+    patch中的 NUM_DISK_SECTORS 和 CRC32(扇区, 长度) 表达式按真实设备的规则计算
+    Firehose运行后新的连接直接进入Firehose（与真实设备一样不再发送HELLO），power reset后回到Sahara
+    """
+
+    def __init__(self, disks: List[Path], sector_size: int = 4096, memory: str = 'ufs',
+                 max_payload: int = 1024 * 1024, mbps: float = 0.0):
+        self.disks = [Path(d) for d in disks]
+        self.sector_size = sector_size
+        self.memory = memory
+        self.max_payload = max_payload
+        self.mbps = mbps
+        self.firehose = False
+        self.loader = b''
+        self.bootable: Optional[int] = None
+        self.counts: Dict[str, int] = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._lock = threading.Lock()
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self) -> None:
+                self.buffer = bytearray()
+
+            def _read(self, size: int) -> bytes:
+                while len(self.buffer) < size:
+                    chunk = self.request.recv(max(size - len(self.buffer), 1 << 20))
+                    if not chunk:
+                        raise EOFError
+                    self.buffer += chunk
+                data = bytes(self.buffer[:size])
+                del self.buffer[:size]
+                return data
+
+            def _document(self) -> bytes:
+                while b'</data>' not in self.buffer:
+                    chunk = self.request.recv(1 << 16)
+                    if not chunk:
+                        raise EOFError
+                    self.buffer += chunk
+                end = self.buffer.index(b'</data>') + len(b'</data>')
+                doc = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return doc
+
+            def handle(self) -> None:
+                try:
+                    if not owner.firehose and not owner._sahara(self):
+                        return
+                    while True:
+                        element = ET.fromstring(self._document())[0]
+                        if not owner._firehose(self, element.tag, dict(element.attrib)):
+                            return
+                except (EOFError, ConnectionError):
+                    pass
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self._server = Server(('127.0.0.1', 0), Handler)
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    # ---- Sahara ----
+
+    def _sahara(self, handler) -> bool:
+        send = handler.request.sendall
+        send(struct.pack('<IIIIII6I', 0x01, 0x30, 2, 1, 0x400, 0, 0, 0, 0, 0, 0, 0))
+        cmd, length = struct.unpack('<II', handler._read(8))
+        handler._read(length - 8)
+        if cmd != 0x02:
+            return False
+
+        def read_data(offset: int, size: int) -> bytes:
+            send(struct.pack('<IIQQQ', 0x12, 0x20, 13, offset, size))
+            return handler._read(size)
+        header = read_data(0, 64)
+        if header[:4] != b'\x7fELF' or header[4] != 2:
+            send(struct.pack('<IIII', 0x04, 0x10, 13, 0x08))  # 不是ELF64
+            return False
+        phoff, = struct.unpack_from('<Q', header, 0x20)
+        phentsize, phnum = struct.unpack_from('<HH', header, 0x36)
+        table = read_data(phoff, phentsize * phnum)
+        loader = bytearray(phoff + len(table))
+        loader[:len(header)] = header
+        loader[phoff:] = table
+        for index in range(phnum):
+            p_type, _flags, p_offset, _vaddr, _paddr, p_filesz = struct.unpack_from('<IIQQQQ', table, index * phentsize)
+            if p_type == 1 and p_filesz:
+                data = read_data(p_offset, p_filesz)
+                if len(loader) < p_offset + p_filesz:
+                    loader.extend(bytes(p_offset + p_filesz - len(loader)))
+                loader[p_offset:p_offset + p_filesz] = data
+        send(struct.pack('<IIII', 0x04, 0x10, 13, 0))
+        cmd, length = struct.unpack('<II', handler._read(8))
+        handler._read(length - 8)
+        if cmd != 0x05:
+            return False
+        send(struct.pack('<III', 0x06, 0x0C, 1))
+        with self._lock:
+            self.loader = bytes(loader)
+            self.firehose = True
+        self._log(handler, "Binary build date: fake firehose")
+        self._log(handler, "Chip serial num: 0xafc00001")
+        return True
+
+    # ---- Firehose ----
+
+    @staticmethod
+    def _xml(body: str) -> bytes:
+        return f'<?xml version="1.0" encoding="UTF-8" ?>\n<data>\n{body}\n</data>'.encode('utf-8')
+
+    def _log(self, handler, message: str) -> None:
+        handler.request.sendall(self._xml(f'<log value="{message}" />'))
+
+    def _respond(self, handler, ok: bool = True, **attrs) -> None:
+        extra = ''.join(f' {k}="{v}"' for k, v in attrs.items())
+        handler.request.sendall(self._xml(f'<response value="{"ACK" if ok else "NAK"}"{extra} />'))
+
+    def _nak(self, handler, message: str) -> bool:
+        self._log(handler, message)
+        self._respond(handler, False)
+        return True
+
+    def _disk_sectors(self, lun: int) -> int:
+        return self.disks[lun].stat().st_size // self.sector_size
+
+    def _number(self, text: str, lun: int) -> int:
+        text = text.strip().rstrip('.')
+        match = re.fullmatch(r'NUM_DISK_SECTORS\s*([+-]\s*\d+)?', text)
+        if match:
+            return self._disk_sectors(lun) + int((match.group(1) or '0').replace(' ', ''))
+        return int(text, 0)
+
+    def _range(self, attrs: Dict[str, str]):
+        """(LUN, 字节偏移, 字节数)，超出范围时返回None"""
+        lun = int(attrs.get('physical_partition_number', '0'))
+        if lun >= len(self.disks) or int(attrs['SECTOR_SIZE_IN_BYTES']) != self.sector_size:
+            return None
+        start = self._number(attrs['start_sector'], lun)
+        count = int(attrs['num_partition_sectors'])
+        if start < 0 or start + count > self._disk_sectors(lun):
+            return None
+        return lun, start * self.sector_size, count * self.sector_size
+
+    def _throttle(self, size: int, start: float) -> None:
+        if self.mbps > 0:
+            delay = size / 1024 / 1024 / self.mbps - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _firehose(self, handler, tag: str, attrs: Dict[str, str]) -> bool:
+        with self._lock:
+            self.counts[tag] = self.counts.get(tag, 0) + 1
+        if tag == 'nop':
+            self._respond(handler)
+        elif tag == 'configure':
+            if attrs.get('MemoryName', '').lower() != self.memory:
+                return self._nak(handler, f"Failed to open the {attrs.get('MemoryName')} device")
+            requested = int(attrs.get('MaxPayloadSizeToTargetInBytes', 0))
+            if requested > self.max_payload:
+                self._respond(handler, False, MaxPayloadSizeToTargetInBytes=self.max_payload,
+                              MaxPayloadSizeToTargetInBytesSupported=self.max_payload)
+            else:
+                self._respond(handler, MaxPayloadSizeToTargetInBytes=requested,
+                              MaxPayloadSizeToTargetInBytesSupported=self.max_payload)
+        elif tag in ('program', 'read', 'erase'):
+            target = self._range(attrs)
+            if target is None:
+                return self._nak(handler, f"{tag}: 扇区超出范围或扇区大小不符")
+            lun, offset, size = target
+            start = time.monotonic()
+            with open(self.disks[lun], 'r+b') as disk:
+                disk.seek(offset)
+                if tag == 'program':
+                    self._respond(handler, rawmode='true')
+                    remaining = size
+                    while remaining:
+                        data = handler._read(min(remaining, 1 << 20))
+                        disk.write(data)
+                        remaining -= len(data)
+                    self.bytes_written += size
+                elif tag == 'read':
+                    self._respond(handler, rawmode='true')
+                    remaining = size
+                    while remaining:
+                        data = disk.read(min(remaining, 1 << 20))
+                        handler.request.sendall(data)
+                        remaining -= len(data)
+                    self.bytes_read += size
+                else:
+                    for pos in range(0, size, 1 << 20):
+                        disk.write(bytes(min(1 << 20, size - pos)))
+            self._throttle(size if tag != 'erase' else 0, start)
+            self._respond(handler, rawmode='false')
+        elif tag == 'patch':
+            return self._patch(handler, attrs)
+        elif tag == 'setbootablestoragedrive':
+            self.bootable = int(attrs['value'])
+            self._respond(handler)
+        elif tag == 'power':
+            self._respond(handler)
+            with self._lock:
+                self.firehose = False
+            return False
+        else:
+            return self._nak(handler, f"Unknown command {tag}")
+        return True
+
+    def _patch(self, handler, attrs: Dict[str, str]) -> bool:
+        if attrs.get('filename') != 'DISK':
+            return self._nak(handler, "patch只支持DISK")
+        lun = int(attrs.get('physical_partition_number', '0'))
+        sector = self._number(attrs['start_sector'], lun)
+        offset = sector * self.sector_size + int(attrs['byte_offset'])
+        size = int(attrs['size_in_bytes'])
+        value = attrs['value'].strip()
+        with open(self.disks[lun], 'r+b') as disk:
+            match = re.fullmatch(r'CRC32\((.+),(.+)\)', value)
+            if match:
+                disk.seek(self._number(match.group(1), lun) * self.sector_size)
+                number = zlib.crc32(disk.read(self._number(match.group(2), lun)))
+            else:
+                number = self._number(value, lun)
+            disk.seek(offset)
+            disk.write(number.to_bytes(size, 'little'))
+        self._respond(handler)
+        return True
+
+    @property
+    def target(self) -> str:
+        return f"tcp:127.0.0.1:{self.port}"
+
+    def __enter__(self) -> 'FakeFirehoseTarget':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,375 @@
+"""
+adb host协议客户端
+直接通过TCP与adb server(默认5037端口)通信，避免每条命令都启动一次adb进程
+支持 host:devices / host:transport / shell: / shell,v2: / reboot: / sync 服务，按序列号池化sync连接
+"""
+
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from commands.trace import get_tracer
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 5037
+SYNC_DATA_MAX = 64 * 1024  # sync协议单个DATA包的最大长度
+
+# shell v2协议的数据包类型：[类型:1字节][长度:4字节小端][数据]
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+# 不支持shell v2的设备上，在命令后输出退出码
+RC_MARKER = "__AFC_RC="
+
+
+class AdbError(Exception):
+    """adb server或设备返回了FAIL"""
+
+
+class AdbConnection:
+    """到adb server的一条连接"""
+
+    def __init__(self, host: str, port: int, timeout: Optional[float] = 10.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def send_request(self, payload: str) -> None:
+        """发送 4位十六进制长度 + 内容 的请求并检查OKAY"""
+        data = payload.encode('utf-8')
+        self.sock.sendall(b'%04x' % len(data) + data)
+        self.read_status()
+
+    def read_status(self) -> None:
+        status = self.read_exact(4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbError(self.read_hex_block().decode('utf-8', 'replace'))
+        raise AdbError(f"未知的响应: {status!r}")
+
+    def read_hex_block(self) -> bytes:
+        """读取 4位十六进制长度 + 内容"""
+        length = int(self.read_exact(4), 16)
+        return self.read_exact(length)
+
+    def read_exact(self, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("adb连接被关闭")
+            buf += chunk
+        return bytes(buf)
+
+    def read_all(self) -> bytes:
+        """读取到对端关闭为止"""
+        chunks = []
+        while True:
+            chunk = self.sock.recv(256 * 1024)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    # ---- sync 服务 ----
+
+    def sync_send_packet(self, sid: bytes, data: bytes) -> None:
+        self.sock.sendall(sid + struct.pack('<I', len(data)) + data)
+
+    def sync_read_header(self) -> Tuple[bytes, int]:
+        header = self.read_exact(8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+
+class AdbClient:
+    """adb server客户端，按序列号维护空闲sync连接池"""
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, max_idle: int = 2):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self._idle: Dict[str, List[AdbConnection]] = {}
+        self._lock = threading.Lock()
+
+    def connect(self, timeout: Optional[float] = 10.0) -> AdbConnection:
+        return AdbConnection(self.host, self.port, timeout)
+
+    def open_service(self, serial: Optional[str], service: str,
+                     timeout: Optional[float] = 10.0) -> AdbConnection:
+        """切换到指定设备并打开服务，返回已就绪的连接"""
+        conn = self.connect(timeout)
+        try:
+            conn.send_request(f"host:transport:{serial}" if serial else "host:transport-any")
+            conn.send_request(service)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    # ---- host 服务 ----
+
+    def devices(self) -> List[Tuple[str, str]]:
+        """返回 [(序列号, 状态)]"""
+        conn = self.connect()
+        try:
+            conn.send_request("host:devices")
+            text = conn.read_hex_block().decode('utf-8', 'replace')
+        finally:
+            conn.close()
+        return parse_device_list(text)
+
+    def track_devices(self, deadline: Optional[float] = None) -> Iterator[List[Tuple[str, str]]]:
+        """持续返回设备列表的变化（host:track-devices），超过deadline(time.monotonic)时抛出socket.timeout"""
+        conn = self.connect()
+        try:
+            conn.send_request("host:track-devices")
+            while True:
+                if deadline is not None:
+                    conn.sock.settimeout(max(0.01, deadline - time.monotonic()))
+                yield parse_device_list(conn.read_hex_block().decode('utf-8', 'replace'))
+        finally:
+            conn.close()
+
+    # ---- 设备服务 ----
+
+    def shell(self, serial: Optional[str], command: str, timeout: Optional[float] = 60.0) -> bytes:
+        conn = self.open_service(serial, f"shell:{command}", timeout)
+        try:
+            return conn.read_all()
+        finally:
+            conn.close()
+
+    def run_shell(self, serial: Optional[str], command: str,
+                  timeout: Optional[float] = 60.0) -> Tuple[int, bytes]:
+        """
+        执行shell命令，返回 (退出码, stdout和stderr按到达顺序合并的输出)
+        使用带退出码的 shell,v2: 服务；设备不支持时用 shell: 并在命令后输出退出码
+        """
+        try:
+            conn = self.open_service(serial, f"shell,v2,raw:{command}", timeout)
+        except AdbError:
+            return self._run_shell_v1(serial, command, timeout)
+        try:
+            output = bytearray()
+            while True:
+                header = conn.read_exact(5)
+                kind, length = header[0], struct.unpack('<I', header[1:])[0]
+                data = conn.read_exact(length)
+                if kind in (SHELL_STDOUT, SHELL_STDERR):
+                    output += data
+                elif kind == SHELL_EXIT:
+                    return (data[0] if data else 255), bytes(output)
+        finally:
+            conn.close()
+
+    def _run_shell_v1(self, serial: Optional[str], command: str,
+                      timeout: Optional[float]) -> Tuple[int, bytes]:
+        output = self.shell(serial, f"{command}; echo {RC_MARKER}$?", timeout)
+        head, marker, tail = output.rpartition(RC_MARKER.encode('ascii'))
+        if not marker or not tail.strip().isdigit():
+            # 命令中途退出（如exit），没有输出退出码
+            return 255, output
+        return int(tail.strip()), head
+
+    def reboot(self, serial: Optional[str], target: str = "") -> None:
+        conn = self.open_service(serial, f"reboot:{target}")
+        try:
+            conn.read_all()
+        except OSError:
+            # 设备重启时连接可能被直接断开
+            pass
+        finally:
+            conn.close()
+
+    # ---- sync 服务（连接池） ----
+
+    def _acquire_sync(self, serial: Optional[str]) -> Tuple[AdbConnection, bool]:
+        """取出一条sync连接，返回 (连接, 是否来自池)"""
+        key = serial or ""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self.open_service(serial, "sync:", timeout=60.0), False
+
+    def _release_sync(self, serial: Optional[str], conn: AdbConnection) -> None:
+        key = serial or ""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.sync_send_packet(b'QUIT', b'')
+        conn.close()
+
+    def _with_sync(self, serial: Optional[str], func):
+        conn, pooled = self._acquire_sync(serial)
+        try:
+            result = func(conn)
+        except AdbError:
+            # adbd在SEND/RECV失败后结束sync服务，连接不能再放回池中
+            conn.close()
+            raise
+        except OSError:
+            conn.close()
+            if not pooled:
+                raise
+            # 池中的连接可能因设备重启而失效，换新连接重试一次
+            conn = self.open_service(serial, "sync:", timeout=60.0)
+            try:
+                result = func(conn)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        self._release_sync(serial, conn)
+        return result
+
+    def stat(self, serial: Optional[str], remote: str) -> Tuple[int, int, int]:
+        """返回 (mode, size, mtime)，文件不存在时mode为0"""
+        def op(conn: AdbConnection):
+            conn.sync_send_packet(b'STAT', remote.encode('utf-8'))
+            reply = conn.read_exact(16)
+            if reply[:4] != b'STAT':
+                raise AdbError(f"STAT响应异常: {reply[:4]!r}")
+            return struct.unpack('<III', reply[4:])
+        return self._with_sync(serial, op)
+
+    def push(self, serial: Optional[str], local: str, remote: str, mode: int = 0o644) -> int:
+        """推送本地文件，返回传输字节数"""
+        def op(conn: AdbConnection):
+            conn.sync_send_packet(b'SEND', f"{remote},{mode}".encode('utf-8'))
+            total = 0
+            with open(local, 'rb') as f:
+                while True:
+                    data = f.read(SYNC_DATA_MAX)
+                    if not data:
+                        break
+                    conn.sync_send_packet(b'DATA', data)
+                    total += len(data)
+            mtime = int(os.path.getmtime(local))
+            conn.sock.sendall(b'DONE' + struct.pack('<I', mtime))
+            sid, length = conn.sync_read_header()
+            if sid == b'FAIL':
+                raise AdbError(conn.read_exact(length).decode('utf-8', 'replace'))
+            if sid != b'OKAY':
+                raise AdbError(f"SEND响应异常: {sid!r}")
+            return total
+        return self._with_sync(serial, op)
+
+    def pull(self, serial: Optional[str], remote: str, local: str) -> int:
+        """拉取设备文件，返回传输字节数"""
+        def op(conn: AdbConnection):
+            conn.sync_send_packet(b'RECV', remote.encode('utf-8'))
+            total = 0
+            with open(local, 'wb') as f:
+                while True:
+                    sid, length = conn.sync_read_header()
+                    if sid == b'DATA':
+                        f.write(conn.read_exact(length))
+                        total += length
+                    elif sid == b'DONE':
+                        return total
+                    elif sid == b'FAIL':
+                        raise AdbError(conn.read_exact(length).decode('utf-8', 'replace'))
+                    else:
+                        raise AdbError(f"RECV响应异常: {sid!r}")
+        return self._with_sync(serial, op)
+
+    def close(self) -> None:
+        """关闭所有池化连接"""
+        with self._lock:
+            pools, self._idle = self._idle, {}
+        for conns in pools.values():
+            for conn in conns:
+                conn.close()
+
+
+def parse_device_list(text: str) -> List[Tuple[str, str]]:
+    devices = []
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) >= 2:
+            devices.append((parts[0], parts[1]))
+    return devices
+
+
+_clients: Dict[Tuple[str, int], AdbClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client() -> AdbClient:
+    """返回进程内共享的客户端（端口可由 ANDROID_ADB_SERVER_PORT 指定）"""
+    host = os.environ.get('ADB_SERVER_HOST', DEFAULT_HOST)
+    port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', DEFAULT_PORT))
+    with _clients_lock:
+        client = _clients.get((host, port))
+        if client is None:
+            client = _clients[(host, port)] = AdbClient(host, port)
+        return client
+
+
+def run_native(serial: Optional[str], args: List[str],
+               timeout: Optional[float] = 60.0) -> Optional[Tuple[bool, str]]:
+    """
+    尝试用协议客户端执行adb命令，timeout为shell命令的无输出超时（None表示不限）
+    返回 (是否成功, 输出)；命令不受支持或server未运行时返回None，由调用方回退到adb程序
+    """
+    if not args:
+        return None
+    command = args[0]
+    client = get_client()
+    try:
+        if command == 'devices' and len(args) == 1:
+            lines = [f"{s}\t{state}" for s, state in client.devices()]
+            return True, "\n".join(["List of devices attached"] + lines)
+        if command == 'reboot' and len(args) <= 2:
+            client.reboot(serial, args[1] if len(args) == 2 else "")
+            return True, ""
+        if command == 'shell' and len(args) >= 2:
+            code, output = client.run_shell(serial, ' '.join(args[1:]), timeout)
+            text = output.decode('utf-8', 'replace')
+            if code != 0:
+                return False, f"{text.rstrip()}\n退出码 {code}".lstrip()
+            return True, text
+        if command == 'push' and len(args) == 3:
+            start = time.monotonic()
+            local, remote = args[1], args[2]
+            # 与adb程序一样，目标是目录时推送到目录中的同名文件
+            if remote.endswith('/') or stat.S_ISDIR(client.stat(serial, remote)[0]):
+                remote = remote.rstrip('/') + '/' + Path(local).name
+            size = client.push(serial, local, remote)
+            get_tracer().add_bytes(size)
+            return True, _transfer_summary(local, 'pushed', size, time.monotonic() - start)
+        if command == 'pull' and len(args) == 3:
+            start = time.monotonic()
+            remote, local = args[1], args[2]
+            if Path(local).is_dir():
+                local = str(Path(local) / remote.rsplit('/', 1)[-1])
+            size = client.pull(serial, remote, local)
+            get_tracer().add_bytes(size)
+            return True, _transfer_summary(remote, 'pulled', size, time.monotonic() - start)
+    except AdbError as e:
+        return False, str(e)
+    except ConnectionRefusedError:
+        # adb server未启动，交给adb程序（它会自动拉起server）
+        return None
+    except OSError as e:
+        return False, str(e)
+    return None
+
+
+def _transfer_summary(name: str, verb: str, size: int, elapsed: float) -> str:
+    rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+    return f"{name}: 1 file {verb}, {size} bytes in {elapsed:.3f}s ({rate:.1f} MB/s)"
@@ -0,0 +1,453 @@
+"""
+应用安装/卸载
+INSTALL(目录或通配符)：解析每个APK的AndroidManifest.xml（二进制XML），按包名把base和split APK合成一组，
+用install session（pm install-create / install-write / install-commit，即install-multiple的做法）安装
+- 每台设备只查询一次 pm list packages --show-versioncode（进程内缓存，安装/卸载后同步更新），
+  已安装相同versionCode的包直接跳过
+- APK通过adb sync协议并发推送到设备的临时目录（同一设备多条连接），推送后面的包时前面的包已经在安装
+- APK的解析结果和SHA-256在本机只计算一次，多台设备（--devices）共享；设备上已有同一内容的暂存文件时不再推送
+UNINSTALL(包名...)：一次shell调用卸载多个包，未安装的包跳过
+"""
+
+import re
+import struct
+import subprocess
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from commands.manifest import get_hash_cache
+
+PUSH_JOBS = 4  # 每台设备同时推送的APK数
+STAGING_DIR = '/data/local/tmp/afc'
+SHELL_TIMEOUT = 300.0  # 安装提交（dexopt）可能需要较长时间
+PACKAGE_CACHE_TTL = 60.0
+PACKAGE_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)+$')
+
+# 二进制XML
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+UTF8_FLAG = 0x100
+TYPE_STRING = 0x03
+# 属性名被混淆（空字符串）时按资源ID识别
+ATTR_IDS = {0x0101021b: 'versionCode', 0x01010576: 'versionCodeMajor'}
+
+
+class ApkError(Exception):
+    """APK无法解析"""
+
+
+class InstallError(Exception):
+    """设备命令执行失败"""
+
+
+@dataclass
+class ApkInfo:
+    """AndroidManifest.xml中的包信息"""
+    path: Path
+    package: str
+    version_code: int
+    split: str = ""  # split APK的名称，base APK为空
+    size: int = 0
+    sha256: str = ""
+
+
+@dataclass
+class PackageGroup:
+    """同一个包的base和split APK，一次安装"""
+    package: str
+    version_code: int
+    apks: List[ApkInfo] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return sum(apk.size for apk in self.apks)
+
+
+# ---- AndroidManifest.xml 解析 ----
+
+def _read_strings(data: bytes, offset: int) -> List[str]:
+    _type, header_size, _size, count, _styles, flags, strings_start, _ = struct.unpack_from('<HHIIIIII', data, offset)
+    offsets = struct.unpack_from(f'<{count}I', data, offset + header_size)
+    base = offset + strings_start
+    strings = []
+    for item in offsets:
+        pos = base + item
+        if flags & UTF8_FLAG:
+            # UTF-8：字符数和字节数各占1或2字节
+            pos += 2 if data[pos] & 0x80 else 1
+            length = data[pos]
+            if length & 0x80:
+                length = ((length & 0x7f) << 8) | data[pos + 1]
+                pos += 1
+            strings.append(data[pos + 1:pos + 1 + length].decode('utf-8', 'replace'))
+        else:
+            length = struct.unpack_from('<H', data, pos)[0]
+            if length & 0x8000:
+                length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, pos + 2)[0]
+                pos += 2
+            strings.append(data[pos + 2:pos + 2 + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def parse_manifest(data: bytes) -> Dict[str, str]:
+    """返回<manifest>元素的属性（package/versionCode/versionCodeMajor/split），只解析到第一个元素"""
+    if len(data) < 8 or struct.unpack_from('<H', data)[0] != RES_XML_TYPE:
+        raise ApkError("不是二进制XML")
+    strings: List[str] = []
+    resource_ids: Tuple[int, ...] = ()
+    pos = struct.unpack_from('<H', data, 2)[0]
+    while pos + 8 <= len(data):
+        chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, pos)
+        if chunk_size < 8:
+            break
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = _read_strings(data, pos)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            resource_ids = struct.unpack_from(f'<{(chunk_size - header_size) // 4}I', data, pos + header_size)
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            _ns, _name, attr_start, attr_size, attr_count = struct.unpack_from('<IIHHH', data, pos + header_size)
+            attrs = {}
+            for index in range(attr_count):
+                attr = pos + header_size + attr_start + index * attr_size
+                _ns, name_ref, raw_ref, _vsize, _res0, data_type, value = struct.unpack_from('<IIIHBBI', data, attr)
+                name = strings[name_ref] if name_ref < len(strings) else ""
+                if not name and name_ref < len(resource_ids):
+                    name = ATTR_IDS.get(resource_ids[name_ref], "")
+                if raw_ref != 0xFFFFFFFF and raw_ref < len(strings):
+                    attrs[name] = strings[raw_ref]
+                elif data_type == TYPE_STRING and value < len(strings):
+                    attrs[name] = strings[value]
+                else:
+                    attrs[name] = str(value)
+            return attrs
+        pos += chunk_size
+    raise ApkError("AndroidManifest.xml中没有manifest元素")
+
+
+def _version_number(text: str) -> int:
+    """versionCode的原始字符串：十进制（可以有前导零，如0123），或0x开头的十六进制"""
+    text = text.strip()
+    if text[:2].lower() == '0x':
+        return int(text[2:], 16)
+    return int(text, 10)
+
+
+_info_cache: Dict[Tuple[str, int, int], ApkInfo] = {}
+_info_lock = threading.Lock()
+
+
+def read_apk(path: Path, hash_cache=None) -> ApkInfo:
+    """解析APK的包名、versionCode和split名称；按 (路径, 大小, mtime) 在进程内缓存"""
+    path = Path(path).resolve()
+    st = path.stat()
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    with _info_lock:
+        if key in _info_cache:
+            return _info_cache[key]
+    try:
+        with zipfile.ZipFile(path) as archive:
+            attrs = parse_manifest(archive.read('AndroidManifest.xml'))
+    except KeyError:
+        raise ApkError("缺少AndroidManifest.xml")
+    except (zipfile.BadZipFile, struct.error, IndexError) as e:
+        raise ApkError(str(e))
+    package = attrs.get('package', '')
+    if not PACKAGE_NAME.match(package):
+        raise ApkError(f"无效的包名: {package!r}")
+    try:
+        version = _version_number(attrs.get('versionCode', '0')) + \
+            (_version_number(attrs.get('versionCodeMajor', '0')) << 32)
+    except ValueError:
+        raise ApkError(f"无效的versionCode: {attrs.get('versionCode')!r}")
+    info = ApkInfo(path, package, version, attrs.get('split', ''), st.st_size,
+                   hash_cache.sha256(path) if hash_cache is not None else "")
+    with _info_lock:
+        _info_cache[key] = info
+    return info
+
+
+def find_apks(base_dir: Path, spec: str) -> List[Path]:
+    """目录（递归查找*.apk）、单个APK或通配符"""
+    path = Path(base_dir) / spec
+    if path.is_dir():
+        return sorted(path.rglob('*.apk'))
+    if path.is_file():
+        return [path]
+    if Path(spec).is_absolute():
+        return sorted(Path(path.anchor).glob(str(path.relative_to(path.anchor))))
+    return sorted(p for p in Path(base_dir).glob(spec) if p.is_file())
+
+
+def group_packages(apks: List[ApkInfo]) -> List[PackageGroup]:
+    """按包名分组，base APK排在前面；同一包的split没有base时报错"""
+    groups: Dict[str, PackageGroup] = {}
+    for apk in apks:
+        group = groups.setdefault(apk.package, PackageGroup(apk.package, 0))
+        group.apks.append(apk)
+    for group in groups.values():
+        bases = [apk for apk in group.apks if not apk.split]
+        if len(bases) != 1:
+            names = ', '.join(apk.path.name for apk in group.apks)
+            raise ApkError(f"{group.package} 需要恰好一个base APK（{names}）")
+        group.version_code = bases[0].version_code
+        group.apks.sort(key=lambda apk: (apk.split != "", apk.split))
+    return list(groups.values())
+
+
+# ---- 设备 ----
+
+class _Device:
+    """对一台设备执行shell命令和推送文件：优先使用adb协议客户端，adb server未运行时使用adb程序"""
+
+    def __init__(self, executor):
+        self.serial = executor.serial
+        # 已安装应用的缓存按真实序列号区分设备，无法确定设备时不缓存
+        self.key = executor.device_serial()
+        self.client = None
+        if executor.native_adb:
+            from commands.adb_client import get_client
+
+            self.client = get_client()
+        adb_path = executor._find_tool("adb")
+        self.adb_cmd = [str(adb_path) if adb_path else 'adb'] + executor._serial_args()
+
+    def shell(self, command: str) -> str:
+        # 设备命令的失败由调用方根据输出判断（如 Failure [...]）
+        return self.run(command)[1]
+
+    def run(self, command: str) -> Tuple[int, str]:
+        """执行shell命令，返回 (设备上的退出码, 输出)"""
+        if self.client is not None:
+            from commands.adb_client import AdbError
+
+            try:
+                code, output = self.client.run_shell(self.serial, command, timeout=SHELL_TIMEOUT)
+                return code, output.decode('utf-8', 'replace')
+            except ConnectionRefusedError:
+                self.client = None
+            except (AdbError, OSError) as e:
+                raise InstallError(str(e))
+        # adb程序（shell v2）的返回码即设备上命令的退出码
+        result = self._run(['shell', command], check=False)
+        return result.returncode, result.stdout + result.stderr
+
+    def push(self, local: Path, remote: str, size: int) -> bool:
+        """推送文件，设备上已有同样大小的文件（文件名含哈希）时跳过，返回是否实际推送"""
+        if self.client is not None:
+            from commands.adb_client import AdbError
+
+            try:
+                _mode, remote_size, _mtime = self.client.stat(self.serial, remote)
+                if _mode and remote_size == size:
+                    return False
+                self.client.push(self.serial, str(local), remote)
+                return True
+            except ConnectionRefusedError:
+                self.client = None
+            except (AdbError, OSError) as e:
+                raise InstallError(str(e))
+        self._run(['push', str(local), remote])
+        return True
+
+    def _run(self, args: List[str], check: bool = True) -> subprocess.CompletedProcess:
+        try:
+            result = subprocess.run(self.adb_cmd + args, capture_output=True, text=True, timeout=SHELL_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise InstallError(str(e))
+        if check and result.returncode != 0:
+            raise InstallError(result.stderr.strip() or f"adb返回码 {result.returncode}")
+        return result
+
+
+_installed: Dict[str, Tuple[float, Dict[str, int]]] = {}
+_installed_lock = threading.Lock()
+
+
+def installed_packages(device: _Device, refresh: bool = False) -> Dict[str, int]:
+    """设备上已安装的 包名 -> versionCode（每台设备缓存PACKAGE_CACHE_TTL秒，无法确定设备序列号时不缓存）"""
+    key = device.key
+    with _installed_lock:
+        cached = _installed.get(key) if key else None
+        if cached and not refresh and time.monotonic() - cached[0] < PACKAGE_CACHE_TTL:
+            return cached[1]
+    packages = parse_package_list(device.shell('pm list packages --show-versioncode'))
+    if key:
+        with _installed_lock:
+            _installed[key] = (time.monotonic(), packages)
+    return packages
+
+
+def parse_package_list(text: str) -> Dict[str, int]:
+    """解析 "package:com.foo versionCode:123" 格式的输出"""
+    packages = {}
+    for line in text.splitlines():
+        match = re.match(r'package:(\S+)(?:\s+versionCode:(\d+))?', line.strip())
+        if match:
+            packages[match.group(1)] = int(match.group(2) or 0)
+    return packages
+
+
+def _set_installed(device: _Device, package: str, version: Optional[int]) -> None:
+    with _installed_lock:
+        cached = _installed.get(device.key) if device.key else None
+        if cached:
+            if version is None:
+                cached[1].pop(package, None)
+            else:
+                cached[1][package] = version
+
+
+def _remote_path(apk: ApkInfo) -> str:
+    return f"{STAGING_DIR}/{apk.sha256[:16]}.apk"
+
+
+def _install_group(device: _Device, group: PackageGroup) -> None:
+    """用install session安装一组已推送的APK，任何一步失败时放弃session"""
+    code, output = device.run(f"pm install-create -r -S {group.size}")
+    match = re.search(r'\[(\d+)\]', output)
+    if code != 0 or not match:
+        raise InstallError(output.strip() or "install-create没有返回session")
+    session = match.group(1)
+    committed = False
+    try:
+        for index, apk in enumerate(group.apks):
+            code, output = device.run(f"pm install-write -S {apk.size} {session} "
+                                      f"{index}_{apk.split or 'base'}.apk {_remote_path(apk)}")
+            if code != 0:
+                raise InstallError(f"install-write {apk.path.name} 失败 - {output.strip() or f'退出码 {code}'}")
+        code, output = device.run(f"pm install-commit {session}")
+        lines = output.strip().splitlines()
+        if code != 0 or not lines or not lines[-1].startswith('Success'):
+            failure = re.search(r'Failure \[[^\]]*\]', output)
+            raise InstallError(failure.group(0) if failure else output.strip() or "install-commit失败")
+        committed = True
+    finally:
+        if not committed:
+            try:
+                device.run(f"pm install-abandon {session}")
+            except InstallError:
+                pass
+
+
+def install(executor, spec: str) -> bool:
+    """安装目录/通配符中的所有APK（split APK按包名合并安装），跳过已安装相同versionCode的包"""
+    paths = find_apks(executor.script_dir, spec)
+    if not paths:
+        print(f"错误: 没有找到APK - {executor.script_dir / spec}")
+        return False
+    hash_cache = get_hash_cache(executor.state_dir)
+    try:
+        with ThreadPoolExecutor(max_workers=PUSH_JOBS) as pool:
+            apks = list(pool.map(lambda path: read_apk(path, hash_cache), paths))
+        groups = group_packages(apks)
+    except (OSError, ApkError) as e:
+        print(f"错误: 无法解析APK - {e}")
+        return False
+
+    device = _Device(executor)
+    try:
+        installed = installed_packages(device)
+    except InstallError as e:
+        print(f"错误: 无法获取已安装的应用 - {e}")
+        return False
+    todo = []
+    for group in groups:
+        if installed.get(group.package) == group.version_code:
+            print(f"跳过 {group.package}: 已安装相同版本 ({group.version_code})")
+        else:
+            todo.append(group)
+    if not todo:
+        return True
+
+    print(f"安装 {len(todo)} 个应用（{sum(len(g.apks) for g in todo)} 个APK，"
+          f"{sum(g.size for g in todo) / 1024 / 1024:.1f} MB）")
+    try:
+        device.shell(f"mkdir -p {STAGING_DIR}")
+    except InstallError as e:
+        print(f"错误: 无法创建暂存目录 - {e}")
+        return False
+
+    def push(apk: ApkInfo) -> Tuple[bool, float]:
+        start = time.monotonic()
+        pushed = device.push(apk.path, _remote_path(apk), apk.size)
+        return pushed, time.monotonic() - start
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=PUSH_JOBS) as pool:
+        # 所有APK一起排队推送，按顺序安装推送完成的包
+        pushes = {id(apk): pool.submit(push, apk) for group in todo for apk in group.apks}
+        for group in todo:
+            try:
+                for apk in group.apks:
+                    pushed, elapsed = pushes[id(apk)].result()
+                    rate = apk.size / elapsed / 1024 / 1024 if pushed and elapsed > 0 else 0.0
+                    status = f"推送 {elapsed:.2f}s ({rate:.1f} MB/s)" if pushed else "设备上已有"
+                    print(f"  {apk.path.name} ({apk.size / 1024 / 1024:.1f} MB): {status}")
+                start = time.monotonic()
+                _install_group(device, group)
+            except InstallError as e:
+                print(f"失败: {group.package} - {e}")
+                failed.append(group.package)
+                continue
+            _set_installed(device, group.package, group.version_code)
+            print(f"已安装 {group.package} ({group.version_code})，安装用时 {time.monotonic() - start:.2f}s")
+
+    try:
+        device.shell(f"rm -f {' '.join(_remote_path(apk) for group in todo for apk in group.apks)}")
+    except InstallError as e:
+        executor.debug("清理暂存文件失败: %s", e)
+    if failed:
+        print(f"安装失败 {len(failed)}/{len(todo)}: {', '.join(failed)}")
+        return False
+    return True
+
+
+def uninstall(executor, *packages: str) -> bool:
+    """卸载一个或多个应用，未安装的跳过"""
+    if not packages:
+        print("错误: UNINSTALL需要至少一个包名")
+        return False
+    invalid = [p for p in packages if not PACKAGE_NAME.match(p)]
+    if invalid:
+        print(f"错误: 无效的包名 {', '.join(invalid)}")
+        return False
+    device = _Device(executor)
+    try:
+        installed = installed_packages(device)
+    except InstallError as e:
+        print(f"错误: 无法获取已安装的应用 - {e}")
+        return False
+    todo = []
+    for package in packages:
+        if package in installed:
+            todo.append(package)
+        else:
+            print(f"跳过 {package}: 未安装")
+    if not todo:
+        return True
+
+    start = time.monotonic()
+    try:
+        output = device.shell(f"for p in {' '.join(todo)}; do echo \"$p $(pm uninstall $p 2>&1)\"; done")
+    except InstallError as e:
+        print(f"错误: 卸载失败 - {e}")
+        return False
+    results = dict(line.split(' ', 1) for line in output.splitlines() if ' ' in line)
+    failed = []
+    for package in todo:
+        result = results.get(package, '').strip()
+        if result == 'Success':
+            _set_installed(device, package, None)
+            print(f"已卸载 {package}")
+        else:
+            print(f"失败: 卸载 {package} - {result or '无输出'}")
+            failed.append(package)
+    executor.debug("卸载 %d 个应用用时 %.2fs", len(todo), time.monotonic() - start)
+    return not failed
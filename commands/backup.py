@@ -0,0 +1,435 @@
+"""
+分区备份
+BACKUP(分区, 目录) / BACKUP_ALL(目录)：通过 adb exec-out dd 读取 /dev/block/by-name 下的分区，边读边压缩、边写边计算哈希
+- 按1MB检测全零区域，块大小对齐的分区保存为sparse镜像（全零区域为FILL chunk，恢复时写回零）
+- xz/gzip按块在线程池中并行压缩后拼接（多stream/member，解压工具和FLASH可直接读取）；zstd使用zstandard自带的多线程
+- 读取设备与压缩、写盘流水线并行：压缩前一个分区的尾部时已经开始读取下一个分区
+- 目录中的 manifest.json 记录每个备份文件的大小和SHA-256（VERIFY/--verify 的清单格式）以及分区和原始数据的SHA-256，
+  restore.AFC 是由清单生成的恢复脚本（先VERIFY再逐个FLASH）
+读取分区需要root（adb root，或设备上有su）
+"""
+
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional
+
+from commands.image_source import CODECS, zstandard
+from commands.sparse import (CHUNK_FILL, CHUNK_HEADER, CHUNK_RAW, DEFAULT_BLOCK_SIZE, FILE_HEADER,
+                             SPARSE_MAGIC)
+
+SEGMENT = 1024 * 1024  # 全零检测的粒度，也是每个sparse chunk覆盖的大小
+COMPRESS_BLOCK = 8 * 1024 * 1024  # 每个压缩任务的数据量
+XZ_PRESET = 3
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BY_NAME_DIRS = ('/dev/block/by-name', '/dev/block/bootdevice/by-name')
+# BACKUP_ALL默认跳过的分区：用户数据通常已加密且很大
+SKIP_PARTITIONS = {'userdata'}
+MANIFEST_NAME = 'manifest.json'
+RESTORE_SCRIPT = 'restore.AFC'
+
+_ZERO = bytes(SEGMENT)
+_SUFFIXES = {codec: suffix for suffix, codec in CODECS.items()}
+
+
+class BackupError(Exception):
+    """读取分区失败"""
+
+
+@dataclass
+class Partition:
+    """设备上的一个分区"""
+    name: str
+    path: str
+    size: int
+
+
+@dataclass
+class BackupEntry:
+    """一个完成的备份文件"""
+    partition: str
+    file: str
+    size: int
+    sha256: str
+    raw_size: int
+    raw_sha256: str
+    sparse: bool
+    codec: Optional[str]
+
+    def to_dict(self) -> dict:
+        return {'partition': self.partition, 'size': self.size, 'sha256': self.sha256,
+                'raw_size': self.raw_size, 'raw_sha256': self.raw_sha256,
+                'sparse': self.sparse, 'codec': self.codec}
+
+
+def default_codec() -> str:
+    return 'zstd' if zstandard is not None else 'xz'
+
+
+def parse_codec(name: str) -> Optional[str]:
+    """参数中的压缩格式：zstd/zst、xz、gzip/gz、none"""
+    name = (name or default_codec()).lower().lstrip('.')
+    aliases = {'zst': 'zstd', 'gz': 'gzip', 'none': '', 'raw': ''}
+    name = aliases.get(name, name)
+    if name and name not in _SUFFIXES:
+        raise ValueError(f"不支持的压缩格式: {name}")
+    if name == 'zstd' and zstandard is None:
+        raise ValueError("zstd压缩需要安装zstandard: pip install zstandard")
+    return name or None
+
+
+def _compress_block(codec: Optional[str]) -> Callable[[bytes], bytes]:
+    """可在多个线程中独立执行的块压缩函数；结果拼接后仍是合法的压缩文件"""
+    if codec == 'xz':
+        return lambda data: lzma.compress(data, preset=XZ_PRESET)
+    if codec == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    return lambda data: data
+
+
+class _BackupFile:
+    """正在写入的备份文件：压缩结果按顺序写入 .part 临时文件并计算哈希，完成后改名"""
+
+    def __init__(self, partition: Partition, path: Path, codec: Optional[str], sparse: bool):
+        self.partition = partition
+        self.path = path
+        self.codec = codec
+        self.sparse = sparse
+        self.compress = _compress_block(codec)
+        self.failed = False
+        self._tmp = path.with_name(path.name + '.part')
+        self._file = open(self._tmp, 'wb')
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        # zstd由zstandard的工作线程并行压缩，这里按顺序喂入
+        self._zstd = (zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).compressobj()
+                      if codec == 'zstd' else None)
+
+    def buffer(self, data: bytes) -> Optional[bytes]:
+        """累积待压缩的数据，攒够一块时返回该块"""
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < COMPRESS_BLOCK:
+            return None
+        return self.take()
+
+    def take(self) -> bytes:
+        block = b''.join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        return block
+
+    def write(self, data: bytes) -> None:
+        if self.failed:
+            return
+        if self._zstd is not None:
+            data = self._zstd.compress(data)
+        self._file.write(data)
+        self._hash.update(data)
+        self._size += len(data)
+
+    def finish(self, raw_sha256: str) -> Optional[BackupEntry]:
+        if self._zstd is not None and not self.failed:
+            tail = self._zstd.flush()
+            self._file.write(tail)
+            self._hash.update(tail)
+            self._size += len(tail)
+        self._file.close()
+        if self.failed:
+            self._tmp.unlink(missing_ok=True)
+            return None
+        os.replace(self._tmp, self.path)
+        return BackupEntry(self.partition.name, self.path.name, self._size, self._hash.hexdigest(),
+                           self.partition.size, raw_sha256, self.sparse, self.codec)
+
+
+class _Pipeline:
+    """
+    压缩流水线：读取线程提交数据块，线程池并行压缩，结果按提交顺序写入各自的文件
+    正在压缩的块数有上限，内存占用固定；读取线程在提交时顺便写出已完成的块
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.max_pending = workers + 2
+        self.entries: List[BackupEntry] = []
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup')
+        self._pending: deque = deque()  # (文件, Future[bytes]) 或 (文件, 原始数据SHA-256) 表示该文件结束
+
+    def feed(self, output: _BackupFile, data: bytes) -> None:
+        block = output.buffer(data)
+        if block is not None:
+            self._submit(output, block)
+
+    def _submit(self, output: _BackupFile, block: bytes) -> None:
+        self._pending.append((output, self._pool.submit(output.compress, block)))
+        self._drain(self.max_pending)
+
+    def end(self, output: _BackupFile, raw_sha256: str) -> None:
+        """该文件的数据已全部提交；不等待压缩完成，继续读取下一个分区"""
+        if output._buffered:
+            self._submit(output, output.take())
+        self._pending.append((output, raw_sha256))
+        self._drain(self.max_pending)
+
+    def _drain(self, keep: int) -> None:
+        while self._pending:
+            output, item = self._pending[0]
+            if isinstance(item, Future):
+                if len(self._pending) <= keep and not item.done():
+                    return
+                self._pending.popleft()
+                try:
+                    output.write(item.result())
+                except OSError as e:
+                    print(f"错误: 写入备份 {output.path} 失败 - {e}")
+                    output.failed = True
+            else:
+                self._pending.popleft()
+                entry = output.finish(item)
+                if entry is not None:
+                    self.entries.append(entry)
+                    rate = entry.size / entry.raw_size * 100 if entry.raw_size else 0.0
+                    print(f"已备份 {entry.partition} -> {entry.file} "
+                          f"({entry.raw_size / 1024 / 1024:.1f} MB -> {entry.size / 1024 / 1024:.1f} MB, {rate:.0f}%)")
+
+    def close(self) -> List[BackupEntry]:
+        self._drain(0)
+        self._pool.shutdown()
+        return self.entries
+
+
+def _sparse_header(size: int) -> bytes:
+    """chunk数在读取前就能确定：每SEGMENT一个chunk（全零为FILL，否则为RAW）"""
+    chunks = (size + SEGMENT - 1) // SEGMENT
+    return FILE_HEADER.pack(SPARSE_MAGIC, 1, 0, FILE_HEADER.size, CHUNK_HEADER.size,
+                            DEFAULT_BLOCK_SIZE, size // DEFAULT_BLOCK_SIZE, chunks, 0)
+
+
+def _sparse_chunk(data: bytes) -> bytes:
+    blocks = len(data) // DEFAULT_BLOCK_SIZE
+    if data == _ZERO[:len(data)]:
+        return CHUNK_HEADER.pack(CHUNK_FILL, 0, blocks, CHUNK_HEADER.size + 4) + b'\0\0\0\0'
+    return CHUNK_HEADER.pack(CHUNK_RAW, 0, blocks, CHUNK_HEADER.size + len(data)) + data
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = stream.read(size - len(buf))
+        if not chunk:
+            break
+        buf += chunk
+    return bytes(buf)
+
+
+def backup_partition(stream: BinaryIO, partition: Partition, output: _BackupFile, pipeline: _Pipeline) -> None:
+    """从设备数据流读取整个分区并提交到流水线，原始数据在读取线程中计算哈希"""
+    raw_hash = hashlib.sha256()
+    if output.sparse:
+        pipeline.feed(output, _sparse_header(partition.size))
+    remaining = partition.size
+    while remaining:
+        data = _read_exact(stream, min(SEGMENT, remaining))
+        if not data:
+            output.failed = True
+            pipeline.end(output, "")
+            raise BackupError(f"数据在 {partition.size - remaining} 字节处中断")
+        raw_hash.update(data)
+        remaining -= len(data)
+        pipeline.feed(output, _sparse_chunk(data) if output.sparse else data)
+    pipeline.end(output, raw_hash.hexdigest())
+
+
+# ---- 设备访问 ----
+
+def _adb_cmd(executor) -> List[str]:
+    adb_path = executor._find_tool("adb")
+    return [str(adb_path) if adb_path else 'adb'] + executor._serial_args()
+
+
+def _shell(executor, command: str) -> str:
+    if executor.native_adb:
+        from commands.adb_client import AdbError, get_client
+
+        try:
+            return get_client().shell(executor.serial, command).decode('utf-8', 'replace')
+        except ConnectionRefusedError:
+            pass
+        except (AdbError, OSError) as e:
+            raise BackupError(str(e))
+    try:
+        result = subprocess.run(_adb_cmd(executor) + ['shell', command], capture_output=True, text=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise BackupError(str(e))
+    if result.returncode != 0:
+        raise BackupError(result.stderr.strip() or f"adb返回码 {result.returncode}")
+    return result.stdout
+
+
+@contextmanager
+def _exec_out(executor, command: str) -> Iterator[BinaryIO]:
+    """打开设备命令的原始输出流（adb exec-out）"""
+    if executor.native_adb:
+        from commands.adb_client import AdbError, get_client
+
+        try:
+            conn = get_client().open_service(executor.serial, f"exec:{command}", timeout=60.0)
+        except ConnectionRefusedError:
+            conn = None
+        except (AdbError, OSError) as e:
+            raise BackupError(str(e))
+        if conn is not None:
+            stream = conn.sock.makefile('rb')
+            try:
+                yield stream
+            finally:
+                stream.close()
+                conn.close()
+            return
+    try:
+        proc = subprocess.Popen(_adb_cmd(executor) + ['exec-out', command], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+    except OSError as e:
+        raise BackupError(str(e))
+    try:
+        yield proc.stdout
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def _as_root(executor) -> Callable[[str], str]:
+    """adb已是root时直接执行，否则通过su执行"""
+    if _shell(executor, 'id -u').strip() == '0':
+        return lambda command: command
+    return lambda command: f"su -c '{command}'"
+
+
+def list_partitions(executor, root: Callable[[str], str]) -> List[Partition]:
+    """一次shell调用列出 by-name 下的所有分区及大小"""
+    dirs = ' '.join(BY_NAME_DIRS)
+    script = (f"for d in {dirs}; do [ -d $d ] && break; done; "
+              "for p in $d/*; do echo \"$p $(blockdev --getsize64 $p)\"; done")
+    partitions = []
+    for line in _shell(executor, root(script)).splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1].isdigit() and int(parts[1]) > 0:
+            partitions.append(Partition(parts[0].rsplit('/', 1)[-1], parts[0], int(parts[1])))
+    return partitions
+
+
+# ---- 清单 ----
+
+def update_manifest(dest: Path, entries: List[BackupEntry]) -> Path:
+    """合并写入 manifest.json，并重新生成 restore.AFC"""
+    manifest_path = dest / MANIFEST_NAME
+    images: Dict[str, dict] = {}
+    if manifest_path.is_file():
+        try:
+            images = json.loads(manifest_path.read_text(encoding='utf-8')).get('images', {})
+        except (OSError, ValueError):
+            images = {}
+    for entry in entries:
+        # 同一分区换了压缩格式时去掉旧文件的记录
+        images = {name: item for name, item in images.items() if item.get('partition') != entry.partition}
+        images[entry.file] = entry.to_dict()
+    tmp = manifest_path.with_name(MANIFEST_NAME + '.tmp')
+    tmp.write_text(json.dumps({'images': images}, indent=2, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp, manifest_path)
+
+    lines = ["# 由BACKUP生成的恢复脚本：先校验备份文件，再逐个刷写分区",
+             "# 执行前请确认设备处于fastboot模式，并检查需要恢复的分区",
+             f"VERIFY({MANIFEST_NAME})"]
+    for name, item in sorted(images.items(), key=lambda kv: kv[1].get('partition', kv[0])):
+        if item.get('partition'):
+            lines.append(f"FLASH({item['partition']}, {name})")
+    (dest / RESTORE_SCRIPT).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return manifest_path
+
+
+# ---- 命令 ----
+
+def _run_backup(executor, dest: str, names: Optional[List[str]], codec_name: str) -> bool:
+    try:
+        codec = parse_codec(codec_name)
+    except ValueError as e:
+        print(f"错误: {e}")
+        return False
+    dest_dir = executor.script_dir / dest
+    try:
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        root = _as_root(executor)
+        partitions = list_partitions(executor, root)
+    except (OSError, BackupError) as e:
+        print(f"错误: 无法读取分区列表 - {e}")
+        return False
+    if not partitions:
+        print("错误: 没有找到可读取的分区（需要root权限读取 /dev/block/by-name）")
+        return False
+
+    if names is None:
+        selected = [p for p in partitions if p.name not in SKIP_PARTITIONS]
+    else:
+        by_name = {p.name: p for p in partitions}
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            print(f"错误: 设备上没有分区 {', '.join(missing)}")
+            return False
+        selected = [by_name[name] for name in names]
+
+    total = sum(p.size for p in selected)
+    print(f"备份 {len(selected)} 个分区（{total / 1024 / 1024:.1f} MB，压缩: {codec or '无'}）到 {dest_dir}")
+    pipeline = _Pipeline(max(2, min(8, os.cpu_count() or 2)))
+    failed = []
+    try:
+        for partition in selected:
+            sparse = partition.size % DEFAULT_BLOCK_SIZE == 0
+            filename = f"{partition.name}.img" + (_SUFFIXES[codec] if codec else "")
+            output = _BackupFile(partition, dest_dir / filename, codec, sparse)
+            executor.debug("读取 %s (%d 字节, sparse=%s)", partition.path, partition.size, sparse)
+            try:
+                with executor.tracer.span(f"dd {partition.name}", 'tool', executor.serial):
+                    with _exec_out(executor, root(f"dd if={partition.path} bs={SEGMENT} 2>/dev/null")) as stream:
+                        backup_partition(stream, partition, output, pipeline)
+                executor.tracer.add_bytes(partition.size)
+            except (OSError, BackupError) as e:
+                if not output.failed:
+                    output.failed = True
+                    pipeline.end(output, "")
+                print(f"错误: 读取分区 {partition.name} 失败 - {e}")
+                failed.append(partition.name)
+    finally:
+        entries = pipeline.close()
+    if entries:
+        try:
+            manifest_path = update_manifest(dest_dir, entries)
+        except OSError as e:
+            print(f"错误: 无法写入备份清单 - {e}")
+            return False
+        print(f"清单: {manifest_path}，恢复脚本: {dest_dir / RESTORE_SCRIPT}")
+    if failed:
+        print(f"备份失败 {len(failed)}/{len(selected)}: {', '.join(failed)}")
+        return False
+    return True
+
+
+def backup(executor, partition: str, dest: str = "backup", codec: str = "") -> bool:
+    """备份单个分区到目录，codec可选 zstd/xz/gzip/none"""
+    return _run_backup(executor, dest, [partition], codec)
+
+
+def backup_all(executor, dest: str = "backup", codec: str = "") -> bool:
+    """备份 by-name 下的所有分区（跳过userdata）"""
+    return _run_backup(executor, dest, None, codec)
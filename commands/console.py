@@ -0,0 +1,88 @@
+"""
+控制台输出路由
+按线程把print输出重定向到各自的日志流，多设备并行时互不串行
+输出按整行写入目标流，多个线程（脚本并行分支、后台任务）写同一个流时不会在行内交错
+"""
+
+import sys
+import threading
+from typing import Optional, TextIO, Tuple
+
+
+class ThreadOutputRouter:
+    """按线程分发写入的stdout替身，未绑定的线程写回原始流"""
+
+    def __init__(self, fallback: TextIO):
+        self.fallback = fallback
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def bind(self, stream: Optional[TextIO], prefix: str = "") -> None:
+        """为当前线程绑定输出流和行前缀"""
+        self._flush_pending()
+        self._local.stream = stream
+        self._local.prefix = prefix
+        self._local.at_line_start = True
+
+    def unbind(self) -> None:
+        """解除当前线程的绑定"""
+        self._flush_pending()
+        self._local.stream = None
+        self._local.prefix = ""
+
+    def current(self) -> Tuple[Optional[TextIO], str]:
+        """当前线程绑定的 (输出流, 行前缀)，供派生的线程继承"""
+        return getattr(self._local, 'stream', None), getattr(self._local, 'prefix', "")
+
+    def _target(self) -> TextIO:
+        return getattr(self._local, 'stream', None) or self.fallback
+
+    def _emit(self, pieces) -> None:
+        # 在每行开头加上前缀（如设备序列号、行号）
+        prefix = getattr(self._local, 'prefix', "")
+        out = []
+        for piece in pieces:
+            if prefix and getattr(self._local, 'at_line_start', True):
+                out.append(prefix)
+            out.append(piece)
+            self._local.at_line_start = piece.endswith(('\n', '\r'))
+        if out:
+            with self._write_lock:
+                self._target().write(''.join(out))
+
+    def _flush_pending(self) -> None:
+        pending = getattr(self._local, 'pending', "")
+        if pending:
+            self._local.pending = ""
+            self._emit([pending])
+
+    def write(self, text: str) -> int:
+        if not text:
+            return 0
+        # 不完整的行先留在当前线程的缓冲中，凑成整行后一次写出
+        pieces = (getattr(self._local, 'pending', "") + text).splitlines(keepends=True)
+        self._local.pending = "" if pieces[-1].endswith(('\n', '\r')) else pieces.pop()
+        self._emit(pieces)
+        return len(text)
+
+    def flush(self) -> None:
+        self._flush_pending()
+        self._target().flush()
+
+    def isatty(self) -> bool:
+        return False
+
+    @property
+    def encoding(self) -> str:
+        return getattr(self.fallback, 'encoding', 'utf-8')
+
+
+_router_lock = threading.Lock()
+
+
+def install_router() -> ThreadOutputRouter:
+    """把sys.stdout替换为线程路由器（重复调用返回同一个实例）"""
+    with _router_lock:
+        if not isinstance(sys.stdout, ThreadOutputRouter):
+            sys.stdout = ThreadOutputRouter(sys.stdout)
+        return sys.stdout
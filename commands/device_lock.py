@@ -0,0 +1,26 @@
+"""
+设备锁
+脚本的并行分支、后台任务以及常驻服务中的多个任务可能同时操作同一台设备，
+对设备执行的命令按序列号互斥：同一台设备同一时间只执行一条命令，不同设备互不影响
+"""
+
+import threading
+from typing import Dict, Optional
+
+# 只在本机执行、不操作设备的命令，不需要加锁
+HOST_COMMANDS = {'PRINT', 'PAUSE', 'CLEAR', 'WAIT', 'VERIFY'}
+
+_locks: Dict[str, threading.RLock] = {}
+_locks_lock = threading.Lock()
+
+
+def device_lock(serial: Optional[str]) -> threading.RLock:
+    """
+    序列号对应的锁，同一线程可重入；调用方应传入解析后的真实序列号（见FastbootExecutor.device_serial），
+    None表示无法确定设备
+    """
+    key = serial or ''
+    with _locks_lock:
+        if key not in _locks:
+            _locks[key] = threading.RLock()
+        return _locks[key]
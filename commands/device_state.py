@@ -0,0 +1,161 @@
+"""
+设备状态监视
+WAIT_FOR(adb|fastboot|recovery|sideload, 超时秒数)：设备一进入目标状态立即返回并报告切换耗时，
+取代重启后固定时长的WAIT
+- adb类状态优先使用adb server的 host:track-devices 推送，server不可用时用 adb devices 指数退避轮询
+- fastboot状态轮询 fastboot devices；tcp:目标直接尝试fastboot-TCP握手
+"""
+
+import socket
+import subprocess
+import time
+from typing import List, Optional, Tuple
+
+# 脚本中的状态名 -> adb devices 中的状态
+ADB_STATES = {'ADB': 'device', 'DEVICE': 'device', 'SYSTEM': 'device',
+              'RECOVERY': 'recovery', 'SIDELOAD': 'sideload'}
+
+POLL_INITIAL = 0.1
+POLL_MAX = 2.0
+
+
+def _matches(devices: List[Tuple[str, str]], serial: Optional[str], state: str) -> bool:
+    return any(s == state and (serial is None or dev == serial) for dev, s in devices)
+
+
+def _backoff_poll(check, deadline: float) -> bool:
+    """以指数退避轮询，check()返回True时结束"""
+    delay = POLL_INITIAL
+    while True:
+        if check():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_MAX)
+
+
+def parse_devices(text: str, state: Optional[str] = None) -> List[Tuple[str, str]]:
+    """
+    解析 `adb devices` / `fastboot devices` 的输出，返回 [(序列号, 状态)]，state不为None时只保留该状态的设备；
+    跳过标题行和adb启动server时输出的 "* daemon ..." 行
+    """
+    devices = []
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 2 or line.startswith(('*', 'List of devices')):
+            continue
+        if state is None or parts[1] == state:
+            devices.append((parts[0], parts[1]))
+    return devices
+
+
+def list_devices(executor, tool: str, state: Optional[str] = None, timeout: float = 10) -> List[Tuple[str, str]]:
+    """执行 `<tool> devices`，工具无法运行时返回空列表"""
+    tool_path = executor._find_tool(tool)
+    cmd = [str(tool_path) if tool_path else tool, 'devices']
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    return parse_devices(result.stdout, state)
+
+
+def single_device_serial(executor) -> Optional[str]:
+    """adb和fastboot下唯一连接的设备的序列号；没有设备或有多台设备时返回None"""
+    serials = set()
+    for tool in ('fastboot', 'adb'):
+        devices = None
+        if tool == 'adb' and executor.native_adb:
+            from commands.adb_client import AdbError, get_client
+
+            try:
+                devices = get_client().devices()
+            except (OSError, AdbError):
+                pass
+        if devices is None:
+            devices = list_devices(executor, tool)
+        serials.update(dev for dev, _ in devices)
+    return serials.pop() if len(serials) == 1 else None
+
+
+def _wait_adb_tracked(serial: Optional[str], state: str, deadline: float) -> Optional[bool]:
+    """通过track-devices等待；server不可用时返回None"""
+    from commands.adb_client import get_client
+
+    client = get_client()
+    try:
+        updates = client.track_devices(deadline)
+        for devices in updates:
+            if _matches(devices, serial, state):
+                updates.close()
+                return True
+            if time.monotonic() >= deadline:
+                updates.close()
+                return False
+    except ConnectionRefusedError:
+        return None
+    except socket.timeout:
+        return False
+    except OSError:
+        return None
+    return False
+
+
+def _wait_fastboot_tcp(target: str, deadline: float) -> bool:
+    from commands.fastboot_protocol import FastbootError, open_transport
+
+    def check() -> bool:
+        try:
+            open_transport(target, timeout=2.0).close()
+            return True
+        except (OSError, FastbootError):
+            return False
+    return _backoff_poll(check, deadline)
+
+
+def wait_for_state(executor, state: str, timeout: float) -> bool:
+    """等待设备进入指定状态"""
+    deadline = time.monotonic() + timeout
+    serial = executor.serial
+    key = state.strip().upper()
+
+    if key in ('FASTBOOT', 'BOOTLOADER'):
+        if serial and serial.startswith('tcp:'):
+            return _wait_fastboot_tcp(serial, deadline)
+        return _backoff_poll(lambda: _matches(list_devices(executor, 'fastboot'), serial, 'fastboot'),
+                             deadline)
+
+    adb_state = ADB_STATES[key]
+    if executor.native_adb:
+        tracked = _wait_adb_tracked(serial, adb_state, deadline)
+        if tracked is not None:
+            return tracked
+    return _backoff_poll(lambda: _matches(list_devices(executor, 'adb'), serial, adb_state), deadline)
+
+
+def wait_for(executor, state: str, timeout: str = "60") -> bool:
+    """等待设备进入 adb/fastboot/recovery/sideload 状态"""
+    key = state.strip().upper()
+    if key not in ADB_STATES and key not in ('FASTBOOT', 'BOOTLOADER'):
+        print(f"错误: 未知的设备状态 - {state}（可选: adb, fastboot, recovery, sideload）")
+        return False
+    try:
+        seconds = float(timeout)
+    except ValueError:
+        print(f"错误: 无效的超时时间 - {timeout}")
+        return False
+
+    target = executor.serial or "设备"
+    print(f"等待 {target} 进入 {state.strip().lower()} 状态（最长 {seconds:g} 秒）...")
+    start = time.monotonic()
+    with executor.tracer.span(f"WAIT_FOR {key}", 'wait', executor.serial, state=key) as span:
+        ok = wait_for_state(executor, key, seconds)
+        elapsed = time.monotonic() - start
+        span.set(latency=elapsed, status='ok' if ok else 'timeout')
+    if ok:
+        print(f"{target} 已进入 {state.strip().lower()} 状态，用时 {elapsed:.1f}s")
+        return True
+    print(f"错误: 等待 {target} 进入 {state.strip().lower()} 状态超时（{seconds:g}秒）")
+    return False
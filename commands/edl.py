@@ -0,0 +1,459 @@
+"""
+高通EDL（9008）刷写
+FLASHEDL(目录或rawprogram.xml, 分区...)：按rawprogram*.xml把镜像写入对应LUN的扇区，全部写入后按patch*.xml修正分区表
+- 目录中的rawprogramN.xml/patchN.xml全部使用（UFS每个LUN一组）；指定分区（label）时只写这些分区，不应用patch
+- sparse镜像按chunk写入：DONT_CARE区域跳过，FILL区域展开
+- 连接设备之前并行检查所有镜像是否存在、大小是否超过分区
+EDL_READ(分区, 文件) / EDL_ERASE(分区)：按设备上的GPT查找分区；EDL_RESET()：重启设备，离开EDL
+脚本变量：
+- EDL_PORT      设备端口（COM5、/dev/ttyUSB0、usb、tcp:主机:端口），未设置时自动查找05C6:9008
+- EDL_LOADER    引导程序（prog_firehose），未设置时在rawprogram所在目录中查找
+- EDL_STORAGE   存储类型 ufs/emmc，未设置时按rawprogram的扇区大小判断（4096为ufs），EDL_READ/EDL_ERASE默认emmc
+- EDL_PAYLOAD   单次发送大小（如1M），未设置时与设备协商
+- EDL_BATCH     每条program/read命令的数据量（默认64M）
+- EDL_BOOT_LUN  FLASHEDL完成后设置的启动LUN（UFS）
+同一进程中保持与设备的连接，引导程序只上传一次
+"""
+
+import os
+import re
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from commands.edl_protocol import (DEFAULT_BATCH, SECTOR_SIZES, Channel, EdlError, Extent, FirehoseClient,
+                                   connect, find_port, open_transport)
+
+RAWPROGRAM = re.compile(r'^rawprogram(\d+)\.xml$', re.IGNORECASE)
+PATCH = re.compile(r'^patch(\d+)\.xml$', re.IGNORECASE)
+LOADER_SUFFIXES = ('.mbn', '.elf', '.melf', '.bin')
+GPT_SIGNATURE = b'EFI PART'
+GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+MAX_LUNS = 8
+
+
+class RawProgramError(Exception):
+    """rawprogram/patch文件格式错误"""
+
+
+@dataclass
+class ProgramEntry:
+    """rawprogram中的一个program"""
+    label: str
+    filename: str
+    sector_size: int
+    lun: int
+    start_sector: Union[int, str]  # 备份GPT等为 NUM_DISK_SECTORS-5. 这样的表达式，由设备计算
+    num_sectors: int
+    file_sector_offset: int = 0
+    source: Optional[Path] = None
+
+
+@dataclass
+class FlashLayout:
+    """一组rawprogram/patch文件"""
+    base_dir: Path
+    programs: List[ProgramEntry] = field(default_factory=list)
+    erases: List[Dict[str, str]] = field(default_factory=list)
+    patches: List[Dict[str, str]] = field(default_factory=list)
+
+    @property
+    def sector_size(self) -> int:
+        return self.programs[0].sector_size if self.programs else SECTOR_SIZES['emmc']
+
+
+@dataclass
+class GptPartition:
+    """设备GPT中的一个分区"""
+    name: str
+    lun: int
+    first: int
+    last: int
+
+    @property
+    def sectors(self) -> int:
+        return self.last - self.first + 1
+
+
+def _sector(text: str) -> Union[int, str]:
+    text = text.strip()
+    return int(text) if text.isdigit() else text
+
+
+def _load_xml(path: Path) -> ET.Element:
+    try:
+        return ET.parse(path).getroot()
+    except ET.ParseError as e:
+        raise RawProgramError(f"{path.name}: {e}")
+
+
+def parse_rawprogram(path: Path) -> Tuple[List[ProgramEntry], List[Dict[str, str]]]:
+    """返回 (program列表, erase列表)；没有文件名的program只用于说明分区布局，不写入"""
+    programs, erases = [], []
+    for elem in _load_xml(path):
+        attrs = elem.attrib
+        try:
+            if elem.tag == 'program':
+                programs.append(ProgramEntry(
+                    label=attrs.get('label', ''), filename=attrs.get('filename', '').strip(),
+                    sector_size=int(attrs['SECTOR_SIZE_IN_BYTES']),
+                    lun=int(attrs.get('physical_partition_number', '0')),
+                    start_sector=_sector(attrs['start_sector']),
+                    num_sectors=int(attrs.get('num_partition_sectors', '0').rstrip('.') or 0),
+                    file_sector_offset=int(attrs.get('file_sector_offset', '0') or 0)))
+            elif elem.tag == 'erase':
+                erases.append(dict(attrs))
+        except (KeyError, ValueError) as e:
+            raise RawProgramError(f"{path.name}: {elem.tag} 的属性无效 - {e}")
+    return programs, erases
+
+
+def parse_patch(path: Path) -> List[Dict[str, str]]:
+    """patch文件中针对设备（filename="DISK"）的修改；针对本地文件的修改只在生成镜像时使用"""
+    return [dict(elem.attrib) for elem in _load_xml(path)
+            if elem.tag == 'patch' and elem.attrib.get('filename') == 'DISK']
+
+
+def load_layout(path: Path) -> FlashLayout:
+    """目录：使用其中全部rawprogramN.xml和patchN.xml；文件：该rawprogram和同编号的patch"""
+    if path.is_dir():
+        base_dir = path
+        names = sorted(os.listdir(path))
+        raw_files = sorted((p for p in names if RAWPROGRAM.match(p)), key=lambda p: int(RAWPROGRAM.match(p).group(1)))
+        patch_files = sorted((p for p in names if PATCH.match(p)), key=lambda p: int(PATCH.match(p).group(1)))
+        if not raw_files:
+            raise RawProgramError(f"目录中没有rawprogram*.xml - {path}")
+    else:
+        base_dir = path.parent
+        raw_files = [path.name]
+        match = RAWPROGRAM.match(path.name)
+        patch_name = f"patch{match.group(1)}.xml" if match else ""
+        patch_files = [patch_name] if patch_name and (base_dir / patch_name).is_file() else []
+    layout = FlashLayout(base_dir)
+    for name in raw_files:
+        programs, erases = parse_rawprogram(base_dir / name)
+        for entry in programs:
+            if entry.filename:
+                entry.source = base_dir / entry.filename
+        layout.programs.extend(programs)
+        layout.erases.extend(erases)
+    for name in patch_files:
+        layout.patches.extend(parse_patch(base_dir / name))
+    return layout
+
+
+def find_loader(directory: Path) -> Optional[Path]:
+    """目录中的Firehose引导程序，有多个时优先带ddr的（完整版）"""
+    candidates = [p for p in directory.iterdir() if p.is_file() and p.suffix.lower() in LOADER_SUFFIXES
+                  and ('firehose' in p.name.lower() or 'devprg' in p.name.lower())]
+    candidates.sort(key=lambda p: ('ddr' not in p.name.lower(), p.name))
+    return candidates[0] if candidates else None
+
+
+def check_image(entry: ProgramEntry) -> Optional[str]:
+    """检查program的镜像，返回错误说明"""
+    from commands.scatter import image_size
+
+    try:
+        size = image_size(entry.source) - entry.file_sector_offset * entry.sector_size
+    except OSError:
+        return f"镜像不存在 - {entry.filename}"
+    if entry.num_sectors and size > entry.num_sectors * entry.sector_size:
+        return f"镜像 {entry.filename} 大小 {size:#x} 超过分区大小 {entry.num_sectors * entry.sector_size:#x}"
+    return None
+
+
+def check_images(entries: List[ProgramEntry], workers: int = 8) -> List[Tuple[ProgramEntry, str]]:
+    if not entries:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(entries)))) as pool:
+        results = list(pool.map(check_image, entries))
+    return [(entry, error) for entry, error in zip(entries, results) if error]
+
+
+@contextmanager
+def image_extents(entry: ProgramEntry) -> Iterator[List[Tuple[int, Extent]]]:
+    """镜像要写入的各段 (相对分区起始的扇区, 数据)；sparse镜像的DONT_CARE区域不写"""
+    from commands.sparse import CHUNK_FILL, CHUNK_RAW, SparseError, SparseImage, is_sparse
+
+    with open(entry.source, 'rb') as f:
+        if not is_sparse(entry.source):
+            offset = entry.file_sector_offset * entry.sector_size
+            yield [(0, Extent(os.fstat(f.fileno()).st_size - offset, f, offset))]
+            return
+        try:
+            image = SparseImage.from_sparse(entry.source)
+        except SparseError as e:
+            raise EdlError(f"{entry.filename}: {e}")
+        if image.block_size % entry.sector_size:
+            raise EdlError(f"{entry.filename} 的块大小 {image.block_size} 不是扇区大小的整数倍")
+        per_block = image.block_size // entry.sector_size
+        extents, block = [], 0
+        for chunk in image.chunks:
+            length = chunk.blocks * image.block_size
+            if chunk.type == CHUNK_RAW:
+                extents.append((block * per_block, Extent(length, f, chunk.offset)))
+            elif chunk.type == CHUNK_FILL:
+                extents.append((block * per_block, Extent(length, fill=chunk.fill)))
+            block += chunk.blocks
+        yield extents
+
+
+# ---- GPT ----
+
+def read_gpt(client: FirehoseClient, sector_size: int, lun: int) -> List[GptPartition]:
+    header = client.read_sectors(sector_size, lun, 1, 1)
+    fields = GPT_HEADER.unpack_from(header)
+    if fields[0] != GPT_SIGNATURE:
+        raise EdlError(f"LUN{lun} 没有GPT")
+    entries_lba, count, entry_size = fields[10], fields[11], fields[12]
+    sectors = -(-count * entry_size // sector_size)
+    table = client.read_sectors(sector_size, lun, entries_lba, sectors)
+    partitions = []
+    for index in range(count):
+        type_guid, _guid, first, last, _attrs, name = GPT_ENTRY.unpack_from(table, index * entry_size)
+        if type_guid == bytes(16) or last < first:
+            continue
+        partitions.append(GptPartition(name.decode('utf-16-le').split('\0', 1)[0], lun, first, last))
+    return partitions
+
+
+def device_partitions(client: FirehoseClient, sector_size: int) -> List[GptPartition]:
+    """所有LUN的分区（eMMC只有LUN0，UFS读到第一个不存在的LUN为止）；结果缓存在连接上"""
+    if client.partitions is not None:
+        return client.partitions
+    partitions = read_gpt(client, sector_size, 0)
+    if client.memory == 'ufs':
+        # 读取不存在的LUN时设备返回NAK和错误日志，属于正常情况，不显示
+        info, client.info = client.info, (lambda message: None)
+        try:
+            for lun in range(1, MAX_LUNS):
+                partitions.extend(read_gpt(client, sector_size, lun))
+        except EdlError:
+            pass
+        finally:
+            client.info = info
+    client.partitions = partitions
+    return partitions
+
+
+# ---- 连接 ----
+
+class _Session:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.client: Optional[FirehoseClient] = None
+
+
+_SESSIONS: Dict[str, _Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _size_variable(executor, name: str, default: int) -> int:
+    from commands.image_cache import parse_size
+
+    value = executor.variables.get(name)
+    if not value:
+        return default
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise EdlError(f"无效的大小 {name} = {value}")
+
+
+@contextmanager
+def session(executor, memory: Optional[str] = None, loader: Optional[Path] = None) -> Iterator[FirehoseClient]:
+    """独占使用与设备的Firehose连接；第一次使用或设备重新进入EDL时握手并上传引导程序"""
+    target = executor.variables.get('EDL_PORT') or find_port()
+    if not target:
+        raise EdlError("没有找到EDL模式（05C6:9008）的设备，可用脚本变量 EDL_PORT 指定端口")
+    memory = (executor.variables.get('EDL_STORAGE') or memory or '').lower()
+    if memory and memory not in SECTOR_SIZES:
+        raise EdlError(f"不支持的存储类型 {memory}，可选: {', '.join(SECTOR_SIZES)}")
+    payload = _size_variable(executor, 'EDL_PAYLOAD', 0)
+    batch = _size_variable(executor, 'EDL_BATCH', DEFAULT_BATCH)
+    with _SESSIONS_LOCK:
+        state = _SESSIONS.setdefault(target, _Session())
+    with state.lock:
+        client = state.client
+        if client is not None:
+            try:
+                client.nop()
+            except (OSError, EdlError):
+                client.close()
+                client = state.client = None
+        if client is None:
+            if executor.variables.get('EDL_LOADER'):
+                loader = executor.script_dir / executor.variables['EDL_LOADER']
+            loader_data = loader.read_bytes() if loader is not None else None
+            timeout = executor._timeout_for('edl')
+            print(f"连接EDL设备 {target}" + (f"（引导程序 {loader.name}）" if loader is not None else ""))
+            channel = Channel(open_transport(target, timeout))
+            try:
+                client = connect(channel, loader_data, memory or 'emmc', payload, batch, timeout)
+            except BaseException:
+                channel.close()
+                raise
+            state.client = client
+            print(f"Firehose已就绪: {client.memory}，单次发送 {client.payload_size // 1024} KB")
+        elif memory and client.memory != memory:
+            client.memory = memory
+            client.configure()
+            client.partitions = None
+        client.batch_size = batch
+        try:
+            yield client
+        except OSError:
+            # 连接已不可用，下次重新握手
+            client.close()
+            state.client = None
+            raise
+
+
+def _close_session(executor) -> None:
+    target = executor.variables.get('EDL_PORT') or find_port()
+    state = _SESSIONS.get(target or '')
+    if state is not None and state.client is not None:
+        state.client.close()
+        state.client = None
+
+
+# ---- 命令 ----
+
+def _program(client: FirehoseClient, entry: ProgramEntry) -> int:
+    """写入一个program，返回写入的字节数"""
+    written = 0
+    with image_extents(entry) as extents:
+        for offset, extent in extents:
+            start = entry.start_sector + offset if isinstance(entry.start_sector, int) else entry.start_sector
+            client.program(entry.sector_size, entry.lun, start, extent, label=entry.filename)
+            written += extent.length
+    return written
+
+
+def flash_edl(executor, path: str, *partitions: str) -> bool:
+    """按rawprogram/patch文件通过EDL刷写；指定分区时只写这些分区"""
+    layout_path = executor.script_dir / path
+    try:
+        layout = load_layout(layout_path)
+    except (OSError, RawProgramError) as e:
+        print(f"错误: 无法读取rawprogram - {e}")
+        return False
+    selected = [entry for entry in layout.programs if entry.source is not None]
+    if partitions:
+        labels = {entry.label for entry in selected}
+        missing = [name for name in partitions if name not in labels]
+        if missing:
+            print(f"错误: rawprogram中没有可写入的分区 {', '.join(missing)}")
+            return False
+        selected = [entry for entry in selected if entry.label in partitions]
+
+    errors = check_images(selected)
+    if errors:
+        for entry, error in errors:
+            print(f"错误: 分区 {entry.label or entry.filename}: {error}")
+        print(f"镜像检查失败 {len(errors)}/{len(selected)}，未连接设备")
+        return False
+
+    loader = find_loader(layout.base_dir)
+    memory = 'ufs' if layout.sector_size == SECTOR_SIZES['ufs'] else 'emmc'
+    patches = [] if partitions else layout.patches
+    erases = [] if partitions else layout.erases
+    total_bytes, total_time = 0, 0.0
+    try:
+        with session(executor, memory, loader) as client:
+            for attrs in erases:
+                print(f"擦除 LUN{attrs.get('physical_partition_number', '0')} 扇区 {attrs.get('start_sector')}")
+                client.command('erase', **attrs)
+            for entry in selected:
+                print(f"Writing '{entry.label or entry.filename}' -> LUN{entry.lun} 扇区 {entry.start_sector}")
+                start = time.monotonic()
+                with executor.tracer.span(f"edl {entry.label or entry.filename}", 'tool', executor.serial):
+                    size = _program(client, entry)
+                elapsed = time.monotonic() - start
+                total_bytes += size
+                total_time += elapsed
+                rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+                print(f"OKAY [{elapsed:7.3f}s] ({rate:.1f} MB/s)")
+            if patches:
+                print(f"应用 {len(patches)} 条分区表修正")
+                for attrs in patches:
+                    client.patch(attrs)
+            client.partitions = None
+            boot_lun = executor.variables.get('EDL_BOOT_LUN')
+            if boot_lun:
+                client.set_bootable(int(boot_lun))
+                print(f"启动LUN已设置为 {boot_lun}")
+    except (OSError, EdlError, ValueError) as e:
+        print(f"错误: EDL刷写失败 - {e}")
+        return False
+    rate = total_bytes / total_time / 1024 / 1024 if total_time > 0 else 0.0
+    print(f"EDL刷写完成: {len(selected)} 个镜像，{total_bytes / 1024 / 1024:.1f} MB，平均 {rate:.1f} MB/s")
+    return True
+
+
+def _find_partition(client: FirehoseClient, name: str) -> Tuple[GptPartition, int]:
+    sector_size = SECTOR_SIZES[client.memory]
+    for partition in device_partitions(client, sector_size):
+        if partition.name == name:
+            return partition, sector_size
+    raise EdlError(f"设备上没有分区 {name}")
+
+
+def edl_read(executor, partition: str, file_path: str) -> bool:
+    """通过EDL把分区读出到文件"""
+    dest = executor.script_dir / file_path
+    tmp = dest.with_name(dest.name + '.part')
+    try:
+        with session(executor) as client:
+            part, sector_size = _find_partition(client, partition)
+            size = part.sectors * sector_size
+            print(f"读取 {partition}（LUN{part.lun}，{size / 1024 / 1024:.1f} MB）-> {dest}")
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            start = time.monotonic()
+            with open(tmp, 'wb') as out, \
+                    executor.tracer.span(f"edl read {partition}", 'tool', executor.serial):
+                client.read(sector_size, part.lun, part.first, part.sectors, out)
+            elapsed = time.monotonic() - start
+        os.replace(tmp, dest)
+    except (OSError, EdlError) as e:
+        tmp.unlink(missing_ok=True)
+        print(f"错误: 读取分区 {partition} 失败 - {e}")
+        return False
+    rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+    print(f"OKAY [{elapsed:7.3f}s] ({rate:.1f} MB/s)")
+    return True
+
+
+def edl_erase(executor, partition: str) -> bool:
+    """通过EDL擦除分区"""
+    try:
+        with session(executor) as client:
+            part, sector_size = _find_partition(client, partition)
+            client.erase(sector_size, part.lun, part.first, part.sectors)
+    except (OSError, EdlError) as e:
+        print(f"错误: 擦除分区 {partition} 失败 - {e}")
+        return False
+    print(f"已擦除 {partition}")
+    return True
+
+
+def edl_reset(executor) -> bool:
+    """重启设备，离开EDL"""
+    try:
+        with session(executor) as client:
+            client.reset()
+    except (OSError, EdlError) as e:
+        print(f"错误: 重启失败 - {e}")
+        return False
+    finally:
+        _close_session(executor)
+    print("设备正在重启")
+    return True
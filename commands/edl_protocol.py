@@ -0,0 +1,530 @@
+"""
+高通EDL（9008）协议实现
+- Sahara：握手并上传引导程序（prog_firehose），设备按需请求的数据块直接从内存中的引导程序切片发送
+- Firehose：configure / program / read / erase / patch / setbootablestoragedrive / power
+- 传输层可插拔：tcp:（网络转发或本地模拟设备）、串口（Windows高通驱动的COM口、Linux qcserial的/dev/ttyUSB*，需pyserial）、
+  usb（libusb直连，需pyusb）
+program按扇区对齐的大块写入：每条命令覆盖 batch_sectors 个扇区，数据按协商的 MaxPayloadSizeToTargetInBytes 分块发送，
+文件读入预分配的缓冲区，不产生额外拷贝
+"""
+
+import io
+import re
+import socket
+import struct
+import time
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import quoteattr
+
+from commands.trace import get_tracer
+
+try:
+    import serial  # pyserial，可选
+except ImportError:
+    serial = None
+
+try:
+    import usb.core  # pyusb，可选
+    import usb.util
+except ImportError:
+    usb = None
+
+QUALCOMM_VID = 0x05C6
+EDL_PID = 0x9008
+READ_SIZE = 1024 * 1024  # 每次从传输层读取的最大数据量
+DEFAULT_PAYLOAD = 1024 * 1024  # 首次configure请求的单次发送大小
+MAX_PAYLOAD = 16 * 1024 * 1024  # 自动协商时单次发送大小的上限
+DEFAULT_BATCH = 64 * 1024 * 1024  # 每条program/read命令覆盖的数据量
+SECTOR_SIZES = {'emmc': 512, 'ufs': 4096, 'nand': 4096, 'spinor': 4096}
+
+# Sahara命令
+SAHARA_HELLO = 0x01
+SAHARA_HELLO_RESP = 0x02
+SAHARA_READ_DATA = 0x03
+SAHARA_END_IMAGE_TX = 0x04
+SAHARA_DONE = 0x05
+SAHARA_DONE_RESP = 0x06
+SAHARA_RESET = 0x07
+SAHARA_RESET_RESP = 0x08
+SAHARA_READ_DATA_64 = 0x12
+SAHARA_HEADER = struct.Struct('<II')
+SAHARA_HELLO_PACKET = struct.Struct('<IIIIII6I')
+SAHARA_MODE_IMAGE_TX = 0
+
+
+class EdlError(Exception):
+    """设备返回NAK或协议异常"""
+
+
+class Transport:
+    """传输层接口：字节流收发，USB传输按单次bulk传输返回数据"""
+
+    def write(self, data) -> None:
+        raise NotImplementedError
+
+    def read(self, size: int, timeout: Optional[float] = None) -> bytes:
+        """读取1到size字节，超时抛出TimeoutError"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class TcpTransport(Transport):
+    """TCP字节流：连接到转发EDL端口的服务或本地模拟设备"""
+
+    def __init__(self, host: str, port: int, timeout: Optional[float] = 60.0):
+        self.timeout = timeout
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def write(self, data) -> None:
+        self.sock.sendall(data)
+
+    def read(self, size: int, timeout: Optional[float] = None) -> bytes:
+        self.sock.settimeout(timeout if timeout is not None else self.timeout)
+        try:
+            data = self.sock.recv(size)
+        except socket.timeout:
+            raise TimeoutError("设备无响应")
+        if not data:
+            raise ConnectionError("EDL连接被关闭")
+        return data
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class SerialTransport(Transport):
+    """高通驱动下的9008串口（COMx或/dev/ttyUSBx）"""
+
+    def __init__(self, port: str, timeout: Optional[float] = 60.0):
+        if serial is None:
+            raise EdlError("串口传输需要安装pyserial: pip install pyserial")
+        self.timeout = timeout
+        try:
+            self.port = serial.Serial(port, baudrate=115200, timeout=timeout)
+        except serial.SerialException as e:
+            raise EdlError(f"无法打开 {port} - {e}")
+
+    def write(self, data) -> None:
+        self.port.write(data)
+
+    def read(self, size: int, timeout: Optional[float] = None) -> bytes:
+        self.port.timeout = timeout if timeout is not None else self.timeout
+        first = self.port.read(1)
+        if not first:
+            raise TimeoutError("设备无响应")
+        waiting = min(size - 1, self.port.in_waiting)
+        return first + self.port.read(waiting) if waiting else first
+
+    def close(self) -> None:
+        self.port.close()
+
+
+class UsbTransport(Transport):
+    """通过libusb直接访问05C6:9008的bulk端点"""
+
+    def __init__(self, timeout: Optional[float] = 60.0):
+        if usb is None:
+            raise EdlError("USB传输需要安装pyusb（以及libusb）: pip install pyusb")
+        self.timeout = timeout
+        self.dev = usb.core.find(idVendor=QUALCOMM_VID, idProduct=EDL_PID)
+        if self.dev is None:
+            raise EdlError("没有找到EDL模式（05C6:9008）的设备")
+        try:
+            if self.dev.is_kernel_driver_active(0):
+                self.dev.detach_kernel_driver(0)
+        except (NotImplementedError, usb.core.USBError):
+            pass
+        self.dev.set_configuration()
+        intf = self.dev.get_active_configuration()[(0, 0)]
+        direction = usb.util.endpoint_direction
+        self.ep_in = usb.util.find_descriptor(
+            intf, custom_match=lambda ep: direction(ep.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        self.ep_out = usb.util.find_descriptor(
+            intf, custom_match=lambda ep: direction(ep.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        self.max_packet = self.ep_out.wMaxPacketSize
+
+    def _ms(self, timeout: Optional[float]) -> int:
+        timeout = timeout if timeout is not None else self.timeout
+        return int(timeout * 1000) if timeout else 0
+
+    def write(self, data) -> None:
+        self.ep_out.write(data, self._ms(None))
+        if len(data) % self.max_packet == 0:
+            # 长度正好是包大小的整数倍时补一个零长度包，设备才知道这次传输结束（ZLPAwareHost）
+            self.ep_out.write(b'', self._ms(None))
+
+    def read(self, size: int, timeout: Optional[float] = None) -> bytes:
+        # 按包大小向上取整，避免设备的一次传输超过缓冲区
+        size = max(self.ep_in.wMaxPacketSize, -(-size // self.ep_in.wMaxPacketSize) * self.ep_in.wMaxPacketSize)
+        try:
+            return bytes(self.ep_in.read(size, self._ms(timeout)))
+        except usb.core.USBTimeoutError:
+            raise TimeoutError("设备无响应")
+
+    def close(self) -> None:
+        usb.util.dispose_resources(self.dev)
+
+
+def find_port() -> Optional[str]:
+    """查找EDL设备：优先高通驱动的串口，其次libusb"""
+    if serial is not None:
+        from serial.tools import list_ports
+
+        for port in list_ports.comports():
+            if port.vid == QUALCOMM_VID and port.pid == EDL_PID:
+                return port.device
+    if usb is not None and usb.core.find(idVendor=QUALCOMM_VID, idProduct=EDL_PID) is not None:
+        return 'usb'
+    return None
+
+
+def open_transport(target: str, timeout: Optional[float] = 60.0) -> Transport:
+    """tcp:host:port、usb、串口名（COM5、/dev/ttyUSB0）"""
+    if target.startswith('tcp:'):
+        host, _, port = target[4:].rpartition(':')
+        if not host or not port.isdigit():
+            raise EdlError(f"无效的地址: {target}，格式为 tcp:主机:端口")
+        return TcpTransport(host, int(port), timeout)
+    if target == 'usb':
+        return UsbTransport(timeout)
+    return SerialTransport(target, timeout)
+
+
+class Channel:
+    """传输层之上的缓冲读取：按长度读取（Sahara、raw数据）或按XML文档读取（Firehose）"""
+
+    def __init__(self, transport: Transport):
+        self.transport = transport
+        self._buffer = bytearray()
+
+    def write(self, data) -> None:
+        self.transport.write(data)
+
+    def _fill(self, timeout: Optional[float] = None, size: int = READ_SIZE) -> None:
+        self._buffer += self.transport.read(size, timeout)
+
+    def read_exact(self, size: int, timeout: Optional[float] = None) -> bytes:
+        while len(self._buffer) < size:
+            self._fill(timeout, max(size - len(self._buffer), 512))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_into(self, out: BinaryIO, size: int, timeout: Optional[float] = None) -> None:
+        """把接下来的size字节原样写入out，不经过中间缓冲"""
+        if self._buffer:
+            head = bytes(self._buffer[:size])
+            del self._buffer[:len(head)]
+            out.write(head)
+            size -= len(head)
+        while size > 0:
+            data = self.transport.read(min(size, READ_SIZE), timeout)
+            if len(data) > size:
+                self._buffer += data[size:]
+                data = data[:size]
+            out.write(data)
+            size -= len(data)
+
+    def peek(self, timeout: Optional[float]) -> bytes:
+        """等待设备发来数据但不消耗；超时返回空串"""
+        if not self._buffer:
+            try:
+                self._fill(timeout)
+            except TimeoutError:
+                return b''
+        return bytes(self._buffer)
+
+    def read_document(self, timeout: Optional[float] = None) -> bytes:
+        """读取一个 <data>...</data> 文档（设备可能把多个文档放在一次传输中）"""
+        while True:
+            end = self._buffer.find(b'</data>')
+            if end >= 0:
+                end += len(b'</data>')
+                doc = bytes(self._buffer[:end])
+                del self._buffer[:end]
+                # 文档之间的换行和填充
+                while self._buffer[:1] in (b'\n', b'\r', b'\0', b' '):
+                    del self._buffer[:1]
+                return doc
+            self._fill(timeout)
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class SaharaClient:
+    """Sahara协议：设备上电进入EDL后发送HELLO，按块请求引导程序"""
+
+    def __init__(self, channel: Channel, timeout: Optional[float] = 10.0):
+        self.channel = channel
+        self.timeout = timeout
+
+    def _packet(self) -> Tuple[int, bytes]:
+        cmd, length = SAHARA_HEADER.unpack(self.channel.read_exact(SAHARA_HEADER.size, self.timeout))
+        if length < SAHARA_HEADER.size or length > 0x1000:
+            raise EdlError(f"Sahara包长度异常: {length:#x}")
+        return cmd, self.channel.read_exact(length - SAHARA_HEADER.size, self.timeout)
+
+    def _send(self, cmd: int, body: bytes = b'') -> None:
+        self.channel.write(SAHARA_HEADER.pack(cmd, SAHARA_HEADER.size + len(body)) + body)
+
+    def upload(self, loader: bytes) -> None:
+        """完成握手并上传引导程序，返回后设备开始运行Firehose"""
+        cmd, body = self._packet()
+        if cmd != SAHARA_HELLO:
+            raise EdlError(f"期望Sahara HELLO，收到命令 {cmd:#x}")
+        version = struct.unpack_from('<I', body)[0] if len(body) >= 4 else 2
+        self.channel.write(SAHARA_HELLO_PACKET.pack(
+            SAHARA_HELLO_RESP, SAHARA_HELLO_PACKET.size, min(version, 2), 1, 0, SAHARA_MODE_IMAGE_TX,
+            0, 0, 0, 0, 0, 0))
+        sent = 0
+        while True:
+            cmd, body = self._packet()
+            if cmd == SAHARA_READ_DATA:
+                _image, offset, length = struct.unpack_from('<III', body)
+            elif cmd == SAHARA_READ_DATA_64:
+                _image, offset, length = struct.unpack_from('<QQQ', body)
+            elif cmd == SAHARA_END_IMAGE_TX:
+                _image, status = struct.unpack_from('<II', body)
+                if status != 0:
+                    raise EdlError(f"设备拒绝了引导程序（状态 {status:#x}），引导程序与设备不匹配或未签名")
+                break
+            else:
+                raise EdlError(f"Sahara传输中收到意外的命令 {cmd:#x}")
+            if offset + length > len(loader):
+                raise EdlError(f"设备请求的数据超出引导程序: {offset:#x}+{length:#x}")
+            self.channel.write(memoryview(loader)[offset:offset + length])
+            sent += length
+        self._send(SAHARA_DONE)
+        cmd, body = self._packet()
+        if cmd != SAHARA_DONE_RESP:
+            raise EdlError(f"期望Sahara DONE_RESP，收到命令 {cmd:#x}")
+        get_tracer().add_bytes(sent)
+
+
+def _xml(tag: str, attrs: Dict[str, object]) -> bytes:
+    items = ''.join(f" {name}={quoteattr(str(value))}" for name, value in attrs.items())
+    return f'<?xml version="1.0" encoding="UTF-8" ?><data><{tag}{items} /></data>'.encode('utf-8')
+
+
+_VALUE_ATTR = re.compile(rb'value="([^"]*)"')
+
+
+def _parse_document(doc: bytes) -> List[Tuple[str, Dict[str, str]]]:
+    """文档中的元素 (标签, 属性)；日志中有非法字符时按正则提取"""
+    try:
+        root = ET.fromstring(doc)
+    except ET.ParseError:
+        return [('log', {'value': m.group(1).decode('utf-8', 'replace')}) for m in _VALUE_ATTR.finditer(doc)]
+    return [(child.tag, dict(child.attrib)) for child in root]
+
+
+class FirehoseClient:
+    """Firehose协议客户端（引导程序运行后）"""
+
+    def __init__(self, channel: Channel, memory: str = 'ufs', payload_size: int = 0,
+                 batch_size: int = DEFAULT_BATCH, timeout: Optional[float] = 60.0,
+                 info: Optional[Callable[[str], None]] = None):
+        self.channel = channel
+        self.memory = memory
+        self.payload_size = payload_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.info = info or (lambda message: print(f"(firehose) {message}"))
+        self.logs: List[str] = []
+        self.partitions = None  # 设备分区表缓存（见edl.device_partitions）
+
+    def close(self) -> None:
+        self.channel.close()
+
+    def drain_logs(self, timeout: float = 0.2) -> None:
+        """读取引导程序启动时主动发送的日志"""
+        while self.channel.peek(timeout):
+            for tag, attrs in _parse_document(self.channel.read_document(self.timeout)):
+                if tag == 'log':
+                    self._log(attrs.get('value', ''))
+
+    def _log(self, message: str) -> None:
+        self.logs = (self.logs + [message])[-20:]
+        self.info(message)
+
+    def _response(self, timeout: Optional[float] = None, nak_ok: bool = False) -> Dict[str, str]:
+        """读取到下一个response为止，日志交给info回调；NAK时抛出EdlError"""
+        while True:
+            for tag, attrs in _parse_document(self.channel.read_document(timeout or self.timeout)):
+                if tag == 'log':
+                    self._log(attrs.get('value', ''))
+                elif tag == 'response':
+                    if attrs.get('value') != 'ACK' and not nak_ok:
+                        detail = self.logs[-1] if self.logs else "设备返回NAK"
+                        raise EdlError(detail)
+                    return attrs
+
+    def command(self, tag: str, timeout: Optional[float] = None, **attrs) -> Dict[str, str]:
+        self.logs = []
+        self.channel.write(_xml(tag, attrs))
+        return self._response(timeout)
+
+    def nop(self) -> Dict[str, str]:
+        return self.command('nop')
+
+    def configure(self) -> None:
+        """
+        协商单次发送大小：payload_size为0时先请求默认值，设备支持更大的值时按其最大值（不超过MAX_PAYLOAD）重新配置；
+        设备不接受请求的大小时按其支持的最大值重新配置
+        """
+        requested = self.payload_size or DEFAULT_PAYLOAD
+        reply = self._configure(requested)
+        supported = int(reply.get('MaxPayloadSizeToTargetInBytesSupported') or 0)
+        if reply.get('value') != 'ACK':
+            if not supported or supported >= requested:
+                raise EdlError(f"configure失败: {self.logs[-1] if self.logs else 'NAK'}")
+            reply = self._configure(supported)
+            if reply.get('value') != 'ACK':
+                raise EdlError(f"configure失败: {self.logs[-1] if self.logs else 'NAK'}")
+        elif not self.payload_size and supported > requested:
+            reply = self._configure(min(supported, MAX_PAYLOAD))
+        accepted = int(reply.get('MaxPayloadSizeToTargetInBytes') or 0)
+        self.payload_size = accepted or requested
+
+    def _configure(self, payload_size: int) -> Dict[str, str]:
+        self.logs = []
+        self.channel.write(_xml('configure', dict(
+            MemoryName=self.memory, Verbose=0, AlwaysValidate=0, MaxDigestTableSizeInBytes=2048,
+            MaxPayloadSizeToTargetInBytes=payload_size, ZLPAwareHost=1, SkipStorageInit=0, SkipWrite=0)))
+        return self._response(nak_ok=True)
+
+    def _chunk_sectors(self, sector_size: int) -> Tuple[int, int]:
+        """每次发送和每条命令的扇区数：发送大小按扇区对齐，命令大小按发送大小对齐"""
+        payload = max(1, self.payload_size // sector_size)
+        batch = max(payload, self.batch_size // sector_size // payload * payload)
+        return payload, batch
+
+    def program(self, sector_size: int, lun: int, start_sector, data: 'Extent',
+                progress: Optional[Callable[[int], None]] = None, label: str = "") -> None:
+        """写入一段数据；start_sector为数字时按batch拆分成多条program命令，为表达式时只能用一条命令"""
+        payload, batch = self._chunk_sectors(sector_size)
+        total = -(-data.length // sector_size)
+        numeric = isinstance(start_sector, int)
+        buf = bytearray(payload * sector_size)
+        view = memoryview(buf)
+        done = 0
+        while done < total:
+            count = min(batch, total - done) if numeric else total
+            first = start_sector + done if numeric else start_sector
+            self.command('program', SECTOR_SIZE_IN_BYTES=sector_size, num_partition_sectors=count,
+                         physical_partition_number=lun, start_sector=first, filename=label or 'afc')
+            written = 0
+            while written < count:
+                n = min(payload, count - written)
+                size = n * sector_size
+                data.fill(view[:size], (done + written) * sector_size)
+                self.channel.write(view[:size])
+                written += n
+                if progress:
+                    progress(size)
+            self._response()
+            done += count
+        get_tracer().add_bytes(total * sector_size)
+
+    def read(self, sector_size: int, lun: int, start_sector: int, num_sectors: int, out: BinaryIO,
+             progress: Optional[Callable[[int], None]] = None) -> None:
+        """读取扇区写入out，按batch拆分成多条read命令"""
+        _payload, batch = self._chunk_sectors(sector_size)
+        done = 0
+        while done < num_sectors:
+            count = min(batch, num_sectors - done)
+            reply = self.command('read', SECTOR_SIZE_IN_BYTES=sector_size, num_partition_sectors=count,
+                                 physical_partition_number=lun, start_sector=start_sector + done)
+            if reply.get('rawmode') != 'true':
+                raise EdlError(f"read响应异常: {reply}")
+            self.channel.read_into(out, count * sector_size, self.timeout)
+            self._response()
+            done += count
+            if progress:
+                progress(count * sector_size)
+        get_tracer().add_bytes(num_sectors * sector_size)
+
+    def read_sectors(self, sector_size: int, lun: int, start_sector: int, num_sectors: int) -> bytes:
+        out = io.BytesIO()
+        self.read(sector_size, lun, start_sector, num_sectors, out)
+        return out.getvalue()
+
+    def erase(self, sector_size: int, lun: int, start_sector, num_sectors: int) -> None:
+        self.command('erase', SECTOR_SIZE_IN_BYTES=sector_size, num_partition_sectors=num_sectors,
+                     physical_partition_number=lun, start_sector=start_sector)
+
+    def patch(self, attrs: Dict[str, str]) -> None:
+        """转发patch XML中的一条修改（NUM_DISK_SECTORS、CRC32等表达式由设备计算）"""
+        self.command('patch', **attrs)
+
+    def set_bootable(self, lun: int) -> None:
+        self.command('setbootablestoragedrive', value=lun)
+
+    def reset(self, mode: str = 'reset') -> None:
+        self.command('power', value=mode, DelayInSeconds=1)
+
+
+class Extent:
+    """要写入的一段数据：文件中的一段（不足一个扇区的尾部补零），或重复的4字节填充值"""
+
+    def __init__(self, length: int, source: Optional[BinaryIO] = None, offset: int = 0, fill: bytes = b''):
+        self.length = length
+        self.source = source
+        self.offset = offset
+        self.fill_value = fill
+        self._pattern = b''
+
+    def fill(self, view: memoryview, position: int) -> None:
+        """把从position开始的数据放入view（view按扇区对齐，可能超出length）"""
+        size = len(view)
+        if self.source is None:
+            # 扇区大小是4的倍数，填充值总是从第一个字节开始
+            if len(self._pattern) < size:
+                self._pattern = (self.fill_value or bytes(4)) * (size // 4)
+            view[:] = self._pattern[:size]
+            return
+        want = max(0, min(size, self.length - position))
+        self.source.seek(self.offset + position)
+        got = self.source.readinto(view[:want]) if want else 0
+        if got < want:
+            raise EdlError(f"镜像文件提前结束: 偏移 {self.offset + position + got}")
+        if want < size:
+            view[want:] = bytes(size - want)
+
+
+def connect(channel: Channel, loader: Optional[bytes], memory: str, payload_size: int = 0,
+            batch_size: int = DEFAULT_BATCH, timeout: Optional[float] = 60.0,
+            hello_timeout: float = 3.0) -> FirehoseClient:
+    """
+    连接EDL设备：处于Sahara时上传引导程序，Firehose已在运行时直接使用；然后configure
+    """
+    head = channel.peek(hello_timeout)
+    if len(head) >= 4 and struct.unpack_from('<I', head)[0] == SAHARA_HELLO:
+        if loader is None:
+            raise EdlError("设备处于Sahara模式，需要引导程序（prog_firehose）")
+        SaharaClient(channel).upload(loader)
+        client = FirehoseClient(channel, memory, payload_size, batch_size, timeout)
+        # 引导程序启动后会先发送若干日志
+        deadline = time.monotonic() + 5
+        while not channel.peek(0.5) and time.monotonic() < deadline:
+            pass
+        client.drain_logs()
+    else:
+        client = FirehoseClient(channel, memory, payload_size, batch_size, timeout)
+        if head:
+            client.drain_logs()
+        else:
+            try:
+                client.command('nop', timeout=hello_timeout)
+            except TimeoutError:
+                raise EdlError("设备没有响应（不在EDL模式？）")
+    client.configure()
+    return client
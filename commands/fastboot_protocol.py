@@ -0,0 +1,370 @@
+"""
+fastboot协议实现
+支持 getvar / download / flash / erase / reboot / oem，传输层可插拔（目前实现了fastboot-TCP）
+镜像数据按固定大小缓冲区从磁盘流式发送，不会整体读入内存
+"""
+
+import hashlib
+import socket
+import struct
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+from commands.trace import get_tracer
+
+DEFAULT_TCP_PORT = 5554
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 每次发送的数据块大小
+
+
+class FastbootError(Exception):
+    """设备返回FAIL或协议异常"""
+
+
+class HashingReader:
+    """读取时同时计算SHA-256"""
+
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self.digest = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.digest.update(data)
+        return data
+
+    def check(self, expected_sha256: str) -> None:
+        digest = self.digest.hexdigest()
+        if digest != expected_sha256:
+            raise FastbootError(f"已发送数据的SHA-256不符，未写入: {digest[:12]} != {expected_sha256[:12]}")
+
+
+class Transport:
+    """传输层接口：按消息收发，USB传输可实现同样的接口"""
+
+    def write(self, data: bytes) -> None:
+        raise NotImplementedError
+
+    def read(self) -> bytes:
+        """读取一条设备响应"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class TcpTransport(Transport):
+    """fastboot-TCP传输：FB01握手后每条消息带8字节大端长度前缀"""
+
+    VERSION = b'FB01'
+
+    def __init__(self, host: str, port: int = DEFAULT_TCP_PORT, timeout: Optional[float] = 60.0):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            self.sock.sendall(self.VERSION)
+            reply = self._read_exact(4)
+            if reply[:2] != b'FB':
+                raise FastbootError(f"握手失败: {reply!r}")
+        except Exception:
+            self.sock.close()
+            raise
+
+    def _read_exact(self, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("fastboot连接被关闭")
+            buf += chunk
+        return bytes(buf)
+
+    def write(self, data: bytes) -> None:
+        self.sock.sendall(struct.pack('>Q', len(data)) + data)
+
+    def read(self) -> bytes:
+        length = struct.unpack('>Q', self._read_exact(8))[0]
+        return self._read_exact(length)
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def parse_target(target: str) -> Tuple[str, int]:
+    """解析 tcp:host[:port]"""
+    address = target[4:] if target.startswith('tcp:') else target
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address, DEFAULT_TCP_PORT
+
+
+def open_transport(target: str, timeout: Optional[float] = 60.0) -> Transport:
+    """按目标字符串创建传输层"""
+    if target.startswith('tcp:'):
+        host, port = parse_target(target)
+        return TcpTransport(host, port, timeout)
+    raise FastbootError(f"不支持的传输类型: {target}")
+
+
+class FastbootClient:
+    """fastboot协议客户端"""
+
+    def __init__(self, transport: Transport, info: Optional[Callable[[str], None]] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.transport = transport
+        self.info = info or (lambda message: print(f"(bootloader) {message}"))
+        self.chunk_size = chunk_size
+        self._max_download: Optional[int] = None
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def _read_response(self) -> Tuple[str, str]:
+        """读取响应直到OKAY/FAIL/DATA，INFO和TEXT消息交给info回调"""
+        while True:
+            reply = self.transport.read()
+            kind, payload = reply[:4].decode('ascii', 'replace'), reply[4:].decode('utf-8', 'replace')
+            if kind in ('INFO', 'TEXT'):
+                self.info(payload)
+                continue
+            if kind == 'FAIL':
+                raise FastbootError(payload or "设备返回FAIL")
+            if kind in ('OKAY', 'DATA'):
+                return kind, payload
+            raise FastbootError(f"未知的响应: {reply!r}")
+
+    def command(self, cmd: str) -> str:
+        """发送命令并返回OKAY后的内容"""
+        self.transport.write(cmd.encode('utf-8'))
+        kind, payload = self._read_response()
+        if kind != 'OKAY':
+            raise FastbootError(f"命令 {cmd} 的响应异常: {kind}{payload}")
+        return payload
+
+    def getvar(self, name: str) -> str:
+        return self.command(f"getvar:{name}")
+
+    def max_download_size(self) -> int:
+        """设备允许的单次download大小，设备未报告时返回0"""
+        if self._max_download is None:
+            try:
+                value = self.getvar('max-download-size')
+                self._max_download = int(value, 0) if value else 0
+            except (FastbootError, ValueError):
+                self._max_download = 0
+        return self._max_download
+
+    def download(self, stream: BinaryIO, size: int,
+                 progress: Optional[Callable[[int, int], None]] = None) -> None:
+        """把stream中的size字节发送到设备内存"""
+        limit = self.max_download_size()
+        if limit and size > limit:
+            raise FastbootError(f"数据大小 {size} 超过设备的 max-download-size {limit}")
+        self.transport.write(f"download:{size:08x}".encode('ascii'))
+        kind, payload = self._read_response()
+        if kind != 'DATA':
+            raise FastbootError(f"download响应异常: {kind}{payload}")
+        sent = 0
+        while sent < size:
+            data = stream.read(min(self.chunk_size, size - sent))
+            if not data:
+                raise FastbootError(f"数据提前结束: 已发送 {sent}/{size} 字节")
+            self.transport.write(data)
+            sent += len(data)
+            if progress:
+                progress(sent, size)
+        self._read_response()
+        get_tracer().add_bytes(sent)
+
+    def flash(self, partition: str) -> str:
+        return self.command(f"flash:{partition}")
+
+    def erase(self, partition: str) -> str:
+        return self.command(f"erase:{partition}")
+
+    def oem(self, command: str) -> str:
+        return self.command(f"oem {command}")
+
+    def reboot(self, target: str = "") -> str:
+        return self.command(f"reboot-{target}" if target else "reboot")
+
+    def flash_file(self, partition: str, path: Path, expected_sha256: Optional[str] = None,
+                   checkpoint=None) -> float:
+        """
+        流式下载并刷写镜像文件，返回传输速率(MB/s)
+        超过max-download-size的镜像自动转换/拆分为sparse分片依次发送
+        指定expected_sha256时校验镜像，不一致则不发送flash命令
+        checkpoint（journal.TransferCheckpoint）记录每个已写入的分片，恢复执行时跳过已写入的分片
+        """
+        from commands.sparse import ChunkStream, open_pieces
+
+        size = path.stat().st_size
+        limit = self.max_download_size()
+        split = open_pieces(path, limit) if limit else None
+        if split is None:
+            print(f"Sending '{partition}' ({size // 1024} KB)")
+            with open(path, 'rb', buffering=0) as f:
+                if expected_sha256 is None:
+                    return self._send_and_flash(partition, f, size)
+                # 在发送的同一次读取中计算哈希，设备内存中的数据校验通过后才写入分区
+                reader = HashingReader(f)
+                return self._send_and_flash(partition, reader, size,
+                                            lambda: reader.check(expected_sha256))
+
+        if expected_sha256 is not None:
+            # 分片发送时第一个分片写入前必须完成校验，只能先整体计算一次
+            from commands.manifest import file_sha256
+            
+            digest = file_sha256(path)
+            if digest != expected_sha256:
+                raise FastbootError(f"SHA-256不符，未写入: {digest[:12]} != {expected_sha256[:12]}")
+
+        image, pieces = split
+        skip = 0
+        if checkpoint is not None:
+            # 每个sparse分片只写入自己覆盖的区域，已确认写入的分片不需要重发
+            st = path.stat()
+            skip = checkpoint.start(partition, f"{path.resolve()}:{st.st_size}:{st.st_mtime_ns}:{limit}", len(pieces))
+            if skip:
+                print(f"'{partition}' 的前 {skip}/{len(pieces)} 个分片已写入，从第 {skip + 1} 个继续")
+        total_bytes = 0
+        total_time = 0.0
+        for index, piece in enumerate(pieces, 1):
+            if index <= skip:
+                continue
+            print(f"Sending sparse '{partition}' {index}/{len(pieces)} ({piece.size // 1024} KB)")
+            start = time.monotonic()
+            self._send_and_flash(partition, ChunkStream(image.iter_piece(piece)), piece.size)
+            total_bytes += piece.size
+            total_time += time.monotonic() - start
+            if checkpoint is not None:
+                checkpoint.piece_done(index, len(pieces))
+        return total_bytes / total_time / 1024 / 1024 if total_time > 0 else 0.0
+
+    def flash_stream(self, partition: str, stream: BinaryIO, size: int) -> float:
+        """
+        刷写只能顺序读取的raw数据（如边解压边发送的镜像），返回传输速率(MB/s)
+        超过max-download-size时即时拆分为sparse分片
+        """
+        from commands.sparse import ChunkStream, iter_stream_piece, split_stream
+
+        limit = self.max_download_size()
+        if not limit or size <= limit:
+            print(f"Sending '{partition}' ({size // 1024} KB)")
+            return self._send_and_flash(partition, stream, size)
+
+        pieces = split_stream(size, limit)
+        total_time = 0.0
+        for index, piece in enumerate(pieces, 1):
+            print(f"Sending sparse '{partition}' {index}/{len(pieces)} ({piece.size // 1024} KB)")
+            start = time.monotonic()
+            self._send_and_flash(partition, ChunkStream(iter_stream_piece(piece, stream)), piece.size)
+            total_time += time.monotonic() - start
+        return size / total_time / 1024 / 1024 if total_time > 0 else 0.0
+
+    def _send_and_flash(self, partition: str, stream: BinaryIO, size: int,
+                        before_flash: Optional[Callable[[], None]] = None) -> float:
+        start = time.monotonic()
+        self.download(stream, size)
+        elapsed = time.monotonic() - start
+        rate = size / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+        print(f"OKAY [{elapsed:7.3f}s] ({rate:.1f} MB/s)")
+        if before_flash is not None:
+            before_flash()
+        print(f"Writing '{partition}'")
+        start = time.monotonic()
+        self.flash(partition)
+        print(f"OKAY [{time.monotonic() - start:7.3f}s]")
+        return rate
+
+
+def run_native(target: str, args: List[str], timeout: Optional[float] = 60.0,
+               checkpoint=None) -> Optional[Tuple[bool, str]]:
+    """
+    用协议客户端执行一条fastboot命令
+    返回 (是否成功, 输出)；命令不受支持时返回None，由调用方回退到fastboot程序
+    """
+    if not args:
+        return None
+    command, rest = args[0], args[1:]
+    if command not in ('flash', 'erase', 'getvar', 'reboot', 'reboot-bootloader', 'oem', 'flashing'):
+        return None
+    try:
+        client = FastbootClient(open_transport(target, timeout))
+    except (OSError, FastbootError) as e:
+        return False, f"无法连接到 {target} - {e}"
+    try:
+        if command == 'flash' and len(rest) == 2:
+            client.flash_file(rest[0], Path(rest[1]), checkpoint=checkpoint)
+            return True, ""
+        if command == 'erase' and len(rest) == 1:
+            return True, client.erase(rest[0])
+        if command == 'getvar' and len(rest) == 1:
+            return True, f"{rest[0]}: {client.getvar(rest[0])}"
+        if command == 'reboot' and len(rest) <= 1:
+            return True, client.reboot(rest[0] if rest else "")
+        if command == 'reboot-bootloader' and not rest:
+            return True, client.reboot('bootloader')
+        if command in ('oem', 'flashing') and rest:
+            return True, client.command(' '.join(args))
+        return None
+    except (OSError, FastbootError) as e:
+        return False, str(e)
+    finally:
+        client.close()
+
+
+def run_native_stream(target: str, partition: str, stream, size: int,
+                      timeout: Optional[float] = 60.0) -> Optional[Tuple[bool, str]]:
+    """
+    用协议客户端刷写数据流（stream需支持peek，见image_source.PipelineReader）
+    数据本身是sparse镜像且超过max-download-size时无法即时拆分，返回None，由调用方改用文件刷写
+    """
+    from commands.image_source import ImageSourceError
+    from commands.sparse import SPARSE_MAGIC
+
+    try:
+        client = FastbootClient(open_transport(target, timeout))
+    except (OSError, FastbootError) as e:
+        return False, f"无法连接到 {target} - {e}"
+    try:
+        limit = client.max_download_size()
+        if limit and size > limit and stream.peek(4) == struct.pack('<I', SPARSE_MAGIC):
+            return None
+        client.flash_stream(partition, stream, size)
+        return True, ""
+    except (OSError, FastbootError, ImageSourceError) as e:
+        return False, str(e)
+    finally:
+        client.close()
+
+
+def run_native_flash(target: str, partition: str, path: Path, expected_sha256: Optional[str],
+                     timeout: Optional[float] = 60.0, checkpoint=None) -> Tuple[bool, str]:
+    """用协议客户端刷写镜像文件，可同时校验SHA-256"""
+    try:
+        client = FastbootClient(open_transport(target, timeout))
+    except (OSError, FastbootError) as e:
+        return False, f"无法连接到 {target} - {e}"
+    try:
+        client.flash_file(partition, path, expected_sha256, checkpoint)
+        return True, ""
+    except (OSError, FastbootError) as e:
+        return False, str(e)
+    finally:
+        client.close()
+
+
+def query_download_limit(target: str, timeout: Optional[float] = 10.0) -> int:
+    """设备的max-download-size，无法连接或未报告时返回0"""
+    try:
+        client = FastbootClient(open_transport(target, timeout))
+    except (OSError, FastbootError):
+        return 0
+    try:
+        return client.max_download_size()
+    finally:
+        client.close()
@@ -1,14 +1,168 @@
+import sqlite3
+import zipfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from commands.image_source import (ARCHIVE_SEP, ImageSource, ImageSourceError, PipelineReader, cached_content,
+                                   codec_for, extracted, find_image, probe, remember, resolve_image)
+from commands.manifest import get_hash_cache, manifest_for
+
+def _resolve(executor, partition: str, file_path: str) -> Optional[ImageSource]:
+    """解析镜像参数，失败时打印错误并返回None"""
+    try:
+        source = resolve_image(executor.script_dir, file_path, partition)
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f"错误: 无法读取镜像 {file_path} - {e}")
+        return None
+    if source is None:
+        print(f"错误: 文件不存在 - {executor.script_dir / file_path}")
+    return source
+
 def flash_partition(executor, partition: str, file_path: str) -> bool:
-    """刷写分区"""
-    full_path = executor.script_dir / file_path
-    if not full_path.exists():
-        print(f"错误: 文件不存在 - {full_path}")
+    """刷写分区（镜像可以是压缩文件或zip中的文件）"""
+    source = _resolve(executor, partition, file_path)
+    if source is None:
         return False
+    return _flash(executor, partition, source, executor.incremental)
+
+def flash_if_changed(executor, partition: str, file_path: str) -> bool:
+    """镜像与该设备上次刷写的内容相同时跳过"""
+    source = _resolve(executor, partition, file_path)
+    if source is None:
+        return False
+    return _flash(executor, partition, source, True)
+
+def _device_manifest(executor, check_unchanged: bool):
+    """当前设备的刷写记录，无法确定设备时说明不会跳过分区"""
+    manifest = manifest_for(executor)
+    if manifest is None and check_unchanged:
+        print("警告: 无法确定设备序列号（没有连接设备或连接了多台），不跳过未变化的分区")
+    return manifest
+
+def _flash(executor, partition: str, source: ImageSource, check_unchanged: bool,
+           expected: Optional[str] = None, digest: Optional[str] = None) -> bool:
+    """expected为需要在发送时校验的SHA-256，digest为已经校验过的SHA-256"""
+    if executor.image_cache is not None:
+        # 通过镜像库刷写：库中的镜像都是未压缩的文件，来源未变化时只需stat()
+        try:
+            image, digest = executor.image_cache.get(source)
+        except (OSError, zipfile.BadZipFile, ImageSourceError, sqlite3.Error) as e:
+            print(f"错误: 无法把镜像 {source.describe()} 加入镜像库 - {e}")
+            return False
+        executor.debug("镜像库: %s -> %s", source.describe(), image)
+        return _flash_file(executor, partition, image, digest, check_unchanged)
+    if not source.is_plain:
+        return _flash_source(executor, partition, source, check_unchanged)
+    return _flash_file(executor, partition, source.path, digest, check_unchanged, expected)
+
+def _flash_file(executor, partition: str, full_path, digest: Optional[str], check_unchanged: bool,
+                expected: Optional[str] = None) -> bool:
+    """刷写未压缩的镜像文件，成功后记录镜像哈希，供增量刷写比较"""
+    manifest = _device_manifest(executor, check_unchanged)
+    size = full_path.stat().st_size
+    if check_unchanged and manifest is not None:
+        digest = digest or get_hash_cache(executor.state_dir).sha256(full_path)
+        if manifest.matches(partition, digest, size):
+            print(f"跳过分区 {partition}: 镜像未变化 ({digest[:12]})")
+            return True
+    if expected is not None:
+        # 通过fastboot协议发送，哈希在发送时计算，不一致时不会写入分区
+        from commands.fastboot_protocol import run_native_flash
         
-    return executor.run_fastboot_command(['flash', partition, str(full_path)])
+        ok, output = run_native_flash(executor.serial, partition, full_path, expected,
+                                      executor._timeout_for('fastboot'), executor.checkpoint())
+        if not ok:
+            print(f"失败: {output.strip()}")
+        digest = expected
+    else:
+        ok = executor.run_fastboot_command(['flash', partition, str(full_path)])
+    if manifest is None:
+        return ok
+    if not ok:
+        manifest.forget(partition)
+        return False
+    digest = digest or get_hash_cache(executor.state_dir).sha256(full_path)
+    manifest.record(partition, full_path, digest, size)
+    return True
+
+def _flash_source(executor, partition: str, source: ImageSource, check_unchanged: bool) -> bool:
+    """刷写压缩/打包的镜像，tcp:目标边解压边发送，其他情况解压到临时文件，只解压一遍"""
+    manifest = _device_manifest(executor, check_unchanged)
+    cache = get_hash_cache(executor.state_dir)
+    
+    def unchanged(size: int, digest: Optional[str]) -> bool:
+        if digest and manifest.matches(partition, digest, size):
+            print(f"跳过分区 {partition}: 镜像未变化 ({digest[:12]})")
+            return True
+        return False
+    check = unchanged if check_unchanged and manifest is not None else None
+    
+    try:
+        known = cached_content(source, cache)
+        if check is not None and known is not None and check(*known):
+            return True
+        result = None
+        if executor.serial and executor.serial.startswith('tcp:'):
+            result = _stream_source(executor, partition, source, cache, check)
+        if result is None:
+            result = _extract_source(executor, partition, source, cache, check)
+    except (OSError, zipfile.BadZipFile, ImageSourceError) as e:
+        print(f"错误: 读取镜像 {source.describe()} 失败 - {e}")
+        result = (False, 0, None)
+    ok, size, digest = result
+    if not ok:
+        if manifest is not None:
+            manifest.forget(partition)
+        return False
+    if digest and manifest is not None:
+        manifest.record(partition, source.path, digest, size)
+    return True
+
+def _stream_source(executor, partition: str, source: ImageSource, cache,
+                   check) -> Optional[Tuple[bool, int, Optional[str]]]:
+    """
+    通过fastboot协议边解压边发送，返回 (是否成功, 大小, 需要记录的SHA-256)；
+    sparse镜像超过max-download-size时返回None，由调用方解压到临时文件
+    协议需要预先知道大小：不能直接得到大小或需要比较刷写记录时先完整解压一遍（结果会缓存）
+    """
+    from commands.fastboot_protocol import run_native_stream
+    
+    size, digest = probe(source, cache, need_hash=check is not None)
+    if check is not None and check(size, digest):
+        return True, size, None
+    print(f"从 {source.describe()} 刷写分区 {partition} ({size / 1024 / 1024:.1f} MB)")
+    with PipelineReader(source.open()) as reader:
+        result = run_native_stream(executor.serial, partition, reader, size, executor._timeout_for('fastboot'))
+        if result is not None:
+            ok, output = result
+            if not ok:
+                print(f"失败: {output.strip()}")
+                return False, size, None
+            # 数据实际长度与预期不同时不记录哈希
+            if reader.peek(1) != b'' or reader.bytes_read != size:
+                return True, size, None
+            digest = reader.hexdigest()
+            remember(source, cache, size, digest)
+            return True, size, digest
+    executor.debug("sparse镜像超过max-download-size，解压到临时文件后刷写")
+    return None
+
+def _extract_source(executor, partition: str, source: ImageSource, cache,
+                    check) -> Tuple[bool, int, Optional[str]]:
+    """
+    fastboot程序只能读取文件：解压到临时文件，同时计算大小和哈希，
+    再比较刷写记录，刷写后删除临时文件；返回 (是否成功, 大小, 需要记录的SHA-256)
+    """
+    print(f"从 {source.describe()} 刷写分区 {partition}（解压到临时文件）")
+    with extracted(source, executor.state_dir / "tmp") as (path, digest):
+        size = path.stat().st_size
+        remember(source, cache, size, digest)
+        if check is not None and check(size, digest):
+            return True, size, None
+        return executor.run_fastboot_command(['flash', partition, str(path)]), size, digest
 
 def flash_all(executor, directory: str = ".") -> bool:
-    """刷写指定目录下的所有镜像"""
+    """刷写指定目录（或zip）中的所有镜像"""
     flash_dir = executor.script_dir / directory
     success = True
     
@@ -22,13 +176,104 @@ def flash_all(executor, directory: str = ".") -> bool:
         'vbmeta': ['vbmeta.img', 'vbmeta_a.img'],
     }
     
+    images = []
     for partition, possible_files in partition_files.items():
-        for filename in possible_files:
-            file_path = flash_dir / filename
-            if file_path.exists():
-                print(f"找到分区 {partition} 的镜像: {filename}")
-                if not flash_partition(executor, partition, str(file_path.relative_to(executor.script_dir))):
-                    success = False
-                break
-    
-    return success
\ No newline at end of file
+        try:
+            found = find_image(flash_dir, possible_files)
+        except (OSError, zipfile.BadZipFile) as e:
+            print(f"错误: 无法读取 {flash_dir} - {e}")
+            return False
+        if found:
+            if found.startswith(ARCHIVE_SEP):
+                spec = directory + found
+            else:
+                spec = str((flash_dir / found).relative_to(executor.script_dir))
+            images.append((partition, found.lstrip(ARCHIVE_SEP), spec))
+    
+    checked = {}
+    if executor.verify_manifest is not None:
+        checked = _preflight(executor, flash_dir, images)
+        if checked is None:
+            print("错误: 镜像校验未通过，未写入任何分区")
+            return False
+    
+    if executor.image_cache is not None and images:
+        # 刷写前并行把所有镜像哈希/导入镜像库；无法读取的镜像不预取，刷写该分区时报告错误
+        sources = []
+        for partition, _, spec in images:
+            try:
+                source = resolve_image(executor.script_dir, spec, partition)
+            except (OSError, zipfile.BadZipFile) as e:
+                executor.debug("不预取镜像 %s - %s", spec, e)
+                continue
+            if source is not None:
+                sources.append(source)
+        executor.image_cache.prefetch(sources)
+    
+    for partition, name, spec in images:
+        print(f"找到分区 {partition} 的镜像: {name}")
+        if partition in checked:
+            source = _resolve(executor, partition, spec)
+            expected, digest = checked[partition]
+            ok = source is not None and _flash(executor, partition, source, executor.incremental, expected, digest)
+        else:
+            ok = flash_partition(executor, partition, spec)
+        if not ok:
+            success = False
+    
+    return success
+
+def _preflight(executor, flash_dir, images) -> Optional[Dict[str, Tuple[Optional[str], Optional[str]]]]:
+    """
+    --verify：刷写前并行校验所有镜像的大小、AVB和SHA-256
+    返回 分区 -> (需要在发送时校验的哈希, 已校验的哈希)；未通过时返回None
+    通过fastboot协议整体发送的镜像不在这里读取，哈希在发送时计算；压缩镜像按解压后的数据校验，
+    清单中优先查找解压后的文件名（boot.img.xz -> boot.img）
+    """
+    from commands.verify import MANIFEST_NAMES, find_checksums, load_checksums, lookup, print_report, verify_images
+    
+    if flash_dir.is_file():
+        print("错误: --verify 只支持目录中的镜像")
+        return None
+    if executor.verify_manifest == 'auto':
+        manifest_path = find_checksums(flash_dir)
+        if manifest_path is None:
+            print(f"错误: {flash_dir} 中没有校验清单（{', '.join(MANIFEST_NAMES)}）")
+            return None
+    else:
+        manifest_path = executor.script_dir / executor.verify_manifest
+    try:
+        entries = load_checksums(manifest_path)
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取校验清单 {manifest_path} - {e}")
+        return None
+    
+    native = bool(executor.serial and executor.serial.startswith('tcp:')) and executor.image_cache is None
+    limit = 0
+    if native:
+        from commands.fastboot_protocol import query_download_limit
+        
+        limit = query_download_limit(executor.serial)
+    items = []
+    for partition, name, spec in images:
+        path = executor.script_dir / spec
+        codec = codec_for(name)
+        if codec is not None:
+            raw_name = name[:-len(Path(name).suffix)]
+            expected = lookup(entries, raw_name) or lookup(entries, name)
+            items.append((name, path, expected, True, ImageSource(path, None, codec)))
+            continue
+        in_flight = native and (not limit or path.stat().st_size <= limit)
+        items.append((name, path, lookup(entries, name), not in_flight))
+    
+    print(f"校验镜像（清单: {manifest_path}）")
+    results = verify_images(items)
+    if not print_report(results):
+        return None
+    checked = {}
+    for (partition, _, _), (_, _, expected, hashed, *_), result in zip(images, items, results):
+        if hashed:
+            checked[partition] = (None, result.sha256)
+        else:
+            checked[partition] = (expected.sha256 if expected else None, None)
+    return checked
@@ -0,0 +1,100 @@
+"""
+多设备并行执行（fleet模式）
+每个序列号拥有独立的执行器上下文，在有界线程池中运行同一个脚本
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from commands.console import install_router
+from commands.device_state import list_devices
+
+
+@dataclass
+class DeviceResult:
+    """单台设备的执行结果"""
+    serial: str
+    success: bool
+    duration: float
+    log_file: Path
+    error: str = ""
+
+
+def discover_devices(executor) -> List[str]:
+    """
+    枚举adb和fastboot下所有已连接设备的序列号：adb只取device状态，fastboot只取fastboot状态，
+    跳过unauthorized/offline等无法执行命令的设备
+    """
+    serials = []
+    for tool, state in (('adb', 'device'), ('fastboot', 'fastboot')):
+        for serial, _ in list_devices(executor, tool, state, timeout=30):
+            if serial not in serials:
+                serials.append(serial)
+    return serials
+
+
+def resolve_serials(executor, devices_arg: str) -> List[str]:
+    """解析 --devices 参数：all 或 逗号分隔的序列号列表"""
+    if devices_arg.strip().lower() == 'all':
+        return discover_devices(executor)
+    serials = []
+    for serial in devices_arg.split(','):
+        serial = serial.strip()
+        if serial and serial not in serials:
+            serials.append(serial)
+    return serials
+
+
+def _run_one(factory: Callable, serial: str, log_dir: Path) -> DeviceResult:
+    """在当前线程中为单台设备执行脚本，输出写入该设备的日志文件"""
+    router = install_router()
+    log_file = log_dir / f"{serial.replace(':', '_')}.log"
+    start = time.monotonic()
+    error = ""
+    with open(log_file, 'w', encoding='utf-8') as log:
+        router.bind(log)
+        try:
+            executor = factory(serial)
+            success = executor.execute_script()
+        except Exception as e:
+            print(f"错误: 设备 {serial} 执行时发生异常 - {e}")
+            success = False
+            error = str(e)
+        finally:
+            router.unbind()
+    return DeviceResult(serial, success, time.monotonic() - start, log_file, error)
+
+
+def run_fleet(factory: Callable, serials: List[str], jobs: int, log_dir: Path) -> List[DeviceResult]:
+    """在有界线程池中对多台设备并行执行脚本"""
+    log_dir.mkdir(parents=True, exist_ok=True)
+    install_router()
+    workers = max(1, min(jobs, len(serials)))
+    print(f"并行设备数: {len(serials)}，工作线程: {workers}，日志目录: {log_dir}")
+
+    results: List[Optional[DeviceResult]] = [None] * len(serials)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='afc-device') as pool:
+        futures = {pool.submit(_run_one, factory, serial, log_dir): i for i, serial in enumerate(serials)}
+        for future in as_completed(futures):
+            index = futures[future]
+            result = future.result()
+            results[index] = result
+            mark = '✓' if result.success else '✗'
+            print(f"{mark} {result.serial} 完成，用时 {result.duration:.1f}s")
+    return results
+
+
+def print_summary(results: List[DeviceResult]) -> None:
+    """打印汇总表"""
+    width = max([len("序列号")] + [len(r.serial) for r in results])
+    print(f"\n{'=' * 50}")
+    print(f"{'序列号'.ljust(width)}  结果  用时(s)  日志")
+    for r in results:
+        status = '成功' if r.success else '失败'
+        print(f"{r.serial.ljust(width)}  {status}  {r.duration:7.1f}  {r.log_file}")
+    ok = sum(1 for r in results if r.success)
+    print(f"{'=' * 50}")
+    print(f"共 {len(results)} 台设备，成功 {ok} 台，失败 {len(results) - ok} 台")
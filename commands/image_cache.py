@@ -0,0 +1,288 @@
+"""
+按内容寻址的本地镜像库
+同一个镜像（不论在哪个脚本目录、是否压缩在zip里）只哈希、解压、保存一次，多个脚本和任务共用
+- 镜像按SHA-256存放在 <库目录>/<前两位>/<哈希>.img，导入时优先reflink，其次硬链接，都不行时复制
+- 索引为SQLite数据库：来源文件 (路径, 大小, mtime) -> 哈希，命中时只需stat()
+- 总大小超过上限时按最近使用时间淘汰
+- 哈希使用内存映射读取，多个镜像在线程池中并行计算（hashlib计算时释放GIL）
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+HASH_WINDOW = 64 * 1024 * 1024
+FICLONE = 0x40049409  # Linux ioctl: 在支持的文件系统(btrfs/xfs)上做写时复制克隆
+IN_USE_GRACE = 3600.0  # 本进程最近这段时间（秒）内用过的镜像可能仍在刷写，不会被淘汰
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def parse_size(text: str) -> int:
+    """解析 20G / 512M / 1048576 这样的大小"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def mmap_sha256(path: Path) -> str:
+    """通过内存映射分段计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for start in range(0, size, HASH_WINDOW):
+                    digest.update(view[start:start + HASH_WINDOW])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+def _reflink(src: Path, dst: Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return True
+    except OSError:
+        if dst.exists():
+            dst.unlink()
+        return False
+
+
+def import_file(src: Path, dst: Path) -> str:
+    """把文件放入库中，返回使用的方式：reflink / link / copy"""
+    if _reflink(src, dst):
+        return 'reflink'
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        shutil.copyfile(src, dst)
+        return 'copy'
+
+
+class ImageStore:
+    """镜像库，进程内多线程共享；多个进程可同时使用同一个库目录"""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.root / "index.db"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._in_use: Dict[str, float] = {}  # 本进程用过的镜像 -> 最近使用时间(time.monotonic)
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / f"{sha256}.img"
+
+    def lookup(self, key: str, st: os.stat_result) -> Optional[Tuple[Path, str]]:
+        """来源文件未变化且镜像仍完好时返回 (镜像路径, 哈希)"""
+        with self._lock:
+            row = self._db.execute("SELECT s.sha256, b.size, b.mtime_ns FROM sources s JOIN blobs b "
+                                   "ON s.sha256 = b.sha256 WHERE s.key = ? AND s.size = ? AND s.mtime_ns = ?",
+                                   (key, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        sha256, size, mtime_ns = row
+        blob = self.blob_path(sha256)
+        try:
+            blob_st = blob.stat()
+        except OSError:
+            blob_st = None
+        if blob_st is None or blob_st.st_size != size or blob_st.st_mtime_ns != mtime_ns:
+            # 镜像被删除，或硬链接的源文件被原地修改
+            self._drop(sha256)
+            return None
+        self._touch(sha256)
+        return blob, sha256
+
+    def add_file(self, path: Path) -> Tuple[Path, str]:
+        """把未压缩的镜像文件加入库，返回 (镜像路径, 哈希)"""
+        path = Path(path).resolve()
+        st = path.stat()
+        found = self.lookup(str(path), st)
+        if found:
+            return found
+        sha256 = mmap_sha256(path)
+        blob = self.blob_path(sha256)
+        if not self._blob_valid(sha256):
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(f"{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            import_file(path, tmp)
+            os.replace(tmp, blob)
+        self._register(str(path), st, sha256, blob)
+        return blob, sha256
+
+    def add_source(self, source) -> Tuple[Path, str]:
+        """把压缩/zip中的镜像（image_source.ImageSource）解压进库，返回 (镜像路径, 哈希)"""
+        from commands.image_source import READ_SIZE, PipelineReader
+
+        st = source.path.stat()
+        found = self.lookup(source.key, st)
+        if found:
+            return found
+        tmp = self.incoming_path()
+        try:
+            with PipelineReader(source.open()) as reader, open(tmp, 'wb') as out:
+                while True:
+                    data = reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    out.write(data)
+                sha256 = reader.hexdigest()
+            return self.add_extracted(source.key, st, tmp, sha256), sha256
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def incoming_path(self, tag: str = "") -> Path:
+        """库目录中的临时文件路径，解压到这里再用add_extracted移入库（同一文件系统，只需改名）"""
+        return self.root / f"incoming.{os.getpid()}.{threading.get_ident()}{tag}.tmp"
+
+    def add_extracted(self, key: str, st: os.stat_result, path: Path, sha256: str) -> Path:
+        """把解压好的镜像移入库，记录来源 (key, 来源文件的stat)，返回镜像路径"""
+        blob = self.blob_path(sha256)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, blob)
+        self._register(key, st, sha256, blob)
+        return blob
+
+    def find(self, sha256: str) -> Optional[Path]:
+        """按哈希查找库中完好的镜像，找到时标记为最近使用"""
+        if not self._blob_valid(sha256):
+            return None
+        self._touch(sha256)
+        return self.blob_path(sha256)
+
+    def get(self, source) -> Tuple[Path, str]:
+        """ImageSource -> 库中的 (镜像路径, 哈希)"""
+        if source.is_plain:
+            return self.add_file(source.path)
+        return self.add_source(source)
+
+    def prefetch(self, sources: Iterable, workers: int = 4) -> Dict[str, object]:
+        """并行导入多个镜像（FLASH_ALL刷写前），返回 key -> (路径, 哈希) 或异常"""
+        sources = list(sources)
+        results: Dict[str, object] = {}
+        if not sources:
+            return results
+
+        def run(source):
+            try:
+                return source.key, self.get(source)
+            except Exception as e:
+                return source.key, e
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(sources)))) as pool:
+            for key, result in pool.map(run, sources):
+                results[key] = result
+        return results
+
+    def _blob_valid(self, sha256: str) -> bool:
+        """库中的镜像存在且与索引记录一致"""
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+        try:
+            st = self.blob_path(sha256).stat()
+        except OSError:
+            return False
+        if row is None or (st.st_size, st.st_mtime_ns) != tuple(row):
+            self._drop(sha256)
+            return False
+        return True
+
+    def _register(self, key: str, st: os.stat_result, sha256: str, blob: Path) -> None:
+        blob_st = blob.stat()
+        with self._lock:
+            self._in_use[sha256] = time.monotonic()
+            with self._db:
+                self._db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)",
+                                 (sha256, blob_st.st_size, blob_st.st_mtime_ns, time.time()))
+                self._db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                                 (key, st.st_size, st.st_mtime_ns, sha256))
+        self.evict()
+
+    def _touch(self, sha256: str) -> None:
+        with self._lock:
+            self._in_use[sha256] = time.monotonic()
+            with self._db:
+                self._db.execute("UPDATE blobs SET last_used = ? WHERE sha256 = ?", (time.time(), sha256))
+
+    def _drop(self, sha256: str) -> None:
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM sources WHERE sha256 = ?", (sha256,))
+                self._db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+        try:
+            self.blob_path(sha256).unlink()
+        except OSError:
+            pass
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self) -> List[str]:
+        """按最近使用时间淘汰，直到总大小不超过上限；返回被淘汰的哈希"""
+        with self._lock:
+            rows = self._db.execute("SELECT sha256, size FROM blobs ORDER BY last_used").fetchall()
+            # 常驻服务中进程一直运行，只保护最近用过的镜像，否则库的大小上限永远不会生效
+            now = time.monotonic()
+            self._in_use = {sha256: used for sha256, used in self._in_use.items() if now - used < IN_USE_GRACE}
+            in_use = set(self._in_use)
+        total = sum(size for _, size in rows)
+        evicted = []
+        for sha256, size in rows:
+            if total <= self.max_bytes:
+                break
+            if sha256 in in_use:
+                continue
+            self._drop(sha256)
+            total -= size
+            evicted.append(sha256)
+        return evicted
+
+
+_stores: Dict[Path, ImageStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_image_store(root: Path, max_bytes: int) -> ImageStore:
+    """同一个库目录在进程内共享一个实例"""
+    root = Path(root)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = ImageStore(root, max_bytes)
+        _stores[root].max_bytes = max_bytes
+        return _stores[root]
@@ -0,0 +1,360 @@
+"""
+压缩/打包的镜像来源
+FLASH和FLASH_ALL可以直接使用 *.img.gz / *.img.xz / *.img.bz2 / *.img.zst 以及zip中的镜像
+（写作 rom.zip!boot.img，或 FLASH(boot, rom.zip) 时自动查找boot.img），不需要先解压到磁盘
+- 后台线程解压到有界队列，内存占用固定：tcp:目标解压与发送同时进行；
+  fastboot程序只能读文件，解压到临时文件一遍，同时计算大小和哈希
+- 解压后的大小和SHA-256按压缩文件的 (路径, 大小, mtime) 缓存，供下载和增量刷写使用
+- .zst需要安装可选依赖 zstandard
+"""
+
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import queue
+import struct
+import threading
+import zipfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # 只有.zst镜像需要
+    zstandard = None
+
+CODECS = {'.gz': 'gzip', '.xz': 'xz', '.bz2': 'bz2', '.zst': 'zstd'}
+ARCHIVE_SEP = '!'
+READ_SIZE = 1024 * 1024
+QUEUE_DEPTH = 16  # 解压线程最多领先发送方的数据块数
+
+
+class ImageSourceError(Exception):
+    """镜像来源无法读取"""
+
+
+def codec_for(name: str) -> Optional[str]:
+    return CODECS.get(os.path.splitext(name)[1].lower())
+
+
+@dataclass
+class ImageSource:
+    """一个镜像：磁盘文件，可能是压缩文件或zip中的成员"""
+    path: Path
+    member: Optional[str] = None
+    codec: Optional[str] = None
+
+    @property
+    def is_plain(self) -> bool:
+        """是否为可直接使用的未压缩文件"""
+        return self.member is None and self.codec is None
+
+    @property
+    def key(self) -> str:
+        key = str(self.path.resolve())
+        return f"{key}{ARCHIVE_SEP}{self.member}" if self.member else key
+
+    def describe(self) -> str:
+        return f"{self.path.name}{ARCHIVE_SEP}{self.member}" if self.member else self.path.name
+
+    def _open_container(self) -> BinaryIO:
+        if self.member is None:
+            return open(self.path, 'rb')
+        archive = zipfile.ZipFile(self.path)
+        try:
+            return archive.open(self.member)
+        except KeyError:
+            archive.close()
+            raise ImageSourceError(f"{self.path.name} 中没有 {self.member}")
+
+    def open(self) -> BinaryIO:
+        """打开解压后的数据流（只能顺序读取）"""
+        raw = self._open_container()
+        if self.codec is None:
+            return raw
+        if self.codec == 'gzip':
+            return gzip.GzipFile(fileobj=raw, mode='rb')
+        if self.codec == 'xz':
+            return lzma.LZMAFile(raw)
+        if self.codec == 'bz2':
+            return bz2.BZ2File(raw)
+        if zstandard is None:
+            raw.close()
+            raise ImageSourceError("读取.zst镜像需要安装zstandard: pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+
+    def known_size(self) -> Optional[int]:
+        """不解压即可得到的数据大小，无法得知时返回None"""
+        if self.member is not None and self.codec is None:
+            with zipfile.ZipFile(self.path) as archive:
+                return archive.getinfo(self.member).file_size
+        if self.codec is None:
+            return self.path.stat().st_size
+        if self.codec == 'xz':
+            with self._open_container() as f:
+                return _xz_size(f)
+        if self.codec == 'zstd' and zstandard is not None:
+            with self._open_container() as f:
+                size = zstandard.frame_content_size(f.read(18))
+            return size if size >= 0 else None
+        return None
+
+
+def _xz_size(f: BinaryIO) -> Optional[int]:
+    """
+    从xz文件末尾的索引读取解压后大小，失败时返回None
+    多个stream拼接的文件（如按块并行压缩的备份）从后往前依次读取每个stream的索引
+    """
+    try:
+        end = f.seek(0, os.SEEK_END)
+    except (OSError, ValueError):
+        return None
+    total = 0
+    while end > 0:
+        try:
+            f.seek(end - 4)
+            if f.read(4) == b'\0\0\0\0':
+                end -= 4  # stream padding
+                continue
+            f.seek(end - 12)
+            footer = f.read(12)
+            if footer[10:12] != b'YZ':
+                return None
+            backward_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            f.seek(end - 12 - backward_size)
+            index = f.read(backward_size)
+        except (OSError, ValueError):
+            return None
+        if not index or index[0] != 0:
+            return None
+        try:
+            uncompressed, blocks = _xz_index(index)
+        except IndexError:
+            return None
+        total += uncompressed
+        # 上一个stream结束于本stream的头(12字节)之前
+        end -= 12 + backward_size + blocks + 12
+    return total if end == 0 else None
+
+
+def _xz_index(index: bytes) -> Tuple[int, int]:
+    """解析xz索引，返回 (解压后大小, 所有block占用的字节数)"""
+    pos = 1
+
+    def varint() -> int:
+        nonlocal pos
+        value = shift = 0
+        while True:
+            byte = index[pos]
+            pos += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+    records = varint()
+    total = blocks = 0
+    for _ in range(records):
+        blocks += (varint() + 3) // 4 * 4  # unpadded size，block按4字节对齐
+        total += varint()
+    return total, blocks
+
+
+def resolve_image(base_dir: Path, spec: str, partition: Optional[str] = None) -> Optional[ImageSource]:
+    """
+    解析FLASH的镜像参数，文件不存在时返回None
+    支持 boot.img / boot.img.xz / rom.zip!boot.img / rom.zip（按分区名查找其中的镜像）
+    """
+    member = None
+    if ARCHIVE_SEP in spec:
+        spec, member = spec.split(ARCHIVE_SEP, 1)
+    path = Path(base_dir) / spec
+    if not path.is_file():
+        return None
+    if member is None and path.suffix.lower() == '.zip' and partition:
+        member = find_in_zip(path, [f"{partition}.img"])
+        if member is None:
+            return None
+    if member is not None:
+        with zipfile.ZipFile(path) as archive:
+            if member not in archive.namelist():
+                return None
+        return ImageSource(path, member, codec_for(member))
+    return ImageSource(path, None, codec_for(path.name))
+
+
+def _candidates(filenames: List[str]) -> List[str]:
+    return [name + suffix for name in filenames for suffix in [''] + list(CODECS)]
+
+
+def find_in_zip(path: Path, filenames: List[str]) -> Optional[str]:
+    """在zip中查找镜像（任意目录层级，可带压缩后缀）"""
+    with zipfile.ZipFile(path) as archive:
+        members = {}
+        for name in archive.namelist():
+            members.setdefault(name.rsplit('/', 1)[-1], name)
+    for candidate in _candidates(filenames):
+        if candidate in members:
+            return members[candidate]
+    return None
+
+
+def find_image(container: Path, filenames: List[str]) -> Optional[str]:
+    """
+    在目录或zip中查找第一个存在的镜像，返回相对于container的FLASH参数写法
+    如 'boot.img.xz' 或 '!boot.img'（zip时）
+    """
+    if container.is_file() and zipfile.is_zipfile(container):
+        member = find_in_zip(container, filenames)
+        return ARCHIVE_SEP + member if member else None
+    for candidate in _candidates(filenames):
+        if (container / candidate).is_file():
+            return candidate
+    return None
+
+
+class PipelineReader:
+    """在后台线程中读取（解压）数据，通过有界队列交给调用方；可同时计算SHA-256"""
+
+    def __init__(self, stream: BinaryIO, depth: int = QUEUE_DEPTH, chunk_size: int = READ_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._queue: "queue.Queue" = queue.Queue(maxsize=depth)
+        self._buffer = b''
+        self._eof = False
+        self._stop = threading.Event()
+        self._digest = hashlib.sha256()
+        self.bytes_read = 0
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self) -> None:
+        try:
+            while not self._stop.is_set():
+                data = self._stream.read(self._chunk_size)
+                if not data:
+                    break
+                self._digest.update(data)
+                self._put(data)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> None:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _next(self) -> bool:
+        if self._eof:
+            return False
+        item = self._queue.get()
+        if item is None:
+            self._eof = True
+            return False
+        if isinstance(item, Exception):
+            self._eof = True
+            raise ImageSourceError(f"读取镜像失败 - {item}")
+        self._buffer = item
+        return True
+
+    def peek(self, size: int) -> bytes:
+        while len(self._buffer) < size and not self._eof:
+            rest = self._buffer
+            if not self._next():
+                self._buffer = rest
+                break
+            self._buffer = rest + self._buffer
+        return self._buffer[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        """返回不超过size字节的数据（可能少于size），读完时返回空串"""
+        if not self._buffer and not self._next():
+            return b''
+        if size < 0 or size >= len(self._buffer):
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self) -> str:
+        """全部数据读完后的SHA-256"""
+        self._thread.join()
+        return self._digest.hexdigest()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5)
+        self._stream.close()
+
+    def __enter__(self) -> 'PipelineReader':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def cached_content(source: ImageSource, cache) -> Optional[Tuple[int, Optional[str]]]:
+    """之前完整读取过时缓存的解压后 (大小, SHA-256)，不解压；没有缓存时返回None"""
+    entry = cache.lookup(source.key, source.path.stat())
+    if entry and 'content_size' in entry:
+        return entry['content_size'], entry.get('sha256')
+    return None
+
+
+def probe(source: ImageSource, cache, need_hash: bool = False) -> Tuple[int, Optional[str]]:
+    """
+    返回解压后的 (大小, SHA-256)；大小无法直接得到或需要哈希时完整解压一遍，结果按压缩文件缓存
+    cache 为 manifest.HashCache
+    """
+    st = source.path.stat()
+    known = cached_content(source, cache)
+    if known is not None:
+        return known
+    size = source.known_size()
+    if size is not None and not need_hash:
+        return size, None
+    with PipelineReader(source.open()) as reader:
+        size = 0
+        while True:
+            data = reader.read(READ_SIZE)
+            if not data:
+                break
+            size += len(data)
+        digest = reader.hexdigest()
+    cache.store(source.key, st, content_size=size, sha256=digest)
+    return size, digest
+
+
+def remember(source: ImageSource, cache, size: int, digest: str) -> None:
+    """完整读取过一次数据后记录大小和哈希"""
+    cache.store(source.key, source.path.stat(), content_size=size, sha256=digest)
+
+
+@contextmanager
+def extracted(source: ImageSource, scratch_dir: Path) -> Iterator[Tuple[Path, str]]:
+    """解压到临时文件（fastboot程序只能读文件），退出时删除；产出 (路径, SHA-256)"""
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    name = os.path.basename(source.member or source.path.name)
+    if source.codec:
+        name = os.path.splitext(name)[0]
+    tmp = scratch_dir / f"{os.getpid()}.{threading.get_ident()}.{name}"
+    try:
+        with PipelineReader(source.open()) as reader, open(tmp, 'wb') as out:
+            while True:
+                data = reader.read(READ_SIZE)
+                if not data:
+                    break
+                out.write(data)
+            digest = reader.hexdigest()
+        yield tmp, digest
+    finally:
+        if tmp.exists():
+            tmp.unlink()
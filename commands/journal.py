@@ -0,0 +1,134 @@
+"""
+脚本执行日志（断点续刷）
+每次执行脚本时按 (脚本哈希, 设备序列号) 追加写入 .afc/journal/<哈希>-<序列号>.jsonl：
+- 每个成功完成的步骤及完成后的变量
+- 网络fastboot拆分sparse分片刷写时，每个已被设备确认写入的分片
+- 执行结束及结果；全部成功时删除记录文件，只保留需要恢复的记录
+每条记录写入后立即flush，进程崩溃最多丢失正在写的一行（读取时忽略）；操作设备的步骤和分片记录还会fsync，
+断电时不会丢失，只在本机执行的步骤（PRINT、WAIT、变量赋值等）不fsync，断电后最多重新执行这些步骤
+--resume 时跳过已完成的步骤、恢复变量，从第一个未完成的步骤继续；该步骤是分片刷写时从最后确认的分片之后继续
+"""
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+
+@dataclass
+class JournalState:
+    """读取到的上一次执行记录"""
+    started: bool = False
+    finished: Optional[bool] = None  # None表示未正常结束
+    done: Dict[int, Dict[str, str]] = field(default_factory=dict)  # 行号 -> 完成后的变量
+    pieces: Dict[Tuple[int, str, str], int] = field(default_factory=dict)  # (行号, 分区, 镜像) -> 已确认的分片数
+
+    def resume_point(self, steps) -> Tuple[int, Dict[str, str]]:
+        """第一个未完成步骤的下标，以及此前最后一个完成步骤记录的变量"""
+        variables: Dict[str, str] = {}
+        for index, step in enumerate(steps):
+            if step.line_num not in self.done:
+                return index, variables
+            variables = self.done[step.line_num]
+        return len(steps), variables
+
+
+def journal_path(state_dir: Path, script_hash: str, serial: Optional[str]) -> Path:
+    """serial为设备的真实序列号，None只用于不操作设备的脚本（或无法确定设备时，此时不会用于恢复）"""
+    device = (serial or 'default').replace(':', '_').replace('/', '_')
+    return Path(state_dir) / "journal" / f"{script_hash[:16]}-{device}.jsonl"
+
+
+def read_journal(path: Path) -> JournalState:
+    """解析执行记录，文件不存在时返回空记录"""
+    state = JournalState()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return state
+    for text in lines:
+        try:
+            record = json.loads(text)
+        except ValueError:
+            continue  # 崩溃时未写完的一行
+        event = record.get('event')
+        if event == 'start':
+            state.started = True
+        elif event == 'step':
+            state.done[record['line']] = record.get('vars', {})
+        elif event == 'piece':
+            key = (record['line'], record['partition'], record['image'])
+            state.pieces[key] = max(state.pieces.get(key, 0), record['index'])
+        elif event == 'finish':
+            state.finished = record.get('ok', False)
+    return state
+
+
+class Journal:
+    """追加写入的执行记录，多个线程（并行分支）可同时写入"""
+
+    def __init__(self, path: Path, resume_from: Optional[JournalState] = None, resume_line: Optional[int] = None):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._resume_pieces = resume_from.pieces if resume_from else {}
+        self._resume_line = resume_line
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 不是恢复执行时重新开始记录
+        self._file = open(self.path, 'a' if resume_from else 'w', encoding='utf-8')
+
+    def _write(self, record: dict, sync: bool = False) -> None:
+        record['time'] = round(time.time(), 3)
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def start(self, script: Path, resumed: bool) -> None:
+        self._write({'event': 'start', 'script': str(script), 'resumed': resumed})
+
+    def step_done(self, line_num: int, variables: Dict[str, str], sync: bool = True) -> None:
+        """sync为False用于只在本机执行的步骤，断电后重新执行没有影响"""
+        self._write({'event': 'step', 'line': line_num, 'vars': dict(variables)}, sync)
+
+    def finish(self, ok: bool) -> None:
+        """全部成功时删除记录（没有需要恢复的步骤），否则保留供 --resume 使用"""
+        self._write({'event': 'finish', 'ok': ok})
+        with self._lock:
+            self._file.close()
+        if ok:
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def checkpoint(self, line_num: Optional[int]) -> Optional['TransferCheckpoint']:
+        return TransferCheckpoint(self, line_num) if line_num is not None else None
+
+
+class TransferCheckpoint:
+    """一次分片刷写的进度记录，传给 fastboot_protocol.FastbootClient.flash_file"""
+
+    def __init__(self, journal: Journal, line_num: int):
+        self._journal = journal
+        self._line = line_num
+        self._partition = ""
+        self._image = ""
+
+    def start(self, partition: str, image: str, total: int) -> int:
+        """开始刷写，返回可以跳过的已确认分片数（只在恢复执行的那一步有效）"""
+        self._partition, self._image = partition, image
+        if self._line != self._journal._resume_line:
+            return 0
+        return min(self._journal._resume_pieces.get((self._line, partition, image), 0), total)
+
+    def piece_done(self, index: int, total: int) -> None:
+        self._journal._write({'event': 'piece', 'line': self._line, 'partition': self._partition,
+                              'image': self._image, 'index': index, 'total': total}, sync=True)
@@ -0,0 +1,140 @@
+"""
+刷写记录与镜像哈希缓存
+- 每个设备序列号一份记录：分区名、镜像SHA-256、大小、刷写时间
+- 镜像哈希按 (路径, 大小, mtime) 缓存，文件未变化时不重新计算
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+HASH_BUFFER = 4 * 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    """流式计算文件的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        buf = bytearray(HASH_BUFFER)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def _load_json(path: Path) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_json(path: Path, data: dict) -> None:
+    """先写临时文件再替换，避免中途退出留下损坏的记录"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class HashCache:
+    """(路径, 大小, mtime) -> SHA-256 的持久化缓存"""
+
+    def __init__(self, cache_file: Path):
+        self.cache_file = cache_file
+        self._entries: Dict[str, dict] = _load_json(cache_file)
+        self._lock = threading.Lock()
+
+    def sha256(self, path: Path) -> str:
+        path = Path(path).resolve()
+        st = path.stat()
+        entry = self.lookup(str(path), st)
+        if entry:
+            return entry['sha256']
+        digest = file_sha256(path)
+        self.store(str(path), st, sha256=digest)
+        return digest
+
+    def lookup(self, key: str, st: os.stat_result) -> Optional[dict]:
+        """返回与文件当前大小和mtime一致的缓存条目"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                return entry
+        return None
+
+    def store(self, key: str, st: os.stat_result, **values) -> None:
+        with self._lock:
+            self._entries[key] = dict(values, size=st.st_size, mtime_ns=st.st_mtime_ns)
+            _save_json(self.cache_file, self._entries)
+
+
+class DeviceManifest:
+    """单台设备的分区刷写记录"""
+
+    def __init__(self, manifest_file: Path):
+        self.manifest_file = manifest_file
+        self._lock = threading.Lock()
+        self.partitions: Dict[str, dict] = _load_json(manifest_file).get('partitions', {})
+
+    def matches(self, partition: str, sha256: str, size: int) -> bool:
+        entry = self.partitions.get(partition)
+        return bool(entry) and entry.get('sha256') == sha256 and entry.get('size') == size
+
+    def record(self, partition: str, image: Path, sha256: str, size: int) -> None:
+        with self._lock:
+            self.partitions[partition] = {
+                'sha256': sha256,
+                'size': size,
+                'image': str(Path(image).resolve()),
+                'flashed_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            }
+            _save_json(self.manifest_file, {'partitions': self.partitions})
+
+    def forget(self, partition: str) -> None:
+        """分区被擦除或刷写失败后作废记录"""
+        with self._lock:
+            if self.partitions.pop(partition, None) is not None:
+                _save_json(self.manifest_file, {'partitions': self.partitions})
+
+
+_hash_caches: Dict[Path, HashCache] = {}
+_manifests: Dict[Path, DeviceManifest] = {}
+_registry_lock = threading.Lock()
+
+
+def get_hash_cache(state_dir: Path) -> HashCache:
+    """同一状态目录在进程内共享一个哈希缓存"""
+    cache_file = Path(state_dir) / 'hash_cache.json'
+    with _registry_lock:
+        if cache_file not in _hash_caches:
+            _hash_caches[cache_file] = HashCache(cache_file)
+        return _hash_caches[cache_file]
+
+
+def get_device_manifest(state_dir: Path, serial: str) -> DeviceManifest:
+    """按序列号取得刷写记录"""
+    name = serial.replace(':', '_').replace('/', '_')
+    manifest_file = Path(state_dir) / 'manifests' / f"{name}.json"
+    with _registry_lock:
+        if manifest_file not in _manifests:
+            _manifests[manifest_file] = DeviceManifest(manifest_file)
+        return _manifests[manifest_file]
+
+
+def manifest_for(executor) -> Optional[DeviceManifest]:
+    """
+    当前设备的刷写记录；无法确定设备序列号（没有连接设备或连接了多台）时返回None，
+    此时不跳过任何分区，也不记录，避免把一台设备的记录用到下一台设备上
+    """
+    serial = executor.device_serial()
+    return get_device_manifest(executor.state_dir, serial) if serial else None
@@ -0,0 +1,467 @@
+"""
+OTA payload.bin 读取
+直接从OTA zip（或单独的payload.bin）中解出分区镜像并刷写，不需要先用外部工具把所有镜像解压到磁盘
+- 解析payload头和manifest（内置最小protobuf解码，不依赖protobuf库）
+- 支持全量包的 REPLACE / REPLACE_BZ / REPLACE_XZ / ZERO / DISCARD 操作，增量包操作会报错
+- 多个分区在进程池中并行解压，解出的镜像存放在按内容寻址的镜像库（commands/image_cache.py）中，同一镜像只解压一次；
+  指定了 --image-cache 时与FLASH共用该库，否则使用 .afc/payload_cache，总大小超过上限（默认20G，
+  环境变量AFC_PAYLOAD_CACHE可修改）时按最近使用时间淘汰
+- FLASH_PAYLOAD 按顺序刷写，前面的分区刷写时后面的分区仍在后台解压
+"""
+
+import bz2
+import hashlib
+import lzma
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+PAYLOAD_MAGIC = b'CrAU'
+PAYLOAD_MEMBER = 'payload.bin'
+READ_SIZE = 1024 * 1024
+DEFAULT_CACHE_SIZE = '20G'
+
+# InstallOperation.Type
+OP_REPLACE = 0
+OP_REPLACE_BZ = 1
+OP_ZERO = 6
+OP_DISCARD = 7
+OP_REPLACE_XZ = 8
+OP_NAMES = {0: 'REPLACE', 1: 'REPLACE_BZ', 2: 'MOVE', 3: 'BSDIFF', 4: 'SOURCE_COPY', 5: 'SOURCE_BSDIFF',
+            6: 'ZERO', 7: 'DISCARD', 8: 'REPLACE_XZ', 9: 'PUFFDIFF', 10: 'BROTLI_BSDIFF', 11: 'ZUCCHINI',
+            12: 'LZ4DIFF_BSDIFF', 13: 'LZ4DIFF_PUFFDIFF'}
+SUPPORTED_OPS = {OP_REPLACE, OP_REPLACE_BZ, OP_ZERO, OP_DISCARD, OP_REPLACE_XZ}
+
+
+class PayloadError(Exception):
+    """payload格式错误或包含不支持的操作"""
+
+
+# ---- 最小protobuf解码 ----
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise PayloadError("protobuf数据被截断")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def parse_message(data: bytes) -> Dict[int, list]:
+    """把protobuf消息解码为 字段号 -> 值列表（varint/定长为int，length-delimited为bytes）"""
+    fields: Dict[int, list] = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value = struct.unpack_from('<Q', data, pos)[0]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            value = bytes(data[pos:pos + length])
+            pos += length
+        elif wire_type == 5:
+            value = struct.unpack_from('<I', data, pos)[0]
+            pos += 4
+        else:
+            raise PayloadError(f"不支持的protobuf字段类型 {wire_type}")
+        fields.setdefault(number, []).append(value)
+    return fields
+
+
+def _first(fields: Dict[int, list], number: int, default=None):
+    values = fields.get(number)
+    return values[0] if values else default
+
+
+# ---- manifest结构 ----
+
+@dataclass
+class Operation:
+    """一个安装操作：把数据区的一段写入目标分区的若干extent"""
+    type: int
+    data_offset: int
+    data_length: int
+    dst_extents: List[Tuple[int, int]]  # (起始块, 块数)
+    data_sha256: bytes = b''
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'Operation':
+        fields = parse_message(data)
+        extents = []
+        for raw in fields.get(6, []):
+            extent = parse_message(raw)
+            extents.append((_first(extent, 1, 0), _first(extent, 2, 0)))
+        return cls(_first(fields, 1, 0), _first(fields, 2, 0), _first(fields, 3, 0),
+                   extents, _first(fields, 8, b''))
+
+
+@dataclass
+class PartitionUpdate:
+    """payload中的一个分区"""
+    name: str
+    size: int
+    sha256: str  # 分区镜像的SHA-256（十六进制），旧的payload可能为空
+    operations: List[Operation] = field(default_factory=list)
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'PartitionUpdate':
+        fields = parse_message(data)
+        info = parse_message(_first(fields, 7, b''))
+        return cls(_first(fields, 1, b'').decode('utf-8'), _first(info, 1, 0), _first(info, 2, b'').hex(),
+                   [Operation.parse(raw) for raw in fields.get(8, [])])
+
+    def unsupported_ops(self) -> List[str]:
+        return sorted({OP_NAMES.get(op.type, str(op.type)) for op in self.operations
+                       if op.type not in SUPPORTED_OPS})
+
+
+@dataclass
+class Payload:
+    """已解析的payload：数据区在 path（zip时为zip文件本身）中的 data_offset 处开始"""
+    path: Path
+    member: Optional[str]
+    member_offset: Optional[int]  # zip中未压缩存储的payload.bin在zip文件内的偏移
+    block_size: int
+    data_offset: int
+    partitions: Dict[str, PartitionUpdate]
+
+    def open_data(self) -> BinaryIO:
+        """打开payload内容；payload.bin在zip中未压缩时直接读zip文件，可任意seek"""
+        if self.member is None:
+            return open(self.path, 'rb')
+        if self.member_offset is not None:
+            return _OffsetFile(open(self.path, 'rb'), self.member_offset)
+        return zipfile.ZipFile(self.path).open(self.member)
+
+
+class _OffsetFile:
+    """把zip中未压缩成员当作独立文件读取"""
+
+    def __init__(self, f: BinaryIO, offset: int):
+        self._f = f
+        self._offset = offset
+        f.seek(offset)
+
+    def seek(self, pos: int) -> None:
+        self._f.seek(self._offset + pos)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._f.read(size)
+
+    def close(self) -> None:
+        self._f.close()
+
+    def __enter__(self) -> '_OffsetFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _stored_member_offset(path: Path, member: zipfile.ZipInfo) -> Optional[int]:
+    """未压缩存储的zip成员数据在zip文件中的偏移（OTA包中的payload.bin通常如此）"""
+    if member.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        f.seek(member.header_offset)
+        header = f.read(30)
+    if len(header) < 30 or header[:4] != b'PK\x03\x04':
+        return None
+    name_len, extra_len = struct.unpack('<HH', header[26:30])
+    return member.header_offset + 30 + name_len + extra_len
+
+
+def read_payload(path: Path) -> Payload:
+    """读取OTA zip或payload.bin的头部和manifest"""
+    path = Path(path)
+    member = None
+    member_offset = None
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            try:
+                info = zf.getinfo(PAYLOAD_MEMBER)
+            except KeyError:
+                raise PayloadError(f"zip中没有{PAYLOAD_MEMBER}")
+        member = info.filename
+        member_offset = _stored_member_offset(path, info)
+
+    payload = Payload(path, member, member_offset, 4096, 0, {})
+    with payload.open_data() as f:
+        header = f.read(24)
+        if len(header) < 24 or header[:4] != PAYLOAD_MAGIC:
+            raise PayloadError("不是有效的payload（缺少CrAU头）")
+        version, manifest_size = struct.unpack('>QQ', header[4:20])
+        if version != 2:
+            raise PayloadError(f"不支持的payload版本 {version}")
+        signature_size = struct.unpack('>I', header[20:24])[0]
+        manifest = f.read(manifest_size)
+        if len(manifest) != manifest_size:
+            raise PayloadError("payload manifest被截断")
+
+    fields = parse_message(manifest)
+    payload.block_size = _first(fields, 3, 4096)
+    payload.data_offset = 24 + manifest_size + signature_size
+    for raw in fields.get(13, []):
+        partition = PartitionUpdate.parse(raw)
+        payload.partitions[partition.name] = partition
+    return payload
+
+
+# ---- 解压（在子进程中执行） ----
+
+class _ExtentWriter:
+    """按顺序把解压出的数据写入一组extent"""
+
+    def __init__(self, f: BinaryIO, extents: List[Tuple[int, int]], block_size: int):
+        self._f = f
+        self._extents = [(start * block_size, count * block_size) for start, count in extents]
+        self._index = -1
+        self._left = 0
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            if not self._left:
+                self._index += 1
+                if self._index >= len(self._extents):
+                    raise PayloadError("操作数据超出目标extent")
+                offset, self._left = self._extents[self._index]
+                self._f.seek(offset)
+            n = min(self._left, len(view))
+            self._f.write(view[:n])
+            self._left -= n
+            view = view[n:]
+
+
+def _decompressor(op_type: int):
+    if op_type == OP_REPLACE_XZ:
+        return lzma.LZMADecompressor()
+    if op_type == OP_REPLACE_BZ:
+        return bz2.BZ2Decompressor()
+    return None
+
+
+def _apply_operation(src: BinaryIO, data_offset: int, op: Operation, out: BinaryIO, block_size: int) -> None:
+    if op.type in (OP_ZERO, OP_DISCARD):
+        # 输出文件预先截断到分区大小，未写入的区域读出即为零
+        return
+    src.seek(data_offset + op.data_offset)
+    writer = _ExtentWriter(out, op.dst_extents, block_size)
+    decompressor = _decompressor(op.type)
+    digest = hashlib.sha256() if op.data_sha256 else None
+    remaining = op.data_length
+    while remaining:
+        chunk = src.read(min(READ_SIZE, remaining))
+        if not chunk:
+            raise PayloadError("payload数据被截断")
+        remaining -= len(chunk)
+        if digest:
+            digest.update(chunk)
+        if decompressor is None:
+            writer.write(chunk)
+            continue
+        writer.write(decompressor.decompress(chunk, READ_SIZE))
+        # 限制单次输出大小，避免高压缩率数据一次性占用大量内存
+        while not decompressor.needs_input and not decompressor.eof:
+            writer.write(decompressor.decompress(b'', READ_SIZE))
+    if digest and digest.digest() != op.data_sha256:
+        raise PayloadError(f"操作数据校验失败 (偏移 {op.data_offset})")
+
+
+def extract_partition(payload: Payload, name: str, out_path: Path) -> str:
+    """把一个分区解压到out_path，返回镜像的SHA-256"""
+    from commands.manifest import file_sha256
+
+    partition = payload.partitions[name]
+    unsupported = partition.unsupported_ops()
+    if unsupported:
+        raise PayloadError(f"分区 {name} 包含增量操作 {', '.join(unsupported)}，只支持全量OTA")
+    tmp = out_path.with_name(f"{out_path.name}.{os.getpid()}.tmp")
+    try:
+        with payload.open_data() as src, open(tmp, 'wb') as out:
+            out.truncate(partition.size)
+            # 按数据偏移顺序读取，zip中压缩存储时也只需顺序读
+            for op in sorted(partition.operations, key=lambda o: o.data_offset):
+                _apply_operation(src, payload.data_offset, op, out, payload.block_size)
+        digest = file_sha256(tmp)
+        if partition.sha256 and digest != partition.sha256:
+            raise PayloadError(f"分区 {name} 校验失败: {digest[:12]} != {partition.sha256[:12]}")
+        os.replace(tmp, out_path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+    return digest
+
+
+def _extract_worker(payload: Payload, name: str, out_path: str) -> Tuple[str, float]:
+    start = time.monotonic()
+    digest = extract_partition(payload, name, Path(out_path))
+    return digest, time.monotonic() - start
+
+
+# ---- 进程池与缓存 ----
+
+_pool: Optional[ProcessPoolExecutor] = None
+_inflight: Dict[str, Future] = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        workers = int(os.environ.get('AFC_PAYLOAD_JOBS', 0)) or os.cpu_count() or 2
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+def payload_store(executor):
+    """解出的镜像所在的镜像库：--image-cache 的库，或 .afc/payload_cache（大小上限见AFC_PAYLOAD_CACHE）"""
+    from commands.image_cache import get_image_store, parse_size
+
+    if executor.image_cache is not None:
+        return executor.image_cache
+    limit = os.environ.get('AFC_PAYLOAD_CACHE', DEFAULT_CACHE_SIZE)
+    try:
+        max_bytes = parse_size(limit)
+    except ValueError:
+        print(f"警告: 无效的 AFC_PAYLOAD_CACHE 大小 - {limit}，使用默认值 {DEFAULT_CACHE_SIZE}")
+        max_bytes = parse_size(DEFAULT_CACHE_SIZE)
+    root = executor.state_dir / "payload_cache"
+    for legacy in root.glob('*.img'):
+        # 旧版本直接存放在目录下、不受大小上限管理的镜像
+        legacy.unlink()
+    return get_image_store(root, max_bytes)
+
+
+def source_key(payload: Payload, name: str) -> str:
+    """镜像库中记录来源用的键：payload文件路径和分区名"""
+    return f"{payload.path.resolve()}#{name}"
+
+
+def submit_extract(payload: Payload, name: str, store) -> Future:
+    """
+    在进程池中解压分区到镜像库，返回结果为 (镜像路径, SHA-256, 解压耗时) 的Future
+    库中已有时直接完成；多台设备同时请求同一镜像时共用一次解压
+    """
+    key = source_key(payload, name)
+    partition = payload.partitions[name]
+    st = payload.path.stat()
+    found = store.lookup(key, st)
+    if found is None and partition.sha256:
+        blob = store.find(partition.sha256)
+        found = (blob, partition.sha256) if blob is not None else None
+    if found is not None:
+        done: Future = Future()
+        done.set_result((found[0], found[1], 0.0))
+        return done
+
+    with _pool_lock:
+        if key in _inflight:
+            return _inflight[key]
+        tmp = store.incoming_path(f".{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}")
+        result: Future = Future()
+        # 只把该分区的manifest传给子进程
+        single = replace(payload, partitions={name: partition})
+        work = _get_pool().submit(_extract_worker, single, name, str(tmp))
+        _inflight[key] = result
+
+    def finished(work_future: Future) -> None:
+        with _pool_lock:
+            _inflight.pop(key, None)
+        try:
+            digest, elapsed = work_future.result()
+            image = store.add_extracted(key, st, tmp, digest)
+        except Exception as e:
+            if tmp.exists():
+                tmp.unlink()
+            result.set_exception(e)
+        else:
+            result.set_result((image, digest, elapsed))
+    work.add_done_callback(finished)
+    return result
+
+
+def flash_payload(executor, zip_file: str, *partitions: str) -> bool:
+    """从OTA zip/payload.bin刷写指定分区（不指定时刷写全部分区）"""
+    from commands.manifest import manifest_for
+
+    full_path = executor.script_dir / zip_file
+    if not full_path.exists():
+        print(f"错误: 文件不存在 - {full_path}")
+        return False
+    try:
+        payload = read_payload(full_path)
+    except (OSError, zipfile.BadZipFile, PayloadError) as e:
+        print(f"错误: 无法读取payload - {e}")
+        return False
+
+    names = list(partitions) or list(payload.partitions)
+    missing = [name for name in names if name not in payload.partitions]
+    if missing:
+        print(f"错误: payload中没有分区 {', '.join(missing)}（可选: {', '.join(payload.partitions)}）")
+        return False
+    for name in names:
+        unsupported = payload.partitions[name].unsupported_ops()
+        if unsupported:
+            print(f"错误: 分区 {name} 包含增量操作 {', '.join(unsupported)}，只支持全量OTA")
+            return False
+
+    manifest = manifest_for(executor)
+    if manifest is None and executor.incremental:
+        print("警告: 无法确定设备序列号（没有连接设备或连接了多台），不跳过未变化的分区")
+    todo = []
+    for name in names:
+        partition = payload.partitions[name]
+        if (executor.incremental and manifest is not None and partition.sha256
+                and manifest.matches(name, partition.sha256, partition.size)):
+            print(f"跳过分区 {name}: 镜像未变化 ({partition.sha256[:12]})")
+            continue
+        todo.append(name)
+
+    print(f"payload: {len(payload.partitions)} 个分区，将刷写 {len(todo)} 个")
+    try:
+        store = payload_store(executor)
+        futures = {name: submit_extract(payload, name, store) for name in todo}
+    except (OSError, sqlite3.Error) as e:
+        print(f"错误: 无法使用镜像缓存 - {e}")
+        return False
+    success = True
+    for name in todo:
+        try:
+            image, digest, elapsed = futures[name].result()
+        except Exception as e:
+            print(f"错误: 解压分区 {name} 失败 - {e}")
+            success = False
+            continue
+        size = payload.partitions[name].size
+        if elapsed:
+            print(f"已解压 {name} ({size / 1024 / 1024:.1f} MB, {elapsed:.1f}s)")
+        else:
+            print(f"使用缓存的 {name} 镜像 ({digest[:12]})")
+        executor.debug("分区 %s 镜像: %s", name, image)
+        ok = executor.run_fastboot_command(['flash', name, str(image)])
+        if manifest is not None:
+            if ok:
+                manifest.record(name, image, digest, size)
+            else:
+                manifest.forget(name)
+        if not ok:
+            success = False
+    return success
@@ -0,0 +1,272 @@
+"""
+命令注册表（惰性加载）
+解析 custom_commands.txt 得到 命令名 -> (模块, 函数) 的索引，不导入任何命令模块；命令第一次执行时才导入所在模块
+- 编译脚本时需要的参数信息（签名）按模块源文件的 (大小, mtime) 持久化到状态目录，命中时不需要导入模块
+- 计划缓存的指纹由注册文件内容和模块源文件的 (大小, mtime) 计算，同样不需要导入
+- 注册文件修改后重新解析
+"""
+
+import importlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SIGNATURE_VERSION = 1
+
+# 参数种类：位置参数、*args、没有默认值的仅关键字参数
+POSITIONAL = 'positional'
+VAR_POSITIONAL = 'var_positional'
+KEYWORD_ONLY = 'keyword'
+
+
+class CommandSignature:
+    """命令参数（不含executor），用于编译时检查参数个数"""
+
+    def __init__(self, params: List[Tuple[str, str, bool]]):
+        self.params = params  # (参数名, 种类, 是否必需)
+
+    @classmethod
+    def from_function(cls, func) -> Optional['CommandSignature']:
+        import inspect
+
+        try:
+            parameters = list(inspect.signature(func).parameters.values())[1:]
+        except (TypeError, ValueError):
+            return None
+        params = []
+        for param in parameters:
+            if param.kind == param.VAR_POSITIONAL:
+                params.append((param.name, VAR_POSITIONAL, False))
+            elif param.kind in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                params.append((param.name, POSITIONAL, param.default is param.empty))
+            elif param.kind == param.KEYWORD_ONLY and param.default is param.empty:
+                # 脚本只能按位置传参，必需的仅关键字参数无法满足
+                params.append((param.name, KEYWORD_ONLY, True))
+        return cls(params)
+
+    def bind(self, *args) -> None:
+        """参数个数不匹配时抛出TypeError（与inspect.Signature.bind的说明一致）"""
+        positional = [p for p in self.params if p[1] == POSITIONAL]
+        if len(args) > len(positional) and not any(p[1] == VAR_POSITIONAL for p in self.params):
+            raise TypeError("too many positional arguments")
+        for name, kind, required in positional[len(args):]:
+            if required:
+                raise TypeError(f"missing a required argument: '{name}'")
+        for name, kind, required in self.params:
+            if kind == KEYWORD_ONLY and required:
+                raise TypeError(f"missing a required argument: '{name}'")
+
+    def __str__(self) -> str:
+        names = [f"*{name}" if kind == VAR_POSITIONAL else name if required else f"{name}=..."
+                 for name, kind, required in self.params]
+        return f"({', '.join(names)})"
+
+
+class LazyCommand:
+    """注册表中的一个命令，第一次调用时导入模块；第一个参数是执行器"""
+
+    def __init__(self, registry: 'CommandRegistry', name: str, module: str, function: str):
+        self.registry = registry
+        self.name = name
+        self.module = module
+        self.function = function
+        self._func = None
+
+    def resolve(self):
+        """导入并返回命令函数，失败时打印原因并返回None"""
+        if self._func is None:
+            self._func = self.registry.load(self.module, self.function)
+        return self._func
+
+    def signature(self) -> Optional[CommandSignature]:
+        return self.registry.signature(self.module, self.function)
+
+    def fingerprint(self) -> str:
+        return f"{self.module}:{self.function}:{self.registry.module_stat(self.module)}"
+
+    def __call__(self, executor, *args):
+        func = self.resolve()
+        if func is None:
+            print(f"错误: 命令 {self.name} 不可用（{self.module}.{self.function}）")
+            return False
+        return func(executor, *args)
+
+    def __repr__(self) -> str:
+        return f"<命令 {self.name} -> {self.module}.{self.function}>"
+
+
+class CommandRegistry:
+    """custom_commands.txt 的惰性索引"""
+
+    def __init__(self, commands_file: Path, signature_file: Optional[Path] = None):
+        self.commands_file = Path(commands_file)
+        self.signature_file = signature_file
+        self._commands: Dict[str, LazyCommand] = {}
+        self._mtime: Optional[int] = -1
+        self._signatures: Optional[dict] = None  # 模块 -> {'stat': [...], 'functions': {函数: 参数}}
+        self._stats: Dict[str, Optional[List[int]]] = {}
+        self._lock = threading.RLock()
+
+    def commands(self) -> Dict[str, LazyCommand]:
+        """命令名 -> 惰性命令；注册文件修改后重新解析"""
+        try:
+            mtime = self.commands_file.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            if mtime != self._mtime:
+                self._commands = self._parse()
+                self._mtime = mtime
+                self._stats.clear()
+            return self._commands
+
+    def _parse(self) -> Dict[str, LazyCommand]:
+        table: Dict[str, LazyCommand] = {}
+        if not self.commands_file.parent.exists():
+            print(f"警告: commands目录不存在 - {self.commands_file.parent}")
+            return table
+        if not self.commands_file.exists():
+            print(f"警告: 命令注册文件不存在 - {self.commands_file}")
+            return table
+        with open(self.commands_file, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = [part.strip() for part in line.split(':')]
+                if len(parts) == 2:
+                    # 格式: 模块名:函数名
+                    module_name, function_name = parts
+                    command_name = function_name.upper()
+                elif len(parts) == 3:
+                    # 格式: 模块名:函数名:命令别名
+                    module_name, function_name, command_name = parts
+                    command_name = command_name.upper()
+                else:
+                    print(f"错误: 第{line_num}行格式不正确 - {line}")
+                    continue
+                table[command_name] = LazyCommand(self, command_name, module_name, function_name)
+        return table
+
+    def load(self, module_name: str, function_name: str):
+        """导入单个命令函数，失败时返回None"""
+        try:
+            module = importlib.import_module(f"commands.{module_name}")
+        except ImportError as e:
+            print(f"✗ 导入模块失败 {module_name}: {e}")
+            return None
+        except Exception as e:
+            print(f"✗ 加载命令失败 {module_name}.{function_name}: {e}")
+            return None
+        func = getattr(module, function_name, None)
+        if func is None:
+            print(f"✗ 未找到函数: {module_name}.{function_name}")
+            return None
+        import inspect
+
+        try:
+            params = list(inspect.signature(func).parameters)
+        except (TypeError, ValueError):
+            params = []
+        if not params or params[0] != 'executor':
+            print(f"✗ 函数签名错误: {module_name}.{function_name} 第一个参数必须是 'executor'")
+            return None
+        self._remember(module_name, function_name, CommandSignature.from_function(func))
+        return func
+
+    def preload(self) -> int:
+        """导入所有命令（常驻服务启动时），返回可用的命令数"""
+        return sum(1 for command in self.commands().values() if command.resolve() is not None)
+
+    # ---- 签名缓存 ----
+
+    def module_stat(self, module_name: str) -> Optional[List[int]]:
+        """模块源文件的 [大小, mtime]，找不到源文件时为None（签名不缓存）"""
+        with self._lock:
+            if module_name in self._stats:
+                return self._stats[module_name]
+        base = self.commands_file.parent / Path(*module_name.split('.'))
+        stat = None
+        for path in (base.with_suffix('.py'), base / '__init__.py'):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            stat = [st.st_size, st.st_mtime_ns]
+            break
+        with self._lock:
+            self._stats[module_name] = stat
+        return stat
+
+    def signature(self, module_name: str, function_name: str) -> Optional[CommandSignature]:
+        """命令的参数信息：缓存有效时不导入模块"""
+        stat = self.module_stat(module_name)
+        with self._lock:
+            entry = self._signature_cache().get(module_name)
+            if stat is not None and entry and entry.get('stat') == stat and function_name in entry['functions']:
+                params = entry['functions'][function_name]
+                return CommandSignature([tuple(p) for p in params]) if params is not None else None
+        if self.load(module_name, function_name) is None:
+            return None
+        with self._lock:
+            params = self._signature_cache().get(module_name, {}).get('functions', {}).get(function_name)
+        return CommandSignature([tuple(p) for p in params]) if params is not None else None
+
+    def _signature_cache(self) -> dict:
+        if self._signatures is None:
+            self._signatures = {}
+            if self.signature_file is not None:
+                try:
+                    with open(self.signature_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    if data.get('version') == SIGNATURE_VERSION:
+                        self._signatures = data.get('modules', {})
+                except (OSError, ValueError):
+                    pass
+        return self._signatures
+
+    def _remember(self, module_name: str, function_name: str, signature: Optional[CommandSignature]) -> None:
+        stat = self.module_stat(module_name)
+        if stat is None:
+            return
+        with self._lock:
+            cache = self._signature_cache()
+            entry = cache.get(module_name)
+            if not entry or entry.get('stat') != stat:
+                entry = cache[module_name] = {'stat': stat, 'functions': {}}
+            params = [list(p) for p in signature.params] if signature is not None else None
+            if entry['functions'].get(function_name, 0) == params:
+                return
+            entry['functions'][function_name] = params
+            self._save_signatures(cache)
+
+    def _save_signatures(self, cache: dict) -> None:
+        if self.signature_file is None:
+            return
+        try:
+            self.signature_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.signature_file.with_name(f"{self.signature_file.name}.{os.getpid()}.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'version': SIGNATURE_VERSION, 'modules': cache}, f, ensure_ascii=False)
+            os.replace(tmp, self.signature_file)
+        except OSError:
+            pass
+
+
+_REGISTRIES: Dict[Tuple[str, str], CommandRegistry] = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_command_registry(commands_file: Path, state_dir: Optional[Path] = None) -> CommandRegistry:
+    """进程内共享的命令注册表，多设备/常驻服务模式下每个模块只导入一次"""
+    key = (str(commands_file), str(state_dir))
+    registry = _REGISTRIES.get(key)
+    if registry is None:
+        with _REGISTRIES_LOCK:
+            registry = _REGISTRIES.get(key)
+            if registry is None:
+                signature_file = Path(state_dir) / "command_signatures.json" if state_dir is not None else None
+                registry = _REGISTRIES[key] = CommandRegistry(Path(commands_file), signature_file)
+    return registry
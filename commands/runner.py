@@ -0,0 +1,191 @@
+"""
+外部工具的流式执行器
+增量读取stdout/stderr，把fastboot/SPFlashTool的进度输出解析为结构化进度事件（MB/s、剩余时间），
+只保留有限的输出尾部用于报错；超时按“无输出时间”计算而不是固定总时长
+"""
+
+import locale
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, List, Optional, Tuple
+
+TAIL_LINES = 200
+READ_SIZE = 64 * 1024
+
+# fastboot: Sending 'boot' (65536 KB) / Sending sparse 'system' 2/7 (524284 KB) / Writing 'boot'
+SENDING_RE = re.compile(r"sending(?: sparse)? '([^']+)'(?: (\d+)/(\d+))? \((\d+) KB\)", re.IGNORECASE)
+WRITING_RE = re.compile(r"writing '([^']+)'", re.IGNORECASE)
+OKAY_RE = re.compile(r"OKAY \[\s*([\d.]+)s\]")
+PERCENT_RE = re.compile(r"(\d{1,3})\s*%")
+
+
+@dataclass
+class ProgressEvent:
+    """一次进度更新"""
+    stage: str  # sending / sent / writing / progress
+    partition: str = ""
+    percent: Optional[float] = None
+    bytes_total: int = 0
+    rate_mb_s: Optional[float] = None
+    eta_s: Optional[float] = None
+    piece: Optional[Tuple[int, int]] = None
+
+    def describe(self) -> str:
+        parts = [self.stage]
+        if self.partition:
+            parts.append(f"'{self.partition}'")
+        if self.piece:
+            parts.append(f"{self.piece[0]}/{self.piece[1]}")
+        if self.percent is not None:
+            parts.append(f"{self.percent:.0f}%")
+        if self.bytes_total:
+            parts.append(f"{self.bytes_total / 1024 / 1024:.1f} MB")
+        if self.rate_mb_s is not None:
+            parts.append(f"{self.rate_mb_s:.1f} MB/s")
+        if self.eta_s is not None:
+            parts.append(f"预计剩余 {self.eta_s:.0f}s")
+        return ' '.join(parts)
+
+
+class ProgressParser:
+    """把工具输出行解析为进度事件"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self._sending: Optional[ProgressEvent] = None
+        self._sending_text = ""
+        self._piece_times: List[float] = []
+        self._last_percent: Optional[float] = None
+
+    def feed(self, line: str) -> List[ProgressEvent]:
+        events = []
+        match = SENDING_RE.search(line)
+        if match and (self._sending is None or self._sending_text != match.group(0)):
+            self._sending_text = match.group(0)
+            partition, index, count, kb = match.groups()
+            piece = (int(index), int(count)) if index else None
+            self._sending = ProgressEvent('sending', partition, bytes_total=int(kb) * 1024, piece=piece)
+            if piece and self._piece_times:
+                average = sum(self._piece_times) / len(self._piece_times)
+                self._sending.eta_s = average * (piece[1] - piece[0] + 1)
+            events.append(self._sending)
+        okay = OKAY_RE.search(line)
+        if okay and self._sending is not None:
+            seconds = float(okay.group(1))
+            sent = self._sending
+            self._piece_times.append(seconds)
+            rate = sent.bytes_total / seconds / 1024 / 1024 if seconds > 0 else None
+            eta = None
+            if sent.piece:
+                eta = (sum(self._piece_times) / len(self._piece_times)) * (sent.piece[1] - sent.piece[0])
+            events.append(ProgressEvent('sent', sent.partition, bytes_total=sent.bytes_total,
+                                        rate_mb_s=rate, eta_s=eta, piece=sent.piece))
+            self._sending = None
+        match = WRITING_RE.search(line)
+        if match:
+            events.append(ProgressEvent('writing', match.group(1)))
+        if not events:
+            match = PERCENT_RE.search(line)
+            if match:
+                percent = min(100.0, float(match.group(1)))
+                if percent != self._last_percent:
+                    self._last_percent = percent
+                    elapsed = time.monotonic() - self.start
+                    eta = elapsed * (100 - percent) / percent if percent > 0 else None
+                    events.append(ProgressEvent('progress', percent=percent, eta_s=eta))
+        return events
+
+
+@dataclass
+class RunResult:
+    """流式执行的结果，只包含输出尾部"""
+    returncode: Optional[int]
+    timed_out: bool = False
+    tail: Deque[Tuple[str, str]] = field(default_factory=lambda: deque(maxlen=TAIL_LINES))
+    spawn_latency: float = 0.0
+    duration: float = 0.0
+
+    def tail_text(self, stream: Optional[str] = None) -> str:
+        return '\n'.join(line for name, line in self.tail if stream is None or name == stream)
+
+
+def _pump(pipe, name: str, lines: "queue.Queue") -> None:
+    """
+    把管道按行(\\n或\\r)切分后放入队列，EOF时放入None
+    按本地编码解码（与subprocess的text=True相同），中文Windows上fastboot/SPFlashTool/cmd的输出为GBK
+    """
+    encoding = locale.getpreferredencoding(False)
+    pending = b''
+    try:
+        while True:
+            chunk = pipe.read1(READ_SIZE) if hasattr(pipe, 'read1') else os.read(pipe.fileno(), READ_SIZE)
+            if not chunk:
+                break
+            pending += chunk
+            parts = re.split(rb'\r\n|\r|\n', pending)
+            pending = parts.pop()
+            for part in parts:
+                lines.put((name, part.decode(encoding, 'replace'), True))
+            if pending:
+                # 未换行的半行（如fastboot先输出"Sending ..."，传输完成后才补上OKAY）只用于进度解析
+                lines.put((name, pending.decode(encoding, 'replace'), False))
+        if pending:
+            lines.put((name, pending.decode(encoding, 'replace'), True))
+    finally:
+        pipe.close()
+        lines.put((name, None, True))
+
+
+def run_streaming(cmd: List[str], inactivity_timeout: Optional[float],
+                  on_line: Optional[Callable[[str, str], None]] = None,
+                  on_progress: Optional[Callable[[ProgressEvent], None]] = None) -> RunResult:
+    """
+    启动进程并流式读取输出；超过inactivity_timeout秒没有任何输出时终止进程
+    on_line(流名, 行) 收到每一行时调用，on_progress(事件) 解析到进度时调用
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    result = RunResult(None, spawn_latency=time.monotonic() - start)
+    lines: "queue.Queue" = queue.Queue()
+    readers = [threading.Thread(target=_pump, args=(proc.stdout, 'stdout', lines), daemon=True),
+               threading.Thread(target=_pump, args=(proc.stderr, 'stderr', lines), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    parser = ProgressParser() if on_progress else None
+    open_streams = 2
+    while open_streams:
+        try:
+            name, line, complete = lines.get(timeout=inactivity_timeout)
+        except queue.Empty:
+            result.timed_out = True
+            proc.kill()
+            break
+        if line is None:
+            open_streams -= 1
+            continue
+        if complete:
+            result.tail.append((name, line))
+            if on_line:
+                on_line(name, line)
+        if parser:
+            for event in parser.feed(line):
+                on_progress(event)
+
+    try:
+        # 输出已关闭但进程可能还在收尾，同样按无响应时间等待
+        result.returncode = proc.wait(timeout=inactivity_timeout)
+    except subprocess.TimeoutExpired:
+        result.timed_out = True
+        proc.kill()
+        proc.wait()
+    for reader in readers:
+        reader.join(timeout=1)
+    result.duration = time.monotonic() - start
+    return result
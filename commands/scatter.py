@@ -0,0 +1,304 @@
+"""
+MTK scatter文件解析与按分区刷写
+- 支持 MT*_Android_scatter.txt 的 v1/v2（YAML风格，- partition_index: ...）和早期的 "名称 地址 { }" 格式
+- 解析出按分区名索引的分区表：地址、大小、镜像文件名、is_download
+FLASHMTK_PARTS(scatter, 分区...)：只下载指定的分区；不指定分区时只下载镜像与该设备上次刷写内容不同的分区
+- 生成只勾选这些分区的临时scatter交给SPFlashTool（download模式），其余分区不会被重写
+- 启动SPFlashTool之前并行检查镜像是否存在、大小是否超过分区，出错时在DA握手之前就失败
+- DA文件取脚本变量 MTK_DA，未设置时由SPFlashTool使用默认DA
+"""
+
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+ITEM_LINE = re.compile(r'^(\s*)(-\s+)?([A-Za-z_][\w-]*)\s*:\s*(.*?)\s*$')
+LEGACY_LINE = re.compile(r'^(\S+)\s+(0x[0-9a-fA-F]+)\s*$')
+NODL_PREFIX = '__NODL_'
+
+# 早期scatter只写分区名，镜像文件名由SPFlashTool按惯例对应
+LEGACY_FILES = {
+    'PRELOADER': 'preloader.bin', 'MBR': 'MBR', 'EBR1': 'EBR1', 'EBR2': 'EBR2', 'UBOOT': 'lk.bin',
+    'BOOTIMG': 'boot.img', 'RECOVERY': 'recovery.img', 'SEC_RO': 'secro.img', 'LOGO': 'logo.bin',
+    'ANDROID': 'system.img', 'CACHE': 'cache.img', 'USRDATA': 'userdata.img', 'CUSTOM': 'custom.img',
+}
+
+
+class ScatterError(Exception):
+    """scatter文件格式错误"""
+
+
+@dataclass
+class ScatterPartition:
+    """scatter中的一个分区"""
+    index: int
+    name: str
+    file_name: Optional[str]  # 'NONE' 或缺省时为None
+    is_download: bool
+    start: int  # linear_start_addr
+    size: Optional[int]  # partition_size；早期格式按下一个分区的地址推算，最后一个分区为None
+    region: str = ""
+    fields: Dict[str, str] = field(default_factory=dict)
+    first_line: int = 0  # 该分区在文件中的行范围 [first_line, end_line)
+    end_line: int = 0
+    download_line: Optional[int] = None  # is_download 所在行
+
+
+@dataclass
+class Scatter:
+    """解析后的scatter文件"""
+    path: Path
+    version: str  # 'legacy' / 'v1' / 'v2'
+    lines: List[str]
+    general: Dict[str, str] = field(default_factory=dict)
+    partitions: List[ScatterPartition] = field(default_factory=list)
+    _by_name: Dict[str, ScatterPartition] = field(default_factory=dict, repr=False)
+
+    @property
+    def platform(self) -> str:
+        return self.general.get('platform', '')
+
+    def get(self, name: str) -> Optional[ScatterPartition]:
+        """按分区名查找（不区分大小写）"""
+        return self._by_name.get(name.lower())
+
+    def image_path(self, part: ScatterPartition) -> Optional[Path]:
+        """镜像文件路径（相对于scatter所在目录）"""
+        return self.path.parent / part.file_name if part.file_name else None
+
+    def trimmed(self, names: List[str]) -> str:
+        """只下载names中分区的scatter文本，其余内容保持原样"""
+        keep = {name.lower() for name in names}
+        lines = list(self.lines)
+        inserts: List[Tuple[int, str]] = []
+        for part in self.partitions:
+            wanted = part.name.lower() in keep
+            if self.version == 'legacy':
+                head = lines[part.first_line]
+                name = head.split()[0]
+                if wanted and name.startswith(NODL_PREFIX):
+                    lines[part.first_line] = head.replace(name, name[len(NODL_PREFIX):], 1)
+                elif not wanted and not name.startswith(NODL_PREFIX):
+                    lines[part.first_line] = head.replace(name, NODL_PREFIX + name, 1)
+                continue
+            value = 'true' if wanted else 'false'
+            if part.download_line is not None:
+                line = lines[part.download_line]
+                lines[part.download_line] = re.sub(r'(is_download\s*:\s*)\S+', rf'\g<1>{value}', line)
+            elif not wanted:
+                indent = re.match(r'^(\s*)-?\s*', lines[part.first_line]).group(0).replace('-', ' ')
+                inserts.append((part.first_line + 1, f"{indent}is_download: false"))
+        for line_index, text in sorted(inserts, reverse=True):
+            lines.insert(line_index, text)
+        return '\n'.join(lines) + '\n'
+
+
+def _int(value: str) -> int:
+    return int(value, 0)
+
+
+def parse_scatter(path: Path) -> Scatter:
+    """读取scatter文件"""
+    path = Path(path)
+    lines = path.read_text(encoding='utf-8', errors='replace').splitlines()
+    if any(ITEM_LINE.match(line) and 'partition_index' in line for line in lines):
+        scatter = _parse_yaml(path, lines)
+    else:
+        scatter = _parse_legacy(path, lines)
+    if not scatter.partitions:
+        raise ScatterError("没有找到任何分区")
+    for part in scatter.partitions:
+        scatter._by_name.setdefault(part.name.lower(), part)
+    return scatter
+
+
+def _parse_yaml(path: Path, lines: List[str]) -> Scatter:
+    """v1/v2：以 "- 键: 值" 开始的一组 "键: 值"，general项中info下的键合并到general"""
+    items: List[Tuple[int, int, Dict[str, str], Dict[str, int]]] = []
+    current: Optional[Tuple[int, Dict[str, str], Dict[str, int]]] = None
+    for line_index, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        match = ITEM_LINE.match(line)
+        if not match:
+            continue
+        indent, dash, key, value = match.groups()
+        if dash and not indent:
+            if current is not None:
+                items.append((current[0], line_index, current[1], current[2]))
+            current = (line_index, {}, {})
+        if current is not None:
+            current[1].setdefault(key, value)
+            current[2].setdefault(key, line_index)
+    if current is not None:
+        items.append((current[0], len(lines), current[1], current[2]))
+
+    scatter = Scatter(path, 'v1', lines)
+    for first, end, values, positions in items:
+        if 'general' in values:
+            scatter.general = {k: v for k, v in values.items() if k not in ('general', 'info')}
+            continue
+        if 'partition_name' not in values:
+            continue
+        try:
+            part = ScatterPartition(
+                index=len(scatter.partitions),
+                name=values['partition_name'],
+                file_name=values.get('file_name') if values.get('file_name', 'NONE') != 'NONE' else None,
+                is_download=values.get('is_download', 'false').lower() == 'true',
+                start=_int(values.get('linear_start_addr', '0')),
+                size=_int(values['partition_size']) if 'partition_size' in values else None,
+                region=values.get('region', ''),
+                fields=values,
+                first_line=first,
+                end_line=end,
+                download_line=positions.get('is_download'),
+            )
+        except ValueError as e:
+            raise ScatterError(f"第{first + 1}行分区 {values.get('partition_name')} 的数值无效 - {e}")
+        scatter.partitions.append(part)
+    if scatter.general.get('config_version', '').upper().startswith('V2'):
+        scatter.version = 'v2'
+    return scatter
+
+
+def _parse_legacy(path: Path, lines: List[str]) -> Scatter:
+    """早期格式：每个分区为 "名称 起始地址" 加一对大括号，__NODL_前缀表示不下载"""
+    scatter = Scatter(path, 'legacy', lines)
+    for line_index, line in enumerate(lines):
+        match = LEGACY_LINE.match(line.strip())
+        if not match:
+            continue
+        raw_name, address = match.groups()
+        name = raw_name[len(NODL_PREFIX):] if raw_name.startswith(NODL_PREFIX) else raw_name
+        scatter.partitions.append(ScatterPartition(
+            index=len(scatter.partitions), name=name, file_name=LEGACY_FILES.get(name.upper()),
+            is_download=not raw_name.startswith(NODL_PREFIX), start=_int(address), size=None,
+            first_line=line_index, end_line=line_index + 1))
+    for part, following in zip(scatter.partitions, scatter.partitions[1:]):
+        if following.start > part.start:
+            part.size = following.start - part.start
+    return scatter
+
+
+def image_size(path: Path) -> int:
+    """镜像写入后占用的大小：sparse镜像为展开后的大小"""
+    from commands.sparse import FILE_HEADER, SPARSE_MAGIC
+
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+    if len(header) == FILE_HEADER.size:
+        magic, _major, _minor, _hdr, _chunk_hdr, block_size, total_blocks, _chunks, _sum = FILE_HEADER.unpack(header)
+        if magic == SPARSE_MAGIC:
+            return block_size * total_blocks
+    return os.path.getsize(path)
+
+
+def check_image(scatter: Scatter, part: ScatterPartition) -> Optional[str]:
+    """检查分区的镜像，返回错误说明"""
+    path = scatter.image_path(part)
+    if path is None:
+        return "scatter中没有镜像文件"
+    try:
+        size = image_size(path)
+    except OSError:
+        return f"镜像不存在 - {path.name}"
+    if part.size and size > part.size:
+        return f"镜像 {path.name} 大小 {size:#x} 超过分区大小 {part.size:#x}"
+    return None
+
+
+def check_images(scatter: Scatter, parts: List[ScatterPartition], workers: int = 8) -> List[Tuple[str, str]]:
+    """并行检查所有分区的镜像，返回 (分区名, 错误) 列表"""
+    if not parts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(parts)))) as pool:
+        results = list(pool.map(lambda part: check_image(scatter, part), parts))
+    return [(part.name, error) for part, error in zip(parts, results) if error]
+
+
+def _hash_images(executor, scatter: Scatter, parts: List[ScatterPartition]) -> Dict[str, Tuple[str, int]]:
+    """并行计算镜像的SHA-256（使用哈希缓存），返回 分区名 -> (哈希, 大小)"""
+    from commands.manifest import get_hash_cache
+
+    cache = get_hash_cache(executor.state_dir)
+
+    def run(part):
+        path = scatter.image_path(part)
+        return part.name, (cache.sha256(path), path.stat().st_size)
+    with ThreadPoolExecutor(max_workers=max(1, min(4, len(parts)))) as pool:
+        return dict(pool.map(run, parts))
+
+
+def flashmtk_parts(executor, scatter_file: str, *partitions: str) -> bool:
+    """只下载scatter中指定的分区；不指定时只下载镜像有变化的分区"""
+    from commands.manifest import manifest_for
+
+    scatter_path = executor.script_dir / scatter_file
+    try:
+        scatter = parse_scatter(scatter_path)
+    except (OSError, ScatterError) as e:
+        print(f"错误: 无法读取scatter文件 {scatter_path} - {e}")
+        return False
+
+    if partitions:
+        missing = [name for name in partitions if scatter.get(name) is None]
+        if missing:
+            print(f"错误: scatter中没有分区 {', '.join(missing)}")
+            return False
+        selected = [scatter.get(name) for name in partitions]
+    else:
+        selected = [part for part in scatter.partitions if part.is_download and part.file_name]
+
+    errors = check_images(scatter, selected)
+    if errors:
+        for name, error in errors:
+            print(f"错误: 分区 {name}: {error}")
+        print(f"镜像检查失败 {len(errors)}/{len(selected)}，未启动SPFlashTool")
+        return False
+
+    manifest = manifest_for(executor)
+    if manifest is None and not partitions:
+        # preloader/BROM模式下看不到序列号，需要用 @序列号 或 --devices 指定
+        print("警告: 无法确定设备序列号，下载所有is_download的分区（用 @序列号 或 --devices 指定设备后才能跳过未变化的分区）")
+    skip_unchanged = not partitions and manifest is not None
+    digests = _hash_images(executor, scatter, selected) if skip_unchanged else {}
+    if skip_unchanged:
+        selected = [part for part in selected if not manifest.matches(part.name, *digests[part.name])]
+        if not selected:
+            print("所有分区的镜像都没有变化，不需要下载")
+            return True
+
+    names = [part.name for part in selected]
+    print(f"scatter: {scatter.platform or scatter.version}，共 {len(scatter.partitions)} 个分区，"
+          f"将下载 {len(names)} 个: {', '.join(names)}")
+    # SPFlashTool按scatter所在目录查找镜像，临时scatter放在同一目录
+    tmp = scatter_path.with_name(f".{scatter_path.stem}.afc-{os.getpid()}-{threading.get_ident()}.txt")
+    try:
+        tmp.write_text(scatter.trimmed(names), encoding='utf-8')
+        da = executor.variables.get('MTK_DA')
+        args = (['-d', str(executor.script_dir / da)] if da else []) + ['-s', str(tmp), '-c', 'download']
+        ok = executor.run_spflashtool_command(args)
+    except OSError as e:
+        print(f"错误: 无法写入临时scatter文件 - {e}")
+        return False
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+    if manifest is None:
+        return ok
+    if not ok:
+        for name in names:
+            manifest.forget(name)
+        return False
+    digests = digests or _hash_images(executor, scatter, selected)
+    for part in selected:
+        digest, size = digests[part.name]
+        manifest.record(part.name, scatter.image_path(part), digest, size)
+    return True
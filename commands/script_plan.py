@@ -0,0 +1,298 @@
+"""
+AFC脚本编译
+执行前把脚本整体解析为执行计划：命令在注册表中解析、参数个数按函数签名校验、
+$VAR替换预编译为一次扫描；计划按脚本哈希缓存到磁盘，重复执行时跳过解析
+并发语法：
+  PARALLEL { ... }          块中每一行（或用 { } 包起来的一组行）是一个分支，各分支同时执行，全部结束后继续
+  BACKGROUND 名称 { ... }    块在后台执行，脚本继续往下走；JOIN(名称) 等待其结束，JOIN() 等待所有后台任务
+  @序列号 命令(...)           该行（或块）对指定设备执行，序列号可以是 $变量
+"""
+
+import hashlib
+import inspect
+import os
+import pickle
+import re
+import threading
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+PLAN_VERSION = 2
+
+VAR_LINE = re.compile(r'^(\w+)\s*=\s*(.+)$')
+CALL_LINE = re.compile(r'^(\w+)\((.*)\)$')
+VAR_REF = re.compile(r'\$(\w+)')
+SERIAL_PREFIX = re.compile(r'^@(\S+)\s+(.+)$')
+BLOCK_OPEN = re.compile(r'^(PARALLEL|BACKGROUND\s+(\w+))\s*\{$', re.IGNORECASE)
+JOIN_LINE = re.compile(r'^JOIN(?:\s*\((.*)\))?$', re.IGNORECASE)
+
+
+def split_arguments(args_str: str) -> List[str]:
+    """按逗号拆分参数，支持单/双引号"""
+    args = []
+    current_arg = ""
+    in_quotes = False
+    quote_char = None
+
+    for char in args_str:
+        if char in ['"', "'"]:
+            if not in_quotes:
+                in_quotes = True
+                quote_char = char
+            elif char == quote_char:
+                in_quotes = False
+                quote_char = None
+            else:
+                current_arg += char
+        elif char == ',' and not in_quotes:
+            if current_arg:
+                args.append(current_arg.strip())
+                current_arg = ""
+        else:
+            current_arg += char
+
+    if current_arg:
+        args.append(current_arg.strip())
+    return args
+
+
+@dataclass
+class ArgTemplate:
+    """预编译的参数串：字面量与变量引用交替排列，渲染时一次扫描完成替换"""
+    pieces: Tuple[str, ...]  # 偶数位为字面量，奇数位为变量名
+
+    @classmethod
+    def compile(cls, text: str) -> 'ArgTemplate':
+        return cls(tuple(VAR_REF.split(text)))
+
+    @property
+    def has_vars(self) -> bool:
+        return len(self.pieces) > 1
+
+    def render(self, variables: Dict[str, str]) -> str:
+        if not self.has_vars:
+            return self.pieces[0]
+        out = []
+        for i, piece in enumerate(self.pieces):
+            if i % 2 == 0:
+                out.append(piece)
+            elif piece in variables:
+                out.append(variables[piece])
+            else:
+                out.append(_prefix_substitute(piece, variables))
+        return ''.join(out)
+
+
+def _prefix_substitute(name: str, variables: Dict[str, str]) -> str:
+    """兼容旧的str.replace行为：$VAR_SUFFIX 中已定义的最长前缀变量也会被替换"""
+    for end in range(len(name) - 1, 0, -1):
+        if name[:end] in variables:
+            return variables[name[:end]] + name[end:]
+    return '$' + name
+
+
+@dataclass
+class Step:
+    """执行计划中的一步"""
+    line_num: int
+    kind: str  # 'set' 设置变量 / 'call' 调用命令 / 'parallel' 并行块 / 'background' 后台块 / 'join' 等待后台块
+    name: str  # 变量名、命令名或后台任务名
+    value: str = ""  # 变量值（set）
+    template: Optional[ArgTemplate] = None  # 参数模板（call）
+    args: Optional[List[str]] = None  # 不含变量时预先拆分好的参数；join时为等待的任务名（空表示全部）
+    serial: Optional[ArgTemplate] = None  # @序列号 前缀
+    body: List['Step'] = field(default_factory=list)  # 后台块的内容
+    branches: List[List['Step']] = field(default_factory=list)  # 并行块的各个分支
+
+    def resolve_args(self, variables: Dict[str, str]) -> List[str]:
+        if self.args is not None:
+            return self.args
+        return split_arguments(self.template.render(variables))
+
+
+@dataclass
+class Plan:
+    """编译后的脚本"""
+    script_hash: str
+    debug: bool = False
+    steps: List[Step] = field(default_factory=list)
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+    warnings: List[Tuple[int, str]] = field(default_factory=list)
+
+
+def registry_fingerprint(commands: Dict[str, Callable]) -> str:
+    """命令名和签名的指纹，注册表变化后缓存的计划自动失效"""
+    digest = hashlib.sha256()
+    for name in sorted(commands):
+        lazy = _lazy(commands[name])
+        # 惰性命令用模块源文件的 (大小, mtime) 代替签名，不需要导入模块
+        detail = lazy.fingerprint() if lazy is not None else _signature(commands[name])
+        digest.update(f"{name}{detail}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _lazy(func: Callable):
+    """绑定到执行器的惰性命令（commands/registry.py），其他可调用对象返回None"""
+    target = func.func if isinstance(func, partial) else func
+    return target if hasattr(target, 'fingerprint') and hasattr(target, 'signature') else None
+
+
+def _signature(func: Callable):
+    """返回有bind(*args)方法的签名对象，无法获取时返回None"""
+    lazy = _lazy(func)
+    if lazy is not None:
+        return lazy.signature()
+    try:
+        return inspect.signature(func)
+    except (TypeError, ValueError):
+        return None
+
+
+def compile_script(content: str, commands: Dict[str, Callable]) -> Plan:
+    """把脚本文本编译为执行计划，收集所有错误而不是在第一个错误处停止"""
+    plan = Plan(hashlib.sha256(content.encode('utf-8')).hexdigest())
+    lines = content.split('\n')
+
+    # 与原有行为一致：只看第一条DEBUG=设置
+    for line in lines:
+        line = line.strip()
+        if line.startswith('DEBUG='):
+            plan.debug = line.split('=', 1)[1].strip().upper() in ['TRUE', '1', 'ON', 'YES']
+            break
+
+    static_vars: Dict[str, str] = {}
+    signatures: Dict[str, object] = {}
+    backgrounds: Dict[str, int] = {}
+    # 打开的块：(块, 正在填充的步骤列表)；列表为None表示PARALLEL块本身，其中每一步是一个分支
+    stack: List[Tuple[Step, Optional[List[Step]]]] = []
+
+    def add(step: Step) -> None:
+        if not stack:
+            plan.steps.append(step)
+        elif stack[-1][1] is None:
+            stack[-1][0].branches.append([step])
+        else:
+            stack[-1][1].append(step)
+
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        serial = None
+        serial_match = SERIAL_PREFIX.match(line)
+        if serial_match:
+            serial = ArgTemplate.compile(serial_match.group(1))
+            line = serial_match.group(2).strip()
+
+        if line == '}':
+            if not stack:
+                plan.errors.append((line_num, "多余的 }"))
+                continue
+            block, _ = stack.pop()
+            if block.kind == 'parallel' and not block.branches:
+                plan.warnings.append((block.line_num, "PARALLEL块为空"))
+            continue
+
+        if line == '{':
+            # PARALLEL块中用 { } 把多行组成一个按顺序执行的分支
+            if not stack or stack[-1][1] is not None:
+                plan.errors.append((line_num, "{ 只能用于在PARALLEL块中组成分支"))
+                continue
+            branch: List[Step] = []
+            stack[-1][0].branches.append(branch)
+            stack.append((Step(line_num, 'group', '{'), branch))
+            continue
+
+        block_match = BLOCK_OPEN.match(line)
+        if block_match:
+            if block_match.group(2):
+                name = block_match.group(2)
+                if name in backgrounds:
+                    plan.errors.append((line_num, f"后台任务 {name} 已在第{backgrounds[name]}行定义"))
+                backgrounds[name] = line_num
+                block = Step(line_num, 'background', name, serial=serial)
+                add(block)
+                stack.append((block, block.body))
+            else:
+                block = Step(line_num, 'parallel', 'PARALLEL', serial=serial)
+                add(block)
+                stack.append((block, None))
+            continue
+
+        join_match = JOIN_LINE.match(line)
+        if join_match:
+            names = split_arguments(join_match.group(1) or '')
+            for name in names:
+                if name not in backgrounds:
+                    plan.errors.append((line_num, f"JOIN: 未定义的后台任务 - {name}"))
+            add(Step(line_num, 'join', 'JOIN', args=names))
+            continue
+
+        var_match = VAR_LINE.match(line)
+        if var_match:
+            name, value = var_match.group(1), var_match.group(2)
+            if serial is not None:
+                plan.errors.append((line_num, "@序列号 不能用于变量赋值"))
+            static_vars[name] = value
+            add(Step(line_num, 'set', name, value=value))
+            continue
+
+        cmd_match = CALL_LINE.match(line)
+        if not cmd_match:
+            plan.warnings.append((line_num, f"无法识别的语句，已忽略 - {line}"))
+            continue
+
+        command = cmd_match.group(1).upper()
+        template = ArgTemplate.compile(cmd_match.group(2))
+        step = Step(line_num, 'call', command, template=template, serial=serial)
+        if not template.has_vars:
+            step.args = split_arguments(template.pieces[0])
+        add(step)
+
+        if command not in commands:
+            plan.errors.append((line_num, f"未知命令 - {command}"))
+            continue
+        if command not in signatures:
+            signatures[command] = _signature(commands[command])
+        sig = signatures[command]
+        if sig is not None:
+            args = step.resolve_args(static_vars)
+            try:
+                sig.bind(*args)
+            except TypeError as e:
+                plan.errors.append((line_num, f"参数数量不匹配 - {command}({', '.join(args)}): {e}"))
+
+    for block, _ in stack:
+        plan.errors.append((block.line_num, f"块没有用 }} 结束 - {block.name}"))
+    return plan
+
+
+def load_plan(path: Path, commands: Dict[str, Callable], cache_dir: Optional[Path]) -> Plan:
+    """读取脚本并返回执行计划，命中磁盘缓存时直接反序列化"""
+    raw = Path(path).read_bytes()
+    content = raw.decode('utf-8')
+    cache_file = None
+    if cache_dir is not None:
+        key = hashlib.sha256(raw + registry_fingerprint(commands).encode('ascii')
+                             + str(PLAN_VERSION).encode('ascii')).hexdigest()
+        cache_file = Path(cache_dir) / f"{key}.plan"
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.PickleError, EOFError, AttributeError):
+            pass
+
+    plan = compile_script(content, commands)
+    if cache_file is not None:
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, 'wb') as f:
+                pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+            tmp.replace(cache_file)
+        except OSError:
+            pass
+    return plan
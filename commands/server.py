@@ -0,0 +1,385 @@
+"""
+常驻服务模式（--serve）
+一个进程常驻，命令注册表、工具索引、adb连接、镜像库等只初始化一次，通过本地HTTP接口（TCP或Unix socket）接收脚本任务
+- 每个序列号一个先进先出队列：同一台设备同一时间只执行一个任务，不同设备并行（总数受 --jobs 限制）
+- 每个任务的输出写入单独的日志文件，可随时查询状态、实时跟踪日志
+接口（请求和响应均为JSON，日志为纯文本）：
+  POST   /jobs             {"script": "a.AFC", "serial": "...", "incremental": true} -> 任务信息
+  GET    /jobs             所有任务
+  GET    /jobs/<id>        任务状态
+  GET    /jobs/<id>/log    任务日志；?offset=N 从第N字节开始，?follow=1 持续输出直到任务结束
+  DELETE /jobs/<id>        取消仍在排队的任务
+"""
+
+import itertools
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from commands.console import install_router
+
+# 提交任务时可以覆盖的命令行选项
+JOB_OPTIONS = {'incremental': bool, 'resume': bool, 'image_cache': str, 'verify': str, 'timeout': list}
+MAX_BODY = 64 * 1024
+FOLLOW_INTERVAL = 0.2
+
+
+@dataclass
+class Job:
+    """一个脚本任务"""
+    id: str
+    script: str
+    serial: Optional[str]
+    options: dict
+    log_file: Path
+    state: str = 'queued'  # queued / running / succeeded / failed / cancelled
+    submitted: float = 0.0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: str = ""
+
+    @property
+    def done(self) -> bool:
+        return self.state in ('succeeded', 'failed', 'cancelled')
+
+    def to_dict(self) -> dict:
+        duration = None
+        if self.started is not None:
+            duration = round((self.finished or time.time()) - self.started, 3)
+        return {'id': self.id, 'script': self.script, 'serial': self.serial, 'options': self.options,
+                'state': self.state, 'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished, 'duration': duration, 'error': self.error,
+                'log': str(self.log_file)}
+
+
+class Scheduler:
+    """
+    按序列号排队执行任务；factory(job) 返回该任务的执行器，
+    resolve() 返回唯一连接的设备的序列号（无法确定时为None），未指定序列号的任务用它排队
+    """
+
+    def __init__(self, factory: Callable, log_dir: Path, max_running: int,
+                 resolve: Optional[Callable[[], Optional[str]]] = None):
+        self._factory = factory
+        self._resolve = resolve
+        self._log_dir = Path(log_dir)
+        self._log_dir.mkdir(parents=True, exist_ok=True)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queues: Dict[str, Deque[Job]] = {}
+        self._workers: Dict[str, threading.Thread] = {}
+        self._slots = threading.BoundedSemaphore(max(1, max_running))
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._prefix = time.strftime('%Y%m%d-%H%M%S')
+
+    def submit(self, script: str, serial: Optional[str], options: dict) -> Job:
+        # 未指定序列号的任务按唯一连接的设备的真实序列号排队并在该设备上执行，
+        # 与指定了同一序列号的任务共用队列；无法确定设备时共用默认队列
+        if not serial and self._resolve is not None:
+            serial = self._resolve()
+        with self._lock:
+            job_id = f"{self._prefix}-{next(self._ids)}"
+            job = Job(job_id, script, serial, options, self._log_dir / f"{job_id}.log", submitted=time.time())
+            self._jobs[job_id] = job
+            key = serial or ''
+            self._queues.setdefault(key, deque()).append(job)
+            if key not in self._workers:
+                worker = threading.Thread(target=self._drain, args=(key,), daemon=True,
+                                          name=f"afc-serve-{key or 'default'}")
+                self._workers[key] = worker
+                worker.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Tuple[bool, str]:
+        """取消排队中的任务；正在执行的任务无法中途停止"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False, "任务不存在"
+            if job.state != 'queued':
+                return False, f"任务状态为 {job.state}，只能取消排队中的任务"
+            self._queues[job.serial or ''].remove(job)
+            job.state = 'cancelled'
+            job.finished = time.time()
+        return True, ""
+
+    def _drain(self, key: str) -> None:
+        """一个序列号的工作线程：依次执行队列中的任务，队列为空时退出"""
+        while True:
+            with self._lock:
+                queue = self._queues.get(key)
+                if not queue:
+                    self._queues.pop(key, None)
+                    self._workers.pop(key, None)
+                    return
+                job = queue.popleft()
+                job.state = 'running'
+            with self._slots:
+                self._run(job)
+
+    def _run(self, job: Job) -> None:
+        router = install_router()
+        job.started = time.time()
+        success = False
+        with open(job.log_file, 'w', encoding='utf-8', buffering=1) as log:
+            router.bind(log)
+            try:
+                print(f"执行脚本: {job.script}" + (f"（设备 {job.serial}）" if job.serial else ""))
+                success = self._factory(job).execute_script()
+                print(f"\n{'✓ 脚本执行完成' if success else '✗ 脚本执行失败'}: {job.script}")
+            except Exception as e:
+                print(f"错误: 任务执行时发生异常 - {e}")
+                job.error = str(e)
+            finally:
+                router.unbind()
+        with self._lock:
+            job.finished = time.time()
+            job.state = 'succeeded' if success else 'failed'
+        mark = '✓' if success else '✗'
+        print(f"{mark} 任务 {job.id} 完成: {job.script}，用时 {job.finished - job.started:.1f}s")
+
+
+def parse_job(body: dict) -> Tuple[str, Optional[str], dict]:
+    """校验提交的任务，返回 (脚本绝对路径, 序列号, 选项)；格式错误时抛出ValueError"""
+    script = body.get('script')
+    if not isinstance(script, str) or not script:
+        raise ValueError("缺少script")
+    path = Path(script).resolve()
+    if not path.is_file():
+        raise ValueError(f"脚本文件不存在 - {script}")
+    serial = body.get('serial')
+    if serial is not None and not isinstance(serial, str):
+        raise ValueError("serial必须是字符串")
+    options = {}
+    for name, value in body.items():
+        if name in ('script', 'serial'):
+            continue
+        if name not in JOB_OPTIONS:
+            raise ValueError(f"未知的选项 {name}，可选: {', '.join(JOB_OPTIONS)}")
+        if not isinstance(value, JOB_OPTIONS[name]):
+            raise ValueError(f"选项 {name} 的类型不正确")
+        options[name] = value
+    return str(path), serial or None, options
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "AFC"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def scheduler(self) -> Scheduler:
+        return self.server.scheduler
+
+    def log_message(self, format: str, *args) -> None:
+        pass  # 任务的提交和完成已单独输出
+
+    def address_string(self) -> str:
+        # Unix socket的客户端地址为空字符串
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def _send_json(self, status: int, data) -> None:
+        body = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8') + b'\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int, message: str) -> None:
+        self._send_json(status, {'error': message})
+
+    def _route(self) -> Tuple[List[str], dict]:
+        url = urlparse(self.path)
+        return [part for part in url.path.split('/') if part], parse_qs(url.query)
+
+    def do_GET(self) -> None:
+        parts, query = self._route()
+        if parts == ['jobs']:
+            self._send_json(200, [job.to_dict() for job in self.scheduler.jobs()])
+            return
+        if len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.scheduler.get(parts[1])
+            if job is None:
+                self._error(404, "任务不存在")
+            elif len(parts) == 2:
+                self._send_json(200, job.to_dict())
+            elif parts[2] == 'log':
+                self._send_log(job, query)
+            else:
+                self._error(404, "未知的路径")
+            return
+        self._error(404, "未知的路径")
+
+    def do_POST(self) -> None:
+        parts, _ = self._route()
+        if parts != ['jobs']:
+            self._error(404, "未知的路径")
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self._error(413, "请求过大")
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError("请求体必须是JSON对象")
+            script, serial, options = parse_job(body)
+        except ValueError as e:
+            self._error(400, str(e))
+            return
+        job = self.scheduler.submit(script, serial, options)
+        print(f"收到任务 {job.id}: {script}" + (f"（设备 {job.serial}）" if job.serial else ""))
+        self._send_json(201, job.to_dict())
+
+    def do_DELETE(self) -> None:
+        parts, _ = self._route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            self._error(404, "未知的路径")
+            return
+        ok, message = self.scheduler.cancel(parts[1])
+        if ok:
+            self._send_json(200, self.scheduler.get(parts[1]).to_dict())
+        else:
+            self._error(404 if message == "任务不存在" else 409, message)
+
+    def _send_log(self, job: Job, query: dict) -> None:
+        """发送日志；follow时以chunked编码持续发送新内容，任务结束后关闭"""
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+        except ValueError:
+            self._error(400, "offset必须是整数")
+            return
+        follow = query.get('follow', ['0'])[0] not in ('0', '')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while True:
+                done = job.done
+                data = _read_from(job.log_file, offset)
+                if data:
+                    offset += len(data)
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+                if not follow or (done and not data):
+                    break
+                if not data:
+                    time.sleep(FOLLOW_INTERVAL)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def _read_from(path: Path, offset: int) -> bytes:
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+
+# socketserver只在支持AF_UNIX的平台上定义UnixStreamServer（Windows上没有）
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def parse_address(address: str) -> Tuple[str, object]:
+    """
+    'host:port' / 'port' -> ('tcp', (host, port))；'unix:/path' 或路径 -> ('unix', path)
+    格式错误或当前平台不支持Unix socket时抛出ValueError
+    """
+    if address.startswith('unix:') or '/' in address or os.sep in address:
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("当前系统不支持Unix socket，请使用 主机:端口")
+        return 'unix', address[len('unix:'):] if address.startswith('unix:') else address
+    host, _, port = address.rpartition(':')
+    try:
+        return 'tcp', (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise ValueError(f"端口必须是整数 - {port}")
+
+
+def _remove_socket(path: str) -> None:
+    """删除Unix socket文件；路径存在但不是socket时抛出OSError，不删除（防止地址写错删掉普通文件）"""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(f"{path} 已存在且不是socket文件")
+    os.unlink(path)
+
+
+def make_server(address: str, scheduler: Scheduler):
+    """创建HTTP服务（未启动）"""
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        _remove_socket(target)  # 上次未正常退出留下的socket文件
+        server = _UnixHTTPServer(target, _Handler)
+    else:
+        server = ThreadingHTTPServer(target, _Handler)
+        server.daemon_threads = True
+    server.scheduler = scheduler
+    return server
+
+
+def _interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(address: str, factory: Callable, jobs: int, log_dir: Path, warm: Optional[Callable] = None,
+          resolve: Optional[Callable[[], Optional[str]]] = None) -> bool:
+    """启动常驻服务，直到Ctrl+C"""
+    try:
+        kind, target = parse_address(address)
+    except ValueError as e:
+        print(f"错误: 无效的监听地址 {address} - {e}")
+        return False
+    install_router()
+    if warm is not None:
+        warm()
+    scheduler = Scheduler(factory, log_dir, jobs, resolve)
+    try:
+        server = make_server(address, scheduler)
+    except OSError as e:
+        print(f"错误: 无法监听 {address} - {e}")
+        return False
+    where = target if kind == 'unix' else f"http://{target[0]}:{target[1]}"
+    print(f"AFC服务已启动: {where}，同时执行的设备数: {jobs}，任务日志目录: {log_dir}")
+    if threading.current_thread() is threading.main_thread():
+        # 作为后台服务运行时通常收到SIGTERM而不是Ctrl+C
+        signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止服务...")
+    finally:
+        server.server_close()
+        if kind == 'unix':
+            try:
+                _remove_socket(target)
+            except OSError as e:
+                print(f"警告: 未删除socket文件 - {e}")
+    return True
@@ -0,0 +1,324 @@
+"""
+Android sparse镜像编解码
+- 对内存映射的raw镜像做FILL/DONT_CARE检测，按块流式生成sparse数据
+- 读取已有的sparse镜像时只解析chunk头，不展开数据
+- 按设备的max-download-size拆分成多个独立的sparse分片
+"""
+
+import mmap
+import struct
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+SPARSE_MAGIC = 0xED26FF3A
+FILE_HEADER = struct.Struct('<IHHHHIIII')
+CHUNK_HEADER = struct.Struct('<HHII')
+
+CHUNK_RAW = 0xCAC1
+CHUNK_FILL = 0xCAC2
+CHUNK_DONT_CARE = 0xCAC3
+CHUNK_CRC32 = 0xCAC4
+
+DEFAULT_BLOCK_SIZE = 4096
+WINDOW_SIZE = 64 * 1024 * 1024  # 分析/发送时每次处理的映射窗口
+IO_SIZE = 1024 * 1024  # 流式输出时每次读取的数据量
+
+
+class SparseError(Exception):
+    """sparse镜像格式错误"""
+
+
+@dataclass
+class Chunk:
+    """一个sparse chunk；RAW的数据位于源文件offset处，FILL为4字节填充值"""
+    type: int
+    blocks: int
+    offset: int = 0
+    fill: bytes = b''
+
+    def payload_size(self, block_size: int) -> int:
+        if self.type == CHUNK_RAW:
+            return self.blocks * block_size
+        if self.type == CHUNK_FILL:
+            return 4
+        return 0
+
+
+@dataclass
+class SparsePiece:
+    """一个可单独下载的sparse文件（覆盖整个分区，其余部分为DONT_CARE）"""
+    block_size: int
+    total_blocks: int
+    chunks: List[Chunk] = field(default_factory=list)
+
+    @property
+    def size(self) -> int:
+        return FILE_HEADER.size + sum(CHUNK_HEADER.size + c.payload_size(self.block_size)
+                                      for c in self.chunks)
+
+
+def _drop_pages(mm: mmap.mmap, start: int, end: int) -> None:
+    """处理完的窗口归还给内核，避免峰值RSS随镜像大小增长"""
+    if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+        start -= start % mmap.PAGESIZE
+        if end > start:
+            try:
+                mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+            except (OSError, ValueError):
+                pass
+
+
+def is_sparse(path: Path) -> bool:
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    return len(head) == 4 and struct.unpack('<I', head)[0] == SPARSE_MAGIC
+
+
+class SparseImage:
+    """sparse镜像的chunk表，数据仍留在源文件中"""
+
+    def __init__(self, source: Path, block_size: int, total_blocks: int, chunks: List[Chunk]):
+        self.source = Path(source)
+        self.block_size = block_size
+        self.total_blocks = total_blocks
+        self.chunks = chunks
+
+    @classmethod
+    def open(cls, path: Path, block_size: int = DEFAULT_BLOCK_SIZE,
+             zero_dont_care: bool = False) -> 'SparseImage':
+        """sparse镜像直接解析，raw镜像做块检测"""
+        if is_sparse(path):
+            return cls.from_sparse(path)
+        return cls.from_raw(path, block_size, zero_dont_care)
+
+    @classmethod
+    def from_sparse(cls, path: Path) -> 'SparseImage':
+        """解析已有sparse镜像的chunk头"""
+        with open(path, 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                raise SparseError("文件头不完整")
+            (magic, major, _minor, file_hdr_sz, chunk_hdr_sz,
+             block_size, total_blocks, total_chunks, _checksum) = FILE_HEADER.unpack(header)
+            if magic != SPARSE_MAGIC or major != 1:
+                raise SparseError("不是sparse镜像")
+            f.seek(file_hdr_sz)
+            chunks = []
+            for _ in range(total_chunks):
+                raw = f.read(chunk_hdr_sz)
+                if len(raw) < CHUNK_HEADER.size:
+                    raise SparseError("chunk头不完整")
+                chunk_type, _reserved, blocks, total_sz = CHUNK_HEADER.unpack(raw[:CHUNK_HEADER.size])
+                data_offset = f.tell()
+                data_size = total_sz - chunk_hdr_sz
+                if chunk_type == CHUNK_RAW:
+                    if data_size != blocks * block_size:
+                        raise SparseError("RAW chunk大小不匹配")
+                    chunks.append(Chunk(CHUNK_RAW, blocks, data_offset))
+                elif chunk_type == CHUNK_FILL:
+                    chunks.append(Chunk(CHUNK_FILL, blocks, fill=f.read(4)))
+                    data_size -= 4
+                elif chunk_type == CHUNK_DONT_CARE:
+                    chunks.append(Chunk(CHUNK_DONT_CARE, blocks))
+                elif chunk_type != CHUNK_CRC32:
+                    raise SparseError(f"未知的chunk类型: {chunk_type:#x}")
+                f.seek(data_size, 1)
+        if sum(c.blocks for c in chunks) != total_blocks:
+            raise SparseError("chunk块数与文件头不符")
+        return cls(path, block_size, total_blocks, chunks)
+
+    @classmethod
+    def from_raw(cls, path: Path, block_size: int = DEFAULT_BLOCK_SIZE,
+                 zero_dont_care: bool = False) -> 'SparseImage':
+        """
+        扫描raw镜像：整块相同的4字节模式记为FILL（zero_dont_care时全零记为DONT_CARE），
+        其余为RAW；相邻同类块合并为一个chunk
+        """
+        size = Path(path).stat().st_size
+        total_blocks = (size + block_size - 1) // block_size
+        chunks: List[Chunk] = []
+        if size == 0:
+            return cls(path, block_size, 0, chunks)
+
+        def add(chunk_type: int, offset: int, fill: bytes = b'') -> None:
+            last = chunks[-1] if chunks else None
+            if last and last.type == chunk_type and last.fill == fill:
+                last.blocks += 1
+            else:
+                chunks.append(Chunk(chunk_type, 1, offset, fill))
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            tail = size - block_size
+            for window in range(0, size, WINDOW_SIZE):
+                for offset in range(window, min(window + WINDOW_SIZE, size), block_size):
+                    if offset > tail:
+                        # 末尾不足一个块，按RAW处理（输出时补零）
+                        add(CHUNK_RAW, offset)
+                        continue
+                    head = mm[offset:offset + 4]
+                    # 首尾4字节不同的块一定不是FILL，绝大多数数据块在这里就能判定
+                    if head != mm[offset + block_size - 4:offset + block_size] or \
+                            mm[offset:offset + block_size] != head * (block_size // 4):
+                        add(CHUNK_RAW, offset)
+                    elif zero_dont_care and head == b'\0\0\0\0':
+                        add(CHUNK_DONT_CARE, offset)
+                    else:
+                        add(CHUNK_FILL, offset, head)
+                _drop_pages(mm, window, min(window + WINDOW_SIZE, size))
+        return cls(path, block_size, total_blocks, chunks)
+
+    @property
+    def sparse_size(self) -> int:
+        return SparsePiece(self.block_size, self.total_blocks, self.chunks).size
+
+    def split(self, max_size: int) -> List[SparsePiece]:
+        """拆分为每个不超过max_size字节的分片，分片之间用DONT_CARE补齐"""
+        overhead = FILE_HEADER.size + 2 * CHUNK_HEADER.size  # 文件头 + 前后两个DONT_CARE
+        if max_size < overhead + CHUNK_HEADER.size + self.block_size:
+            raise SparseError(f"max-download-size过小: {max_size}")
+        pieces: List[SparsePiece] = []
+        current: List[Chunk] = []
+        used = overhead
+        start_block = 0  # 当前分片第一个chunk对应的块号
+        block = 0  # 下一个待分配的块号
+
+        def finish() -> None:
+            nonlocal current, used, start_block
+            piece_chunks = []
+            if start_block:
+                piece_chunks.append(Chunk(CHUNK_DONT_CARE, start_block))
+            piece_chunks.extend(current)
+            if block < self.total_blocks:
+                piece_chunks.append(Chunk(CHUNK_DONT_CARE, self.total_blocks - block))
+            pieces.append(SparsePiece(self.block_size, self.total_blocks, piece_chunks))
+            current, used, start_block = [], overhead, block
+
+        for chunk in self.chunks:
+            remaining = Chunk(chunk.type, chunk.blocks, chunk.offset, chunk.fill)
+            while remaining.blocks:
+                need = CHUNK_HEADER.size + remaining.payload_size(self.block_size)
+                if used + need <= max_size:
+                    current.append(remaining)
+                    used += need
+                    block += remaining.blocks
+                    break
+                if remaining.type == CHUNK_RAW:
+                    # RAW chunk按块切开，先填满当前分片
+                    fit = (max_size - used - CHUNK_HEADER.size) // self.block_size
+                    if fit > 0:
+                        current.append(Chunk(CHUNK_RAW, fit, remaining.offset))
+                        block += fit
+                        remaining = Chunk(CHUNK_RAW, remaining.blocks - fit,
+                                          remaining.offset + fit * self.block_size)
+                if current:
+                    finish()
+                else:
+                    raise SparseError("chunk无法放入单个分片")
+        if current or not pieces:
+            finish()
+        return pieces
+
+    def iter_piece(self, piece: SparsePiece) -> Iterator[bytes]:
+        """按顺序产出分片的字节流，RAW数据从源文件映射中分段读取"""
+        header = FILE_HEADER.pack(SPARSE_MAGIC, 1, 0, FILE_HEADER.size, CHUNK_HEADER.size,
+                                  piece.block_size, piece.total_blocks, len(piece.chunks), 0)
+        source_is_raw = not is_sparse(self.source)
+        source_size = self.source.stat().st_size
+        with open(self.source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield header
+            for chunk in piece.chunks:
+                size = CHUNK_HEADER.size + chunk.payload_size(self.block_size)
+                yield CHUNK_HEADER.pack(chunk.type, 0, chunk.blocks, size)
+                if chunk.type == CHUNK_FILL:
+                    yield chunk.fill
+                elif chunk.type == CHUNK_RAW:
+                    start = chunk.offset
+                    end = start + chunk.blocks * self.block_size
+                    for pos in range(start, end, IO_SIZE):
+                        data = mm[pos:min(pos + IO_SIZE, end, source_size)]
+                        want = min(IO_SIZE, end - pos)
+                        if len(data) < want and source_is_raw:
+                            # raw镜像最后一个不完整的块补零
+                            data += b'\0' * (want - len(data))
+                        yield data
+                    _drop_pages(mm, start, min(end, source_size))
+
+
+class ChunkStream:
+    """把字节块迭代器包装成带read()的只读流，供download使用"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        """返回不超过size字节的数据（可能少于size），读完时返回空串"""
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return b''
+        if size < 0 or size >= len(self._buffer):
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def split_stream(size: int, max_size: int, block_size: int = DEFAULT_BLOCK_SIZE) -> List[SparsePiece]:
+    """
+    把只能顺序读取的raw数据流（如边解压边发送的镜像）拆分为sparse分片
+    分片只含RAW和DONT_CARE，大小在读取数据之前即可确定
+    """
+    overhead = FILE_HEADER.size + 3 * CHUNK_HEADER.size
+    span = (max_size - overhead) // block_size
+    if span <= 0:
+        raise SparseError(f"max-download-size过小: {max_size}")
+    total_blocks = (size + block_size - 1) // block_size
+    pieces = []
+    for start in range(0, total_blocks, span):
+        count = min(span, total_blocks - start)
+        chunks = [Chunk(CHUNK_DONT_CARE, start)] if start else []
+        chunks.append(Chunk(CHUNK_RAW, count, start * block_size))
+        if start + count < total_blocks:
+            chunks.append(Chunk(CHUNK_DONT_CARE, total_blocks - start - count))
+        pieces.append(SparsePiece(block_size, total_blocks, chunks))
+    return pieces
+
+
+def iter_stream_piece(piece: SparsePiece, stream: BinaryIO) -> Iterator[bytes]:
+    """产出split_stream分片的字节流，RAW数据从stream顺序读取，数据结束后补零到整块"""
+    yield FILE_HEADER.pack(SPARSE_MAGIC, 1, 0, FILE_HEADER.size, CHUNK_HEADER.size,
+                           piece.block_size, piece.total_blocks, len(piece.chunks), 0)
+    for chunk in piece.chunks:
+        yield CHUNK_HEADER.pack(chunk.type, 0, chunk.blocks,
+                                CHUNK_HEADER.size + chunk.payload_size(piece.block_size))
+        if chunk.type != CHUNK_RAW:
+            continue
+        remaining = chunk.blocks * piece.block_size
+        while remaining:
+            data = stream.read(min(IO_SIZE, remaining))
+            if not data:
+                data = b'\0' * min(IO_SIZE, remaining)
+            remaining -= len(data)
+            yield data
+
+
+def write_sparse(image: SparseImage, out: BinaryIO) -> int:
+    """把整个镜像写成单个sparse文件，返回写入字节数"""
+    piece = SparsePiece(image.block_size, image.total_blocks, image.chunks)
+    written = 0
+    for data in image.iter_piece(piece):
+        out.write(data)
+        written += len(data)
+    return written
+
+
+def open_pieces(path: Path, max_size: int) -> Optional[Tuple[SparseImage, List[SparsePiece]]]:
+    """镜像超过max_size时返回 (镜像, 拆分后的分片)，否则返回None（整个文件直接发送）"""
+    path = Path(path)
+    if path.stat().st_size <= max_size:
+        return None
+    image = SparseImage.open(path)
+    return image, image.split(max_size)
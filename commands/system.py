@@ -1,6 +1,8 @@
 import time
 import os
 
+from commands.manifest import manifest_for
+
 def reboot_device(executor, target: str = "") -> bool:
     """重启设备"""
     if target.upper() == "BOOTLOADER":
@@ -49,12 +51,20 @@ def clear_screen(executor) -> bool:
         print(f"清屏时出错: {e}")
         return False
 
+def _forget(executor, partition: str) -> None:
+    """分区内容被改变，作废该设备的刷写记录"""
+    manifest = manifest_for(executor)
+    if manifest is not None:
+        manifest.forget(partition)
+
 def erase_partition(executor, partition: str) -> bool:
     """擦除分区"""
+    _forget(executor, partition)
     return executor.run_fastboot_command(['erase', partition])
 
 def format_partition(executor, partition: str, fs_type: str = "ext4") -> bool:
     """格式化分区"""
+    _forget(executor, partition)
     return executor.run_fastboot_command(['format', f'--fs={fs_type}', partition])
 
 def oem_command(executor, command: str) -> bool:
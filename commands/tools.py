@@ -0,0 +1,170 @@
+"""
+外部工具注册表
+每个工具在进程内只解析一次并缓存结果；tools目录的文件索引持久化到状态目录，按目录mtime失效，
+避免每次调用fastboot/adb/SPFlashTool都递归扫描tools（Mbin下有大量文件）
+- 优先使用当前平台的工具目录 tools/linux、tools/windows、tools/macos，其次为tools根目录
+- 环境变量 AFC_<工具名>_PATH 可直接指定工具路径，如 AFC_FASTBOOT_PATH=/usr/bin/fastboot
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+INDEX_VERSION = 1
+
+PLATFORM_DIRS = {'win32': 'windows', 'cygwin': 'windows', 'darwin': 'macos'}
+
+
+def platform_dir_name(platform: str = sys.platform) -> str:
+    return PLATFORM_DIRS.get(platform, 'linux')
+
+
+def tool_extensions(platform: str = sys.platform) -> List[str]:
+    """按优先级排列的扩展名，空字符串表示无扩展名"""
+    if platform_dir_name(platform) == 'windows':
+        return ['.exe', '.bat', '.cmd', '']
+    return ['', '.exe', '.bat', '.cmd']
+
+
+def override_var(tool_name: str) -> str:
+    return f"AFC_{re.sub(r'[^0-9A-Za-z]', '_', tool_name).upper()}_PATH"
+
+
+class ToolRegistry:
+    """解析并缓存tools目录中的工具路径"""
+
+    def __init__(self, tools_dir: Path, index_file: Optional[Path] = None, platform: str = sys.platform):
+        self.tools_dir = Path(tools_dir)
+        self.index_file = index_file
+        self.platform = platform
+        self._resolved: Dict[str, Optional[Path]] = {}
+        self._files: Optional[List[str]] = None  # tools目录下所有文件的相对路径（/分隔，已排序）
+        self._lock = threading.Lock()
+
+    def find(self, tool_name: str) -> Optional[Path]:
+        """查找工具，没找到时返回None（结果会被缓存）"""
+        try:
+            return self._resolved[tool_name]
+        except KeyError:
+            pass
+        with self._lock:
+            if tool_name not in self._resolved:
+                self._resolved[tool_name] = self._resolve(tool_name)
+            return self._resolved[tool_name]
+
+    def invalidate(self) -> None:
+        """清空缓存，下次查找时重新索引"""
+        with self._lock:
+            self._resolved.clear()
+            self._files = None
+
+    def _resolve(self, tool_name: str) -> Optional[Path]:
+        override = os.environ.get(override_var(tool_name))
+        if override:
+            path = Path(override)
+            if path.is_file():
+                return path
+            print(f"警告: {override_var(tool_name)} 指定的工具不存在 - {override}")
+
+        path = self._lookup(tool_name, self._index())
+        if path is not None and not path.is_file():
+            # 深层目录的变化不会更新tools目录的mtime，索引过期时重建一次
+            path = self._lookup(tool_name, self._index(rebuild=True))
+        return path
+
+    def _lookup(self, tool_name: str, files: List[str]) -> Optional[Path]:
+        file_set = set(files)
+        roots = [platform_dir_name(self.platform) + '/', '']
+        # 平台目录和根目录下的同名工具
+        for root in roots:
+            for ext in tool_extensions(self.platform):
+                if f"{root}{tool_name}{ext}" in file_set:
+                    return self.tools_dir / f"{root}{tool_name}{ext}"
+        # 子目录中以工具名开头的文件，平台目录优先
+        other_platforms = {f"{name}/" for name in set(PLATFORM_DIRS.values()) | {'linux'}} - {roots[0]}
+        candidates = [rel for rel in files
+                      if rel.rsplit('/', 1)[-1].startswith(tool_name)
+                      and not any(rel.startswith(prefix) for prefix in other_platforms)]
+        candidates.sort(key=lambda rel: (not rel.startswith(roots[0]), rel.count('/'), rel))
+        return self.tools_dir / candidates[0] if candidates else None
+
+    def _index(self, rebuild: bool = False) -> List[str]:
+        if self._files is not None and not rebuild:
+            return self._files
+        key = self._index_key()
+        if not rebuild:
+            cached = self._load_index(key)
+            if cached is not None:
+                self._files = cached
+                return cached
+        self._files = self._scan()
+        self._save_index(key, self._files)
+        return self._files
+
+    def _index_key(self) -> List[Tuple[str, int]]:
+        """tools目录及其直接子目录的mtime"""
+        key = []
+        try:
+            key.append(('', os.stat(self.tools_dir).st_mtime_ns))
+            with os.scandir(self.tools_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        key.append((entry.name, entry.stat().st_mtime_ns))
+        except OSError:
+            return []
+        return sorted(key)
+
+    def _scan(self) -> List[str]:
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.tools_dir):
+            rel_dir = os.path.relpath(dirpath, self.tools_dir).replace(os.sep, '/')
+            prefix = '' if rel_dir == '.' else rel_dir + '/'
+            files.extend(prefix + name for name in filenames)
+        return sorted(files)
+
+    def _load_index(self, key) -> Optional[List[str]]:
+        if self.index_file is None or not key:
+            return None
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (data.get('version') != INDEX_VERSION or data.get('tools_dir') != str(self.tools_dir)
+                or [tuple(item) for item in data.get('key', [])] != key):
+            return None
+        return data.get('files')
+
+    def _save_index(self, key, files: List[str]) -> None:
+        if self.index_file is None or not key:
+            return
+        data = {'version': INDEX_VERSION, 'tools_dir': str(self.tools_dir), 'key': key, 'files': files}
+        try:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_file.with_name(f"{self.index_file.name}.{os.getpid()}.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.index_file)
+        except OSError:
+            pass
+
+
+_REGISTRIES: Dict[Tuple[str, str], ToolRegistry] = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_tool_registry(tools_dir: Path, state_dir: Optional[Path] = None) -> ToolRegistry:
+    """进程内共享的工具注册表，多设备并行执行时只索引一次"""
+    key = (str(tools_dir), str(state_dir))
+    registry = _REGISTRIES.get(key)
+    if registry is None:
+        with _REGISTRIES_LOCK:
+            registry = _REGISTRIES.get(key)
+            if registry is None:
+                index_file = Path(state_dir) / "tool_index.json" if state_dir is not None else None
+                registry = _REGISTRIES[key] = ToolRegistry(Path(tools_dir), index_file)
+    return registry
@@ -0,0 +1,237 @@
+"""
+执行过程的计时、追踪与指标导出
+- 记录每行脚本、每次外部工具调用的耗时、传输字节数、进程启动延迟和退出状态（按设备区分）
+- 导出Chrome trace-event格式的JSON（chrome://tracing / Perfetto 可直接打开）和Prometheus文本指标
+- 未启用时span为共享的空对象，调试输出在格式化之前就返回，几乎没有开销
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class _NullSpan:
+    """未启用追踪时使用的空span"""
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+    def set(self, **args) -> None:
+        pass
+
+    def add_bytes(self, count: int) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """一段被计时的操作"""
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, device: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.device = device
+        self.args = args
+        self.bytes = 0
+        self.start = 0.0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        end = time.perf_counter()
+        self.tracer._pop(self)
+        if exc_type is not None:
+            self.args.setdefault('status', 'error')
+            self.args['error'] = str(exc)
+        self.tracer._finish(self, end)
+        return False
+
+    def set(self, **args) -> None:
+        self.args.update(args)
+
+    def add_bytes(self, count: int) -> None:
+        self.bytes += count
+
+
+class Tracer:
+    """进程内共享的追踪器，多个设备（线程）可同时写入"""
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self._events: List[dict] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._devices: Dict[str, int] = {}
+        # 指标：(指标名, 标签元组) -> 值
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = defaultdict(float)
+
+    def span(self, name: str, category: str, device: Optional[str] = None, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, device or 'local', args)
+
+    def add_bytes(self, count: int) -> None:
+        """把传输字节数记到当前线程所有未结束的span上"""
+        if not self.enabled:
+            return
+        for span in getattr(self._local, 'stack', ()):
+            span.add_bytes(count)
+
+    def instant(self, name: str, device: Optional[str] = None, **args) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._events.append({
+                'name': name, 'cat': 'log', 'ph': 'i', 's': 't',
+                'ts': (time.perf_counter() - self.origin) * 1e6,
+                'pid': self._device_pid(device or 'local'), 'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def _push(self, span: Span) -> None:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(span)
+
+    def _pop(self, span: Span) -> None:
+        stack = self._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def _device_pid(self, device: str) -> int:
+        # 调用方持有锁
+        if device not in self._devices:
+            self._devices[device] = len(self._devices) + 1
+        return self._devices[device]
+
+    def _finish(self, span: Span, end: float) -> None:
+        duration = end - span.start
+        args = dict(span.args)
+        if span.bytes:
+            args['bytes'] = span.bytes
+        status = str(args.get('status', 'ok'))
+        with self._lock:
+            self._events.append({
+                'name': span.name, 'cat': span.category, 'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6, 'dur': duration * 1e6,
+                'pid': self._device_pid(span.device), 'tid': threading.get_ident(),
+                'args': args,
+            })
+            labels = [('device', span.device)]
+            if span.category == 'step':
+                labels.append(('command', str(args.get('command', span.name))))
+            elif span.category == 'tool':
+                labels.append(('tool', span.name))
+            key = tuple(labels)
+            self._counters[(f'afc_{span.category}_duration_seconds_sum', key)] += duration
+            self._counters[(f'afc_{span.category}_duration_seconds_count', key)] += 1
+            if status != 'ok':
+                self._counters[(f'afc_{span.category}_failures_total', key)] += 1
+            if span.bytes and span.category == 'step':
+                self._counters[('afc_bytes_transferred_total', (('device', span.device),))] += span.bytes
+            if 'spawn_latency' in args:
+                self._counters[('afc_tool_spawn_seconds_sum', key)] += args['spawn_latency']
+                self._counters[('afc_tool_spawn_seconds_count', key)] += 1
+
+    def write_chrome_trace(self, path: str) -> None:
+        with self._lock:
+            events = list(self._events)
+            devices = dict(self._devices)
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': device}}
+                    for device, pid in devices.items()]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+
+    def write_prometheus(self, path: str) -> None:
+        with self._lock:
+            counters = dict(self._counters)
+        # *_sum/*_count 合并为summary，*_total为counter
+        families: Dict[str, List[Tuple[str, Tuple[Tuple[str, str], ...], float]]] = defaultdict(list)
+        for (metric, labels), value in counters.items():
+            family = metric
+            for suffix in ('_sum', '_count'):
+                if metric.endswith(suffix):
+                    family = metric[:-len(suffix)]
+            families[family].append((metric, labels, value))
+        lines = []
+        for family in sorted(families):
+            metric_type = 'counter' if family.endswith('_total') else 'summary'
+            lines.append(f"# TYPE {family} {metric_type}")
+            for metric, labels, value in sorted(families[family]):
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+                lines.append(f"{metric}{{{label_text}}} {value:.9g}")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class DebugLog:
+    """调试输出：未启用时在格式化参数之前返回"""
+
+    def __init__(self, tracer: Tracer, device: Optional[str] = None):
+        self.tracer = tracer
+        self.device = device
+        self.enabled = False
+
+    def __call__(self, message: str, *args) -> None:
+        if not self.enabled:
+            return
+        if args:
+            message = message % args
+        print(f"[DEBUG] {message}")
+        self.tracer.instant(message, self.device)
+
+
+class StartupTimings:
+    """--timings：各启动阶段的耗时，以及导入了哪些命令模块"""
+
+    def __init__(self, origin: float):
+        self.origin = origin
+        self._last = origin
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, name: str, at: Optional[float] = None) -> None:
+        """记录从上一个阶段结束到现在（或at）的耗时"""
+        now = time.perf_counter() if at is None else at
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self, out=None) -> None:
+        out = out or sys.stderr
+        # 中文按两个字符宽度对齐
+        display = lambda name: sum(2 if ord(c) > 0x7f else 1 for c in name)
+        rows = self.phases + [('总计', self._last - self.origin)]
+        width = max(display(name) for name, _ in rows)
+        print("启动耗时:", file=out)
+        for name, seconds in rows:
+            print(f"  {name}{' ' * (width - display(name))}  {seconds * 1000:8.1f} ms", file=out)
+        modules = sorted(name[len('commands.'):] for name in sys.modules if name.startswith('commands.'))
+        print(f"  已导入的commands模块({len(modules)}): {', '.join(modules)}", file=out)
+
+
+TRACER = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """进程内共享的追踪器（默认未启用）"""
+    return TRACER
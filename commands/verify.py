@@ -0,0 +1,246 @@
+"""
+镜像校验
+VERIFY(清单)：按校验清单在线程池中并行检查所有镜像的大小、SHA-256和AVB结构，汇总报告失败的分区
+FLASH_ALL在 --verify 模式下先做同样的预检，全部通过才开始写入；通过fastboot协议刷写时，
+SHA-256在发送数据的同一次读取中计算，与清单一致才发送flash命令，不额外读盘
+压缩镜像（*.img.xz等）在预检时解压一遍，大小、SHA-256和AVB按解压后的数据检查，清单中的值也可以是压缩文件本身的
+清单格式：
+- sha256sum输出：每行 "<sha256>  <文件名>"
+- JSON：{"images": {"boot.img": {"sha256": "...", "size": 123}}}
+"""
+
+import json
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 在刷写目录中自动查找的清单文件名
+MANIFEST_NAMES = ['SHA256SUMS', 'sha256sums.txt', 'checksums.sha256', 'manifest.json']
+
+AVB_FOOTER = struct.Struct('>4sII QQQ 28x')  # magic, 版本major/minor, 原始镜像大小, vbmeta偏移, vbmeta大小
+AVB_HEADER = struct.Struct('>4sII QQ')  # magic, libavb版本major/minor, 认证数据块大小, 辅助数据块大小
+AVB_HEADER_SIZE = 256
+AVB_TAIL = 1024 * 1024  # 压缩镜像解压时保留的末尾数据，用于检查AVB footer和其后的vbmeta头
+
+
+@dataclass
+class Expected:
+    """清单中的一项"""
+    name: str
+    sha256: Optional[str] = None
+    size: Optional[int] = None
+
+
+@dataclass
+class VerifyResult:
+    """单个镜像的校验结果"""
+    name: str
+    path: Path
+    ok: bool = True
+    size: Optional[int] = None
+    sha256: Optional[str] = None
+    avb: str = ""
+    errors: Tuple[str, ...] = ()
+
+    def fail(self, message: str) -> None:
+        self.ok = False
+        self.errors = self.errors + (message,)
+
+
+def load_checksums(path: Path) -> Dict[str, Expected]:
+    """读取校验清单，返回 文件名 -> 期望值"""
+    text = Path(path).read_text(encoding='utf-8')
+    entries: Dict[str, Expected] = {}
+    if text.lstrip().startswith('{'):
+        data = json.loads(text)
+        for name, item in data.get('images', {}).items():
+            entries[name] = Expected(name, item.get('sha256'), item.get('size'))
+        return entries
+    for line_num, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 1)
+        if len(parts) != 2 or len(parts[0]) != 64:
+            raise ValueError(f"第{line_num}行格式不正确 - {line}")
+        name = parts[1].lstrip('*').replace('\\', '/')
+        entries[name] = Expected(name, parts[0].lower())
+    return entries
+
+
+def find_checksums(directory: Path) -> Optional[Path]:
+    for name in MANIFEST_NAMES:
+        if (directory / name).is_file():
+            return directory / name
+    return None
+
+
+def lookup(entries: Dict[str, Expected], name: str) -> Optional[Expected]:
+    """按相对路径查找，找不到时按文件名查找"""
+    if name in entries:
+        return entries[name]
+    base = name.rsplit('/', 1)[-1]
+    matches = [e for key, e in entries.items() if key.rsplit('/', 1)[-1] == base]
+    return matches[0] if len(matches) == 1 else None
+
+
+def check_avb(path: Path, size: int) -> Tuple[bool, str]:
+    """检查vbmeta镜像头或镜像末尾的AVB footer，返回 (是否有效, 说明)"""
+    with open(path, 'rb') as f:
+        def read_at(offset: int, length: int) -> bytes:
+            f.seek(offset)
+            return f.read(length)
+        return _check_avb(read_at, size)
+
+
+def _check_avb(read_at: Callable[[int, int], Optional[bytes]], size: int) -> Tuple[bool, str]:
+    """read_at(偏移, 长度) 返回镜像中的数据，数据不可用（压缩镜像只保留了首尾）时返回None"""
+    from commands.sparse import SPARSE_MAGIC
+
+    head = read_at(0, AVB_HEADER.size)
+    if head[:4] == b'AVB0':
+        return _check_vbmeta(head, 0, size, "vbmeta")
+    if len(head) >= 4 and struct.unpack('<I', head[:4])[0] == SPARSE_MAGIC:
+        return True, "sparse"
+    if size < AVB_FOOTER.size:
+        return True, "无AVB"
+    footer = read_at(size - AVB_FOOTER.size, AVB_FOOTER.size)
+    if footer[:4] != b'AVBf':
+        return True, "无AVB"
+    _magic, _major, _minor, original_size, vbmeta_offset, vbmeta_size = AVB_FOOTER.unpack(footer)
+    if original_size > size or vbmeta_offset + vbmeta_size > size or vbmeta_size < AVB_HEADER_SIZE:
+        return False, "AVB footer中的偏移超出镜像范围"
+    header = read_at(vbmeta_offset, AVB_HEADER.size)
+    if header is None:
+        return True, "AVB footer"  # vbmeta头不在保留的数据中，只检查了footer
+    return _check_vbmeta(header, vbmeta_offset, size, "footer")
+
+
+def _read_source(source) -> Tuple[int, str, Callable[[int, int], Optional[bytes]]]:
+    """解压一遍压缩/打包的镜像，返回 (大小, SHA-256, 读取首尾数据的read_at)"""
+    from commands.image_source import READ_SIZE, PipelineReader
+
+    head = b''
+    tail = bytearray()
+    size = 0
+    with PipelineReader(source.open()) as reader:
+        while True:
+            data = reader.read(READ_SIZE)
+            if not data:
+                break
+            if len(head) < AVB_HEADER.size:
+                head += data[:AVB_HEADER.size - len(head)]
+            tail += data
+            if len(tail) > AVB_TAIL:
+                del tail[:len(tail) - AVB_TAIL]
+            size += len(data)
+        digest = reader.hexdigest()
+
+    def read_at(offset: int, length: int) -> Optional[bytes]:
+        if offset + length <= len(head):
+            return head[offset:offset + length]
+        start = size - len(tail)
+        if offset >= start:
+            return bytes(tail[offset - start:offset - start + length])
+        return None
+    return size, digest, read_at
+
+
+def _check_vbmeta(header: bytes, offset: int, size: int, kind: str) -> Tuple[bool, str]:
+    if len(header) < AVB_HEADER.size or header[:4] != b'AVB0':
+        return False, f"AVB {kind}: vbmeta头无效"
+    _magic, major, _minor, auth_size, aux_size = AVB_HEADER.unpack(header)
+    if major != 1:
+        return False, f"AVB {kind}: 不支持的libavb版本 {major}"
+    if offset + AVB_HEADER_SIZE + auth_size + aux_size > size:
+        return False, f"AVB {kind}: vbmeta数据块超出镜像范围"
+    return True, f"AVB {kind}"
+
+
+def verify_image(name: str, path: Path, expected: Optional[Expected], check_hash: bool = True,
+                 source=None) -> VerifyResult:
+    """
+    校验单个镜像；check_hash为False时只检查大小和AVB（哈希在刷写时计算）
+    source为压缩/打包镜像的ImageSource时，按解压后的数据检查（清单中的值也可以是压缩文件本身的）
+    """
+    from commands.image_cache import mmap_sha256
+    from commands.image_source import ImageSourceError
+
+    result = VerifyResult(name, path)
+    try:
+        file_size = path.stat().st_size
+    except OSError:
+        result.fail("文件不存在")
+        return result
+    try:
+        if source is not None:
+            result.size, result.sha256, read_at = _read_source(source)
+            ok, message = _check_avb(read_at, result.size)
+        else:
+            result.size = file_size
+            ok, message = check_avb(path, result.size)
+    except (OSError, zipfile.BadZipFile, ImageSourceError) as e:
+        result.fail(f"读取失败 - {e}")
+        return result
+    if expected is None:
+        result.fail("清单中没有该镜像")
+    elif expected.size is not None and expected.size not in (result.size, file_size):
+        result.fail(f"大小不符: {result.size} != {expected.size}")
+    result.avb = message if ok else "无效"
+    if not ok:
+        result.fail(message)
+    if check_hash and expected is not None and expected.sha256:
+        try:
+            if result.sha256 is None:
+                result.sha256 = mmap_sha256(path)
+            if result.sha256 != expected.sha256 and source is not None and mmap_sha256(path) == expected.sha256:
+                return result  # 清单中是压缩文件本身的哈希
+        except OSError as e:
+            result.fail(f"读取失败 - {e}")
+            return result
+        if result.sha256 != expected.sha256:
+            result.fail(f"SHA-256不符: {result.sha256[:12]} != {expected.sha256[:12]}")
+    return result
+
+
+def verify_images(items: List[tuple], workers: int = 4) -> List[VerifyResult]:
+    """并行校验 (名称, 路径, 期望值, 是否计算哈希[, 压缩镜像的来源]) 列表，结果顺序与输入一致"""
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as pool:
+        return list(pool.map(lambda item: verify_image(*item), items))
+
+
+def print_report(results: List[VerifyResult]) -> bool:
+    """打印校验报告，全部通过时返回True"""
+    print(f"{'镜像':<28} {'大小':>12}  {'SHA-256':<14} {'AVB':<12} 结果")
+    for r in results:
+        size = f"{r.size / 1024 / 1024:.1f} MB" if r.size is not None else "-"
+        digest = r.sha256[:12] if r.sha256 else "(刷写时)" if r.ok else "-"
+        status = "✓" if r.ok else "✗ " + "; ".join(r.errors)
+        print(f"{r.name:<28} {size:>12}  {digest:<14} {r.avb or '-':<12} {status}")
+    failed = [r.name for r in results if not r.ok]
+    if failed:
+        print(f"校验失败 {len(failed)}/{len(results)}: {', '.join(failed)}")
+    else:
+        print(f"校验通过 {len(results)}/{len(results)}")
+    return not failed
+
+
+def verify(executor, manifest: str) -> bool:
+    """按校验清单并行检查清单中的所有镜像（路径相对于清单所在目录）"""
+    manifest_path = executor.script_dir / manifest
+    try:
+        entries = load_checksums(manifest_path)
+    except (OSError, ValueError) as e:
+        print(f"错误: 无法读取校验清单 {manifest_path} - {e}")
+        return False
+    if not entries:
+        print(f"错误: 校验清单为空 - {manifest_path}")
+        return False
+    base = manifest_path.parent
+    items = [(name, base / name, expected, True) for name, expected in entries.items()]
+    return print_report(verify_images(items))
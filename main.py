@@ -6,23 +6,57 @@ Fastboot脚本执行器 - 模块化版本
 直接调用项目目录中的工具
 """
 
+import time
+
+_STARTED = time.perf_counter()  # --timings 从这里开始计时（包括下面的导入）
+
 import os
 import sys
 import re
-import subprocess
-import time
-import importlib
-import inspect
+import argparse
+import copy
+import threading
+from contextlib import nullcontext
+from dataclasses import replace
+from functools import partial
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict, List, Callable, Any, Optional
 
+from commands.console import install_router
+from commands.device_lock import HOST_COMMANDS, device_lock
+from commands.journal import Journal, journal_path, read_journal
+from commands.registry import get_command_registry
+from commands.runner import run_streaming
+from commands.script_plan import ArgTemplate, Plan, Step, load_plan, split_arguments
+from commands.tools import get_tool_registry
+from commands.trace import DebugLog, StartupTimings, get_tracer
+
+# 各类外部工具默认的无输出超时（秒），SPFlashTool在DA握手等阶段可能长时间无输出
+DEFAULT_TIMEOUTS = {'fastboot': 60.0, 'adb': 60.0, 'cmd': 60.0, 'spflashtool': 300.0, 'edl': 60.0}
+
+# 尚未查询唯一设备的序列号（查询结果可能是None：没有设备或有多台设备）
+_UNRESOLVED: Any = object()
+
+
+def default_state_dir() -> Path:
+    """状态目录（刷写记录、哈希缓存等），可用AFC_STATE_DIR指定"""
+    return Path(os.environ.get('AFC_STATE_DIR', Path(__file__).parent / ".afc"))
+
 class FastbootExecutor:
-    def __init__(self, script_file: str):
+    def __init__(self, script_file: str, serial: Optional[str] = None):
         self.script_file = Path(script_file)
         self.script_dir = self.script_file.parent
         self.commands: Dict[str, Callable] = {}
         self.variables: Dict[str, str] = {}
-        self.debug_mode = False  # 调试模式标志
+        self.serial = serial  # 目标设备序列号，None表示使用唯一连接的设备
+        self._device_serial: Optional[str] = _UNRESOLVED  # serial为None时解析出的唯一设备的序列号，见device_serial()
+        
+        # 计时/追踪（默认关闭）与调试输出
+        self.tracer = get_tracer()
+        self.debug = DebugLog(self.tracer, serial)
+        # 默认通过adb server协议直接执行adb命令，AFC_NATIVE_ADB=0时总是调用adb程序
+        self.native_adb = os.environ.get('AFC_NATIVE_ADB', '1') != '0'
         
         # 项目根目录（main.py所在目录）
         self.project_root = Path(__file__).parent
@@ -30,312 +64,211 @@ class FastbootExecutor:
         # 工具目录
         self.tools_dir = self.project_root / "tools"
         
+        # 状态目录（刷写记录、哈希缓存等），可用AFC_STATE_DIR指定
+        self.state_dir = default_state_dir()
+        self.incremental = False  # 增量模式：跳过与上次刷写内容相同的分区
+        self.image_cache = None  # 按内容寻址的镜像库（--image-cache），见commands/image_cache.py
+        self.verify_manifest: Optional[str] = None  # --verify：FLASH_ALL刷写前按校验清单校验，'auto'表示在刷写目录中查找
+        
+        # 各工具的无输出超时（秒）
+        self.timeouts: Dict[str, float] = dict(DEFAULT_TIMEOUTS)
+        
+        # 脚本并发执行的状态：失败的 (行号, 命令)、后台任务、并行分支的输出标签
+        self.failures: List[tuple] = []
+        self._background: Dict[str, tuple] = {}
+        self._background_lock = threading.Lock()
+        self._output_tag: Optional[tuple] = None
+        
+        # 执行记录（断点续刷），见commands/journal.py；resume为True时从上次未完成的步骤继续
+        self.resume = False
+        self.journal: Optional[Journal] = None
+        self.current_line: Optional[int] = None
+        self.timings: Optional[StartupTimings] = None  # --timings
+        
         # 自动加载命令
         self.load_commands()
     
+    @property
+    def debug_mode(self) -> bool:
+        """调试模式标志"""
+        return self.debug.enabled
+    
+    @debug_mode.setter
+    def debug_mode(self, value: bool) -> None:
+        self.debug.enabled = value
+    
     def load_commands(self):
-        """自动加载commands目录下的所有命令"""
-        commands_dir = Path(__file__).parent / "commands"
-        
-        # 确保commands目录存在
-        if not commands_dir.exists():
-            print(f"警告: commands目录不存在 - {commands_dir}")
-            return
-        
-        # 读取命令注册文件
-        commands_file = commands_dir / "custom_commands.txt"
-        if commands_file.exists():
-            with open(commands_file, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        parts = [part.strip() for part in line.split(':')]
-                        if len(parts) == 2:
-                            # 格式: 模块名:函数名
-                            module_name, function_name = parts
-                            command_name = function_name.upper()
-                            self.load_command(module_name, function_name, command_name)
-                        elif len(parts) == 3:
-                            # 格式: 模块名:函数名:命令别名
-                            module_name, function_name, command_name = parts
-                            self.load_command(module_name, function_name, command_name.upper())
-                        else:
-                            print(f"错误: 第{line_num}行格式不正确 - {line}")
-        else:
-            print(f"警告: 命令注册文件不存在 - {commands_file}")
-        
+        """把命令注册表绑定到当前执行器（注册表在进程内只解析一次，命令模块在第一次使用时导入）"""
+        self.commands = {name: partial(func, self) for name, func in self.command_table(self.state_dir).items()}
         print(f"已加载 {len(self.commands)} 个命令: {', '.join(sorted(self.commands.keys()))}")
     
-    def load_command(self, module_name: str, function_name: str, command_name: str):
-        """加载单个命令"""
-        try:
-            # 导入模块
-            module = importlib.import_module(f"commands.{module_name}")
-            
-            # 获取函数
-            if hasattr(module, function_name):
-                command_func = getattr(module, function_name)
-                
-                # 检查函数签名，确保第一个参数是executor
-                sig = inspect.signature(command_func)
-                params = list(sig.parameters.keys())
-                if params and params[0] == 'executor':
-                    # 使用偏函数绑定executor参数
-                    from functools import partial
-                    bound_func = partial(command_func, self)
-                    
-                    # 注册命令
-                    self.commands[command_name] = bound_func
-                    if self.debug_mode:
-                        print(f"[DEBUG] 加载命令: {command_name} (来自 {module_name}.{function_name})")
-                else:
-                    print(f"✗ 函数签名错误: {module_name}.{function_name} 第一个参数必须是 'executor'")
-            else:
-                print(f"✗ 未找到函数: {module_name}.{function_name}")
-                
-        except ImportError as e:
-            print(f"✗ 导入模块失败 {module_name}: {e}")
-        except Exception as e:
-            print(f"✗ 加载命令失败 {module_name}.{function_name}: {e}")
+    @staticmethod
+    def command_table(state_dir: Optional[Path] = None) -> Dict[str, Callable]:
+        """命令名 -> 未绑定的命令（commands/registry.py 中的惰性命令）；注册文件修改后重新解析"""
+        commands_file = Path(__file__).parent / "commands" / "custom_commands.txt"
+        return get_command_registry(commands_file, state_dir or default_state_dir()).commands()
     
     def _find_tool(self, tool_name: str) -> Optional[Path]:
-        """在工具目录中查找工具"""
-        # 可能的工具扩展名
-        extensions = ['.exe', '.bat', '.cmd', '']  # 空字符串表示无扩展名
-        
-        for ext in extensions:
-            tool_path = self.tools_dir / f"{tool_name}{ext}"
-            if tool_path.exists():
-                return tool_path
-        
-        # 如果没有找到，尝试在工具目录的子目录中查找
-        for item in self.tools_dir.rglob(f"{tool_name}*"):
-            if item.is_file():
-                return item
-        
-        return None
+        """在工具目录中查找工具（进程内缓存，见commands/tools.py）"""
+        return get_tool_registry(self.tools_dir, self.state_dir).find(tool_name)
+    
+    def device_serial(self) -> Optional[str]:
+        """
+        目标设备的真实序列号（刷写记录、执行记录按它区分设备）：指定了序列号时直接使用，
+        否则为adb/fastboot下唯一连接的设备；无法确定时返回None
+        每次执行只查询一次，无法确定的结果也会保留，不会在每条命令前重新运行adb/fastboot devices
+        """
+        if self.serial:
+            return self.serial
+        if self._device_serial is _UNRESOLVED:
+            from commands.device_state import single_device_serial
+            
+            self._device_serial = single_device_serial(self)
+            if self._device_serial:
+                self.debug("当前设备序列号: %s", self._device_serial)
+        return self._device_serial
+    
+    def _serial_args(self) -> List[str]:
+        """多设备模式下为工具命令追加 -s <序列号>"""
+        return ['-s', self.serial] if self.serial else []
     
     def run_fastboot_command(self, args: List[str]) -> bool:
         """执行fastboot命令"""
-        try:
-            # 查找fastboot工具
-            fastboot_path = self._find_tool("fastboot")
-            if fastboot_path:
-                cmd = [str(fastboot_path)] + args
-            else:
-                # 如果没找到，使用系统PATH中的fastboot
-                cmd = ['fastboot'] + args
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 执行命令: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
+        if self.serial and self.serial.startswith('tcp:'):
+            # 网络设备直接使用内置的fastboot协议实现
+            from commands.fastboot_protocol import run_native
             
-            if self.debug_mode:
-                print(f"[DEBUG] 返回码: {result.returncode}")
-                if result.stdout:
-                    print(f"[DEBUG] 标准输出: {result.stdout}")
-                if result.stderr:
-                    print(f"[DEBUG] 标准错误: {result.stderr}")
-            
-            if result.returncode == 0:
-                if result.stdout.strip():
-                    print(f"成功: {result.stdout.strip()}")
-                return True
-            else:
-                print(f"失败: {result.stderr.strip()}")
+            self.debug("通过fastboot协议执行: %s -> %s", args, self.serial)
+            native = run_native(self.serial, args, timeout=self._timeout_for('fastboot'),
+                                checkpoint=self.checkpoint())
+            if native is not None:
+                ok, output = native
+                if ok:
+                    if output.strip():
+                        print(f"成功: {output.strip()}")
+                    return True
+                print(f"失败: {output.strip()}")
                 return False
-                
-        except subprocess.TimeoutExpired:
-            print("错误: 命令执行超时")
-            return False
-        except Exception as e:
-            print(f"错误: 执行命令时发生异常 - {e}")
-            return False
+        
+        # 查找fastboot工具，没找到时使用系统PATH中的fastboot
+        fastboot_path = self._find_tool("fastboot")
+        cmd = [str(fastboot_path) if fastboot_path else 'fastboot'] + self._serial_args() + args
+        return self._run_tool('fastboot', cmd)
             
     def run_adb_command(self, args: List[str]) -> bool:
         """执行adb命令"""
-        try:
-            # 查找adb工具
-            adb_path = self._find_tool("adb")
-            if adb_path:
-                cmd = [str(adb_path)] + args
-            else:
-                # 如果没找到，使用系统PATH中的adb
-                cmd = ['adb'] + args
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 执行命令: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
+        if self.native_adb:
+            from commands.adb_client import run_native
             
-            if self.debug_mode:
-                print(f"[DEBUG] 返回码: {result.returncode}")
-                if result.stdout:
-                    print(f"[DEBUG] 标准输出: {result.stdout}")
-                if result.stderr:
-                    print(f"[DEBUG] 标准错误: {result.stderr}")
-            
-            if result.returncode == 0:
-                if result.stdout.strip():
-                    print(f"成功: {result.stdout.strip()}")
-                return True
-            else:
-                print(f"失败: {result.stderr.strip()}")
+            self.debug("通过adb协议执行: %s", args)
+            native = run_native(self.serial, args, timeout=self._timeout_for('adb'))
+            if native is not None:
+                ok, output = native
+                if ok:
+                    if output.strip():
+                        print(f"成功: {output.strip()}")
+                    return True
+                print(f"失败: {output.strip()}")
                 return False
-                
-        except subprocess.TimeoutExpired:
-            print("错误: 命令执行超时")
-            return False
-        except Exception as e:
-            print(f"错误: 执行命令时发生异常 - {e}")
-            return False
+            self.debug("adb协议不可用，回退到adb程序")
+        
+        # 查找adb工具，没找到时使用系统PATH中的adb
+        adb_path = self._find_tool("adb")
+        cmd = [str(adb_path) if adb_path else 'adb'] + self._serial_args() + args
+        return self._run_tool('adb', cmd)
             
     def run_cmd_command(self, args: List[str]) -> bool:
         """执行cmd命令"""
-        try:
-            cmd = ['cmd', '/c'] + args
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 执行命令: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=60
-            )
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 返回码: {result.returncode}")
-                if result.stdout:
-                    print(f"[DEBUG] 标准输出: {result.stdout}")
-                if result.stderr:
-                    print(f"[DEBUG] 标准错误: {result.stderr}")
-            
-            if result.returncode == 0:
-                if result.stdout.strip():
-                    print(f"{result.stdout.strip()}")
-                return True
-            else:
-                print(f"{result.stderr.strip()}")
-                return False
-                
-        except subprocess.TimeoutExpired:
-            print("错误: 命令执行超时")
-            return False
-        except Exception as e:
-            print(f"错误: 执行命令时发生异常 - {e}")
-            return False
+        return self._run_tool('cmd', ['cmd', '/c'] + args)
             
     def run_spflashtool_command(self, args: List[str]) -> bool:
         """执行SPFlashTool命令"""
-        try:
-            # 查找SPFlashTool工具
-            spflash_path = self._find_tool("flash_tool") or self._find_tool("Mbin")
-            
-            if not spflash_path:
-                print("错误: 未找到SPFlashTool工具，请确保工具在tools目录中")
-                return False
-            
-            cmd = [str(spflash_path)] + args
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 执行命令: {' '.join(cmd)}")
-            
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=300  # SPFlashTool操作可能需要更长时间
-            )
-            
-            if self.debug_mode:
-                print(f"[DEBUG] 返回码: {result.returncode}")
-                if result.stdout:
-                    print(f"[DEBUG] 标准输出: {result.stdout}")
-                if result.stderr:
-                    print(f"[DEBUG] 标准错误: {result.stderr}")
-            
-            if result.returncode == 0:
-                if result.stdout.strip():
-                    print(f"成功: {result.stdout.strip()}")
-                return True
+        # 查找SPFlashTool工具
+        spflash_path = self._find_tool("flash_tool") or self._find_tool("Mbin")
+        
+        if not spflash_path:
+            print("错误: 未找到SPFlashTool工具，请确保工具在tools目录中")
+            return False
+        
+        return self._run_tool('spflashtool', [str(spflash_path)] + args, label="SPFlashTool")
+    
+    def _timeout_for(self, tool: str) -> Optional[float]:
+        """无输出超时时间：脚本变量 TIMEOUT_<工具名> 优先，其次为命令行/默认设置，0表示不限"""
+        value = self.variables.get(f"TIMEOUT_{tool.upper()}")
+        if value:
+            try:
+                seconds = float(value)
+            except ValueError:
+                print(f"警告: 无效的超时设置 TIMEOUT_{tool.upper()} = {value}")
             else:
-                print(f"失败: {result.stderr.strip()}")
+                return seconds if seconds > 0 else None
+        seconds = self.timeouts.get(tool)
+        return seconds if seconds else None
+    
+    def _run_tool(self, tool: str, cmd: List[str], label: str = "") -> bool:
+        """流式执行外部工具：实时输出每一行和进度，只保留输出尾部用于报错"""
+        label = f"{label}命令" if label else "命令"
+        timeout = self._timeout_for(tool)
+        
+        self.debug("执行命令: %s", cmd)
+        
+        def on_line(stream: str, line: str) -> None:
+            if line.strip():
+                print(line)
+        
+        def on_progress(event) -> None:
+            if event.stage == 'sent':
+                self.tracer.add_bytes(event.bytes_total)
+            if event.stage != 'writing':
+                print(f"  进度: {event.describe()}")
+        
+        with self.tracer.span(tool, 'tool', self.serial, argv=cmd[1:]) as span:
+            try:
+                result = run_streaming(cmd, timeout, on_line, on_progress)
+            except Exception as e:
+                span.set(status='error', error=str(e))
+                print(f"错误: 执行{label}时发生异常 - {e}")
                 return False
-                
-        except subprocess.TimeoutExpired:
-            print("错误: SPFlashTool命令执行超时")
-            return False
-        except Exception as e:
-            print(f"错误: 执行SPFlashTool命令时发生异常 - {e}")
+            span.set(exit_code=result.returncode, spawn_latency=result.spawn_latency,
+                     status='ok' if result.returncode == 0 and not result.timed_out else 'failed')
+        
+        self.debug("返回码: %s，用时 %.2fs，启动耗时 %.3fs", result.returncode, result.duration, result.spawn_latency)
+        
+        if result.timed_out:
+            print(f"错误: {label}执行超时（{timeout:g}秒无输出）")
             return False
+        if result.returncode == 0:
+            return True
+        
+        last_error = next((line for name, line in reversed(result.tail)
+                           if name == 'stderr' and line.strip()), "")
+        print(f"失败: 返回码 {result.returncode}" + (f" - {last_error.strip()}" if last_error else ""))
+        return False
             
     def set_variable(self, var_name: str, value: str) -> None:
         """设置变量"""
         self.variables[var_name] = value
-        if self.debug_mode:
-            print(f"[DEBUG] 设置变量: {var_name} = {value}")
+        self.debug("设置变量: %s = %s", var_name, value)
     
     def get_variable(self, var_name: str) -> str:
         """获取变量值"""
         value = self.variables.get(var_name, "")
-        if self.debug_mode:
-            print(f"[DEBUG] 获取变量: {var_name} = {value}")
+        self.debug("获取变量: %s = %s", var_name, value)
         return value
     
     def parse_arguments(self, args_str: str) -> List[str]:
         """解析参数，支持变量替换和字符串引用"""
-        if self.debug_mode:
-            print(f"[DEBUG] 解析参数: {args_str}")
-            
-        # 替换变量
-        for var_name, value in self.variables.items():
-            args_str = args_str.replace(f'${var_name}', value)
+        self.debug("解析参数: %s", args_str)
         
-        if self.debug_mode:
-            print(f"[DEBUG] 替换变量后: {args_str}")
-            
-        # 简单的参数解析，支持引号
-        args = []
-        current_arg = ""
-        in_quotes = False
-        quote_char = None
-        
-        for char in args_str:
-            if char in ['"', "'"]:
-                if not in_quotes:
-                    in_quotes = True
-                    quote_char = char
-                elif char == quote_char:
-                    in_quotes = False
-                    quote_char = None
-                else:
-                    current_arg += char
-            elif char == ',' and not in_quotes:
-                if current_arg:
-                    args.append(current_arg.strip())
-                    current_arg = ""
-            else:
-                current_arg += char
+        # 替换变量（一次扫描）
+        args_str = ArgTemplate.compile(args_str).render(self.variables)
         
-        if current_arg:
-            args.append(current_arg.strip())
+        self.debug("替换变量后: %s", args_str)
+        
+        args = split_arguments(args_str)
+        
+        self.debug("解析后参数: %s", args)
         
-        if self.debug_mode:
-            print(f"[DEBUG] 解析后参数: {args}")
-            
         return args
     
     def parse_command_line(self, line: str) -> Optional[tuple]:
@@ -359,68 +292,372 @@ class FastbootExecutor:
         
         return None
     
-    def execute_script(self) -> bool:
-        """执行指定的脚本文件"""
+    def compile_script(self) -> Optional[Plan]:
+        """把脚本编译为执行计划（带磁盘缓存），并报告所有错误"""
         try:
-            with open(self.script_file, 'r', encoding='utf-8') as f:
-                script_content = f.read()
+            plan = load_plan(self.script_file, self.commands, self.state_dir / "plans")
         except Exception as e:
             print(f"错误: 无法读取脚本文件 - {e}")
+            return None
+        
+        diagnostics = [(n, "警告", m) for n, m in plan.warnings] + [(n, "错误", m) for n, m in plan.errors]
+        for line_num, level, message in sorted(diagnostics):
+            print(f"[行{line_num}] {level}: {message}")
+        return plan
+    
+    def execute_script(self) -> bool:
+        """执行指定的脚本文件"""
+        plan = self.compile_script()
+        if self.timings is not None:
+            self.timings.mark("加载脚本")
+        if plan is None:
+            return False
+        if plan.errors:
+            print(f"脚本校验失败: 共 {len(plan.errors)} 处错误，未执行任何命令")
             return False
-            
-        lines = script_content.split('\n')
-        success = True
         
         # 检查是否在脚本开头设置了DEBUG参数
-        for line in lines:
-            line = line.strip()
-            if line.startswith('DEBUG='):
-                debug_value = line.split('=', 1)[1].strip().upper()
-                if debug_value in ['TRUE', '1', 'ON', 'YES']:
-                    self.debug_mode = True
-                    print("调试模式已启用")
-                break
-        
-        for line_num, line in enumerate(lines, 1):
-            parsed = self.parse_command_line(line)
-            if not parsed:
-                continue
-            
-            try:
-                if parsed[0] == 'SET_VAR':
-                    var_name, value = parsed[1], parsed[2]
-                    self.set_variable(var_name, value)
-                    print(f"[行{line_num}] 设置变量: {var_name} = {value}")
-                
-                elif parsed[0] in self.commands:
-                    command, args = parsed[0], parsed[1]
-                    
-                    if self.debug_mode:
-                        print(f"[行{line_num}] 执行命令: {command}({', '.join(args)})")
-                    
-                    if not self.commands[command](*args):
-                        print(f"[行{line_num}] 命令执行失败: {command}")
-                        success = False
+        if plan.debug:
+            self.debug_mode = True
+            print("调试模式已启用")
+        
+        # 执行记录按真实序列号区分设备；只有本机命令的脚本不需要查询设备
+        uses_device = _uses_device(plan.steps)
+        serial = self.device_serial() if uses_device else None
+        path = journal_path(self.state_dir, plan.script_hash, serial)
+        steps = plan.steps
+        previous = None
+        if self.resume and uses_device and serial is None:
+            print("无法确定设备序列号（没有连接设备或连接了多台），不能恢复执行，从头执行")
+        elif self.resume:
+            previous = read_journal(path)
+            if not previous.started:
+                print("没有该脚本在此设备上未完成的执行记录（上次已全部完成，或脚本修改后无法恢复），从头执行")
+                previous = None
+            elif previous.finished:
+                print("上次执行已全部完成，没有需要恢复的步骤")
+                return True
+            else:
+                start, variables = previous.resume_point(steps)
+                self.variables.update(variables)
+                if start < len(steps):
+                    print(f"恢复执行: 跳过已完成的 {start} 步，从第{steps[start].line_num}行继续")
+                steps = steps[start:]
+        
+        self.journal = Journal(path, previous, steps[0].line_num if previous and steps else None)
+        self.journal.start(self.script_file, previous is not None)
+        success = True
+        try:
+            for step in steps:
+                if self._run_step(step):
+                    # 后台块在JOIN成功时才算完成；只在本机执行的步骤不需要fsync
+                    if step.kind != 'background':
+                        self.journal.step_done(step.line_num, self.variables, _uses_device([step]))
                 else:
-                    print(f"[行{line_num}] 错误: 未知命令 - {parsed[0]}")
                     success = False
             
-            except TypeError as e:
-                print(f"[行{line_num}] 错误: 参数数量不匹配 - {e}")
+            # 脚本结束前等待仍在运行的后台任务
+            if self._background and not self._join([], None):
                 success = False
-            except Exception as e:
-                print(f"[行{line_num}] 错误: 执行时发生异常 - {e}")
+        finally:
+            self.journal.finish(success)
+        return success
+    
+    def fork(self, serial: Optional[str] = None) -> 'FastbootExecutor':
+        """派生执行上下文（并行分支、后台任务、@序列号）：变量为副本，命令重新绑定，其余状态共用"""
+        child = copy.copy(self)
+        if serial is not None:
+            child.serial = serial
+        child.variables = dict(self.variables)
+        child.debug = DebugLog(self.tracer, child.serial)
+        child.debug.enabled = self.debug.enabled
+        child.commands = {name: partial(func.func, child) for name, func in self.commands.items()}
+        child.failures = []
+        return child
+    
+    def run_steps(self, steps: List[Step]) -> bool:
+        """按顺序执行一组步骤，失败后继续执行后面的步骤"""
+        success = True
+        for step in steps:
+            if not self._run_step(step):
                 success = False
+        return success
+    
+    def _run_step(self, step: Step) -> bool:
+        line_num = step.line_num
+        if step.serial is not None:
+            target = self.fork(step.serial.render(self.variables))
+            ok = target._run_step(replace(step, serial=None))
+            self.failures.extend(target.failures)
+            return ok
+        if self._output_tag is not None:
+            # 并行分支/后台任务的输出带上当前行号
+            stream, tag = self._output_tag
+            install_router().bind(stream, tag.format(line_num))
+        try:
+            if step.kind == 'set':
+                self.set_variable(step.name, step.value)
+                print(f"[行{line_num}] 设置变量: {step.name} = {step.value}")
+                return True
+            if step.kind == 'parallel':
+                ok = self._run_parallel(step)
+            elif step.kind == 'background':
+                self._start_background(step)
+                return True
+            elif step.kind == 'join':
+                return self._join(step.args, line_num)
+            else:
+                ok = self._run_command(step)
+        except TypeError as e:
+            print(f"[行{line_num}] 错误: 参数数量不匹配 - {e}")
+            ok = False
+        except Exception as e:
+            print(f"[行{line_num}] 错误: 执行时发生异常 - {e}")
+            ok = False
+        if not ok and step.kind == 'call':
+            self.failures.append((line_num, step.name))
+        return ok
+    
+    def checkpoint(self):
+        """当前步骤的分片刷写进度记录，传给fastboot协议客户端"""
+        return self.journal.checkpoint(self.current_line) if self.journal else None
+    
+    def _run_command(self, step: Step) -> bool:
+        line_num = step.line_num
+        command = step.name
+        args = step.resolve_args(self.variables)
+        self.current_line = line_num
+        
+        self.debug("[行%d] 执行命令: %s(%s)", line_num, command, ', '.join(args))
         
+        # 同一台设备上的命令互斥（按真实序列号，未指定-s时也与指定了该序列号的任务互斥），
+        # 并行分支/后台任务/常驻服务中的任务不会同时操作同一台设备
+        lock = nullcontext() if command in HOST_COMMANDS else device_lock(self.device_serial())
+        with lock, self.tracer.span(f"行{line_num} {command}", 'step', self.serial,
+                                    line=line_num, command=command) as span:
+            if not self.commands[command](*args):
+                span.set(status='failed')
+                print(f"[行{line_num}] 命令执行失败: {command}")
+                return False
+        return True
+    
+    def _branch(self, tag: str) -> 'FastbootExecutor':
+        """为在其他线程中执行的步骤派生上下文，输出写入当前线程的输出流并带上标签"""
+        stream, prefix = install_router().current()
+        child = self.fork()
+        child._output_tag = (stream, prefix + tag)
+        return child
+    
+    def _run_branch(self, steps: List[Step]) -> bool:
+        try:
+            return self.run_steps(steps)
+        finally:
+            install_router().unbind()
+    
+    def _run_parallel(self, step: Step) -> bool:
+        """并行执行各分支，全部结束后汇总失败的分支"""
+        branches = [(steps, self._branch("[行{}] ")) for steps in step.branches if steps]
+        if not branches:
+            return True
+        print(f"[行{step.line_num}] 并行执行 {len(branches)} 个分支")
+        from concurrent.futures import ThreadPoolExecutor
+        
+        with ThreadPoolExecutor(max_workers=len(branches), thread_name_prefix='afc-branch') as pool:
+            results = list(pool.map(lambda item: item[1]._run_branch(item[0]), branches))
+        failed = [(steps, child) for (steps, child), ok in zip(branches, results) if not ok]
+        for steps, child in failed:
+            detail = ', '.join(f"行{n} {name}" for n, name in child.failures) or "执行出错"
+            print(f"[行{step.line_num}] 分支(行{steps[0].line_num})失败: {detail}")
+            self.failures.extend(child.failures)
+        if failed:
+            print(f"[行{step.line_num}] 并行块中 {len(failed)}/{len(branches)} 个分支失败")
+        return not failed
+    
+    def _start_background(self, step: Step) -> None:
+        """在后台线程中执行块，由JOIN等待"""
+        from concurrent.futures import Future
+        
+        child = self._branch(f"[{step.name} 行{{}}] ")
+        future: Future = Future()
+        
+        def run() -> None:
+            try:
+                future.set_result(child._run_branch(step.body))
+            except BaseException as e:
+                future.set_exception(e)
+        
+        with self._background_lock:
+            self._background[step.name] = (future, child, step.line_num)
+        print(f"[行{step.line_num}] 后台任务 {step.name} 已开始")
+        threading.Thread(target=run, daemon=True, name=f"afc-bg-{step.name}").start()
+    
+    def _join(self, names: List[str], line_num: Optional[int]) -> bool:
+        """等待后台任务结束（names为空时等待全部），返回它们是否全部成功"""
+        where = f"[行{line_num}] " if line_num else ""
+        with self._background_lock:
+            names = list(names) or list(self._background)
+            tasks = [(name, self._background.pop(name, None)) for name in names]
+        success = True
+        for name, task in tasks:
+            if task is None:
+                print(f"{where}后台任务 {name} 未开始或已结束")
+                continue
+            future, child, bg_line = task
+            print(f"{where}等待后台任务 {name}...")
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"{where}错误: 后台任务 {name} 发生异常 - {e}")
+                ok = False
+            if ok:
+                print(f"{where}后台任务 {name} 完成")
+                if self.journal is not None:
+                    self.journal.step_done(bg_line, self.variables)
+            else:
+                detail = ', '.join(f"行{n} {cmd}" for n, cmd in child.failures) or "执行出错"
+                print(f"{where}后台任务 {name} 失败: {detail}")
+                self.failures.extend(child.failures)
+                success = False
         return success
 
+def _uses_device(steps: List[Step]) -> bool:
+    """脚本中是否有操作设备的命令（包括并行块和后台块中的）"""
+    for step in steps:
+        if step.kind == 'call' and step.name not in HOST_COMMANDS:
+            return True
+        if _uses_device(step.body) or any(_uses_device(branch) for branch in step.branches):
+            return True
+    return False
+
+def parse_cli(argv: List[str]) -> argparse.Namespace:
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(
+        prog="main.py",
+        description="Fastboot脚本执行器",
+        epilog="示例: python main.py ./scripts/flash_rom.fs.AFC\n"
+               "      python main.py --devices all ./scripts/flash_rom.fs.AFC",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("script", nargs="?", help="AFC脚本文件路径")
+    parser.add_argument("--devices", metavar="all|SERIAL1,SERIAL2",
+                        help="多设备模式：all 表示所有已连接设备，或逗号分隔的序列号")
+    parser.add_argument("--jobs", type=int, default=8,
+                        help="多设备模式/服务模式下同时执行的设备数（默认8）")
+    parser.add_argument("--log-dir", default="logs",
+                        help="多设备模式下每台设备的日志目录、服务模式下每个任务的日志目录（默认 logs）")
+    parser.add_argument("--serve", nargs="?", const="127.0.0.1:8765", metavar="ADDRESS",
+                        help="常驻服务模式：通过本地HTTP接口接收脚本任务，同一设备的任务排队执行"
+                             "（默认 127.0.0.1:8765，unix:/路径 表示Unix socket）")
+    parser.add_argument("--check", action="store_true",
+                        help="只编译并校验脚本（命令名、参数个数），不连接设备")
+    parser.add_argument("--incremental", action="store_true",
+                        help="增量刷写：跳过镜像与该设备上次刷写内容相同的分区")
+    parser.add_argument("--resume", action="store_true",
+                        help="从上次中断（或失败）的步骤继续执行：跳过已完成的步骤并恢复变量，分片刷写从最后写入的分片继续")
+    parser.add_argument("--image-cache", nargs="?", const="20G", metavar="MAX_SIZE",
+                        help="通过按内容寻址的镜像库刷写，同一镜像只哈希/解压一次（默认上限20G，如 --image-cache 50G）")
+    parser.add_argument("--verify", nargs="?", const="auto", metavar="MANIFEST",
+                        help="FLASH_ALL刷写前按校验清单并行检查所有镜像的大小、SHA-256和AVB，"
+                             "不指定清单时在刷写目录中查找SHA256SUMS/manifest.json，相对路径相对于脚本所在目录")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="把每行脚本和每次工具调用的耗时写入Chrome trace-event格式的JSON文件")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="把耗时、传输字节数等指标写入Prometheus文本格式文件")
+    parser.add_argument("--timeout", action="append", default=[], metavar="TOOL=SECONDS",
+                        help="设置工具的无输出超时，如 fastboot=120、spflashtool=600，0表示不限（可重复）")
+    parser.add_argument("--timings", action="store_true",
+                        help="结束时输出各启动阶段（导入、参数解析、命令索引、加载脚本、执行）的耗时")
+    args = parser.parse_args(argv)
+    if args.script is None and args.serve is None:
+        parser.error("需要指定AFC脚本文件路径")
+    return args
+
+def parse_timeouts(items: List[str]) -> Dict[str, float]:
+    """解析 --timeout TOOL=SECONDS"""
+    timeouts = {}
+    for item in items:
+        tool, _, seconds = item.partition('=')
+        tool = tool.strip().lower()
+        if tool not in DEFAULT_TIMEOUTS:
+            raise ValueError(f"未知的工具 {tool}，可选: {', '.join(DEFAULT_TIMEOUTS)}")
+        timeouts[tool] = float(seconds)
+    return timeouts
+
+def make_executor(args: argparse.Namespace, serial: Optional[str] = None) -> FastbootExecutor:
+    """按命令行选项创建执行器"""
+    executor = FastbootExecutor(args.script, serial=serial)
+    executor.incremental = args.incremental
+    executor.resume = args.resume
+    executor.timeouts.update(parse_timeouts(args.timeout))
+    executor.verify_manifest = args.verify
+    if args.image_cache:
+        from commands.image_cache import get_image_store, parse_size
+        
+        executor.image_cache = get_image_store(executor.state_dir / "images", parse_size(args.image_cache))
+    return executor
+
+def run_devices(args: argparse.Namespace) -> bool:
+    """多设备模式：对每个序列号并行执行同一个脚本"""
+    from commands.fleet import resolve_serials, run_fleet, print_summary
+    
+    probe = FastbootExecutor(args.script)
+    serials = resolve_serials(probe, args.devices)
+    if not serials:
+        print("错误: 没有找到任何设备")
+        return False
+    
+    print(f"{'='*50}")
+    print(f"执行脚本: {args.script}")
+    print(f"目标设备: {', '.join(serials)}")
+    print(f"{'='*50}")
+    
+    results = run_fleet(lambda serial: make_executor(args, serial),
+                        serials, args.jobs, Path(args.log_dir))
+    print_summary(results)
+    return all(r.success for r in results)
+
 def main():
-    if len(sys.argv) != 2:
-        print("用法: python main.py <脚本文件路径>")
-        print("示例: python main.py ./scripts/flash_rom.fs.AFC")
+    entered = time.perf_counter()
+    args = parse_cli(sys.argv[1:])
+    timings = None
+    if args.timings:
+        timings = StartupTimings(_STARTED)
+        timings.mark("导入模块", entered)
+        timings.mark("解析参数")
+    try:
+        run_main(args, timings)
+    finally:
+        if timings is not None:
+            timings.report()
+
+def run_main(args: argparse.Namespace, timings: Optional[StartupTimings]) -> None:
+    script_file = args.script
+    
+    try:
+        parse_timeouts(args.timeout)
+    except ValueError as e:
+        print(f"错误: 无效的 --timeout 参数 - {e}")
         sys.exit(1)
     
-    script_file = sys.argv[1]
+    if args.image_cache:
+        from commands.image_cache import parse_size
+        
+        try:
+            parse_size(args.image_cache)
+        except ValueError:
+            print(f"错误: 无效的 --image-cache 大小 - {args.image_cache}")
+            sys.exit(1)
+    
+    if args.serve:
+        tracer = get_tracer()
+        tracer.enabled = bool(args.trace or args.metrics)
+        try:
+            success = run_server(args)
+        finally:
+            write_reports(args)
+        if not success:
+            sys.exit(1)
+        return
     
     if not os.path.exists(script_file):
         print(f"错误: 脚本文件不存在 - {script_file}")
@@ -430,19 +667,96 @@ def main():
         print(f"错误: 指定的路径不是文件 - {script_file}")
         sys.exit(1)
     
-    executor = FastbootExecutor(script_file)
+    if args.check:
+        executor = make_executor(args)
+        if timings is not None:
+            timings.mark("初始化执行器")
+        plan = executor.compile_script()
+        if timings is not None:
+            timings.mark("加载脚本")
+        if plan is None or plan.errors:
+            print(f"\n✗ 脚本校验失败: {script_file}")
+            sys.exit(1)
+        print(f"\n✓ 脚本校验通过: {script_file}（{len(plan.steps)} 步）")
+        return
+    
+    tracer = get_tracer()
+    tracer.enabled = bool(args.trace or args.metrics)
+    try:
+        if args.devices:
+            success = run_devices(args)
+        else:
+            success = run_single(args, timings)
+    finally:
+        write_reports(args)
+    
+    if not success:
+        sys.exit(1)
+
+def run_server(args: argparse.Namespace) -> bool:
+    """常驻服务模式：每个任务按提交时的选项创建执行器，命令注册表和工具索引在进程内共用"""
+    from commands.server import serve
+    
+    def factory(job) -> FastbootExecutor:
+        return make_executor(argparse.Namespace(**{**vars(args), **job.options, 'script': job.script}), job.serial)
+    
+    def warm() -> None:
+        # 启动时导入所有命令模块并查找常用工具，第一个任务不再承担这些开销
+        start = time.monotonic()
+        commands_file = Path(__file__).parent / "commands" / "custom_commands.txt"
+        loaded = get_command_registry(commands_file, default_state_dir()).preload()
+        registry = get_tool_registry(Path(__file__).parent / "tools", default_state_dir())
+        for tool in ('fastboot', 'adb'):
+            registry.find(tool)
+        print(f"已加载 {loaded} 个命令，预热用时 {time.monotonic() - start:.2f}s")
+    
+    def resolve() -> Optional[str]:
+        # 未指定序列号的任务在提交时确定设备，与指定了同一序列号的任务排在同一个队列
+        from commands.device_state import single_device_serial
+        
+        host = SimpleNamespace(native_adb=os.environ.get('AFC_NATIVE_ADB', '1') != '0',
+                               _find_tool=get_tool_registry(Path(__file__).parent / "tools",
+                                                            default_state_dir()).find)
+        return single_device_serial(host)
+    
+    return serve(args.serve, factory, args.jobs, Path(args.log_dir), warm, resolve)
+
+def run_single(args: argparse.Namespace, timings: Optional[StartupTimings] = None) -> bool:
+    """单设备模式"""
+    script_file = args.script
+    executor = make_executor(args)
+    if timings is not None:
+        timings.mark("初始化执行器")
+        executor.timings = timings
     
     print(f"{'='*50}")
     print(f"执行脚本: {script_file}")
     print(f"{'='*50}")
     
     success = executor.execute_script()
+    if timings is not None:
+        timings.mark("执行脚本")
     
     if success:
         print(f"\n✓ 脚本执行完成: {script_file}")
     else:
         print(f"\n✗ 脚本执行失败: {script_file}")
-        sys.exit(1)
+    return success
+
+def write_reports(args: argparse.Namespace) -> None:
+    """导出追踪和指标文件"""
+    tracer = get_tracer()
+    if args.trace:
+        tracer.write_chrome_trace(args.trace)
+        print(f"追踪文件已写入: {args.trace}")
+    if args.metrics:
+        tracer.write_prometheus(args.metrics)
+        print(f"指标文件已写入: {args.metrics}")
 
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        # 打包为exe时进程池（FLASH_PAYLOAD解压）需要；未打包时不必在启动时导入multiprocessing
+        import multiprocessing
+        
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""adb host协议客户端（commands/adb_client.py），使用 benchmarks/fake_tools.FakeAdbServer"""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import fake_tools  # noqa: E402
+from commands import adb_client  # noqa: E402
+from commands.adb_client import AdbClient, AdbError  # noqa: E402
+
+
+class AdbClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_tools.FakeAdbServer(['SER1', 'SER2'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.client = AdbClient(port=self.server.port)
+        self.addCleanup(self.client.close)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def test_devices(self):
+        self.assertEqual(self.client.devices(), [('SER1', 'device'), ('SER2', 'device')])
+
+    def test_transport_to_unknown_device_fails(self):
+        with self.assertRaises(AdbError):
+            self.client.run_shell('MISSING', 'true')
+
+    def test_shell_v2_reports_exit_code(self):
+        self.assertEqual(self.client.run_shell('SER1', 'echo hi'), (0, b'echo hi\n'))
+        self.assertEqual(self.client.run_shell('SER1', 'exit 3'), (3, b''))
+        self.assertTrue(self.server.commands[-1].startswith('shell,v2,raw:'))
+
+    def test_shell_v1_fallback_reports_exit_code(self):
+        self.server.shell_v2 = False
+        self.assertEqual(self.client.run_shell('SER1', 'echo hi'), (0, b'echo hi\n'))
+        self.assertEqual(self.client.run_shell('SER1', 'false'), (1, b''))
+        # 命令中途退出时没有退出码，按失败处理
+        self.assertEqual(self.client.run_shell('SER1', 'exit 0')[0], 255)
+
+    def test_push_pull_round_trip_reuses_sync_connection(self):
+        data = os.urandom(200 * 1024)
+        local = self.tmp / "a.bin"
+        local.write_bytes(data)
+        self.assertEqual(self.client.push('SER1', str(local), '/sdcard/a.bin'), len(data))
+        self.assertEqual(self.server.files['/sdcard/a.bin'], data)
+        mode, size, _mtime = self.client.stat('SER1', '/sdcard/a.bin')
+        self.assertTrue(mode)
+        self.assertEqual(size, len(data))
+        back = self.tmp / "b.bin"
+        self.assertEqual(self.client.pull('SER1', '/sdcard/a.bin', str(back)), len(data))
+        self.assertEqual(back.read_bytes(), data)
+        self.assertEqual(self.server.commands.count('sync:'), 1)
+
+    def test_sync_failure_closes_connection(self):
+        local = self.tmp / "a.bin"
+        local.write_bytes(b'x' * 10)
+        with self.assertRaises(AdbError):
+            self.client.pull('SER1', '/sdcard/missing', str(self.tmp / "m.bin"))
+        with self.assertRaises(AdbError):
+            self.client.push('SER1', str(local), '/system/a.bin')
+        # 失败后的连接没有放回池中，下一次传输使用新连接
+        self.client.push('SER1', str(local), '/sdcard/a.bin')
+        self.assertEqual(self.server.files['/sdcard/a.bin'], b'x' * 10)
+        self.assertEqual(self.server.commands.count('sync:'), 3)
+
+
+class RunNativeTest(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_tools.FakeAdbServer(['SER1'])
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        patcher = mock.patch.dict(os.environ, {'ANDROID_ADB_SERVER_PORT': str(self.server.port)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def test_shell_failure_fails_step(self):
+        ok, output = adb_client.run_native('SER1', ['shell', 'cat', '/nope'])
+        self.assertFalse(ok)
+        self.assertIn('No such file', output)
+        self.assertEqual(adb_client.run_native('SER1', ['shell', 'echo', 'ok']), (True, 'echo ok\n'))
+
+    def test_push_to_directory_appends_basename(self):
+        local = self.tmp / "boot.img"
+        local.write_bytes(b'boot')
+        self.assertTrue(adb_client.run_native('SER1', ['push', str(local), '/sdcard/'])[0])
+        self.assertTrue(adb_client.run_native('SER1', ['push', str(local), '/data/local/tmp'])[0])
+        self.assertEqual(self.server.files['/sdcard/boot.img'], b'boot')
+        self.assertEqual(self.server.files['/data/local/tmp/boot.img'], b'boot')
+
+    def test_pull_into_directory(self):
+        self.server.files['/sdcard/log.txt'] = b'log'
+        self.assertTrue(adb_client.run_native('SER1', ['pull', '/sdcard/log.txt', str(self.tmp)])[0])
+        self.assertEqual((self.tmp / "log.txt").read_bytes(), b'log')
+
+    def test_server_not_running_falls_back(self):
+        with mock.patch.dict(os.environ, {'ANDROID_ADB_SERVER_PORT': '1'}):
+            self.assertIsNone(adb_client.run_native('SER1', ['shell', 'true']))
+
+
+if __name__ == '__main__':
+    unittest.main()
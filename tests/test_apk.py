@@ -0,0 +1,30 @@
+"""APK信息解析（commands/apk.py）"""
+
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from commands import apk  # noqa: E402
+
+
+class VersionNumberTest(unittest.TestCase):
+    def test_decimal_with_leading_zero(self):
+        self.assertEqual(apk._version_number('0123'), 123)
+        self.assertEqual(apk._version_number('42'), 42)
+        self.assertEqual(apk._version_number('0'), 0)
+
+    def test_hex_prefix(self):
+        self.assertEqual(apk._version_number('0x1F'), 31)
+        self.assertEqual(apk._version_number('0X10'), 16)
+
+    def test_invalid(self):
+        for text in ('', 'abc', '0x', '1.2'):
+            with self.assertRaises(ValueError, msg=text):
+                apk._version_number(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
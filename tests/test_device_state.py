@@ -0,0 +1,92 @@
+"""adb/fastboot devices 输出的解析（commands/device_state.py），fleet模式的设备枚举和唯一设备的判断共用"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_afc  # noqa: E402
+from commands import device_state, fleet  # noqa: E402
+
+ADB_OUTPUT = """* daemon not running; starting now at tcp:5037
+* daemon started successfully
+List of devices attached
+SER1\tdevice
+SER2\tunauthorized
+SER3\toffline
+
+"""
+FASTBOOT_OUTPUT = "FB1\tfastboot\n"
+
+
+def fake_run(outputs):
+    def run(cmd, **kwargs):
+        return subprocess.CompletedProcess(cmd, 0, stdout=outputs[cmd[0]], stderr='')
+    return mock.patch.object(device_state.subprocess, 'run', run)
+
+
+class ParseDevicesTest(unittest.TestCase):
+    def test_skips_daemon_and_header_lines(self):
+        self.assertEqual(device_state.parse_devices(ADB_OUTPUT),
+                         [('SER1', 'device'), ('SER2', 'unauthorized'), ('SER3', 'offline')])
+
+    def test_filters_by_state(self):
+        self.assertEqual(device_state.parse_devices(ADB_OUTPUT, 'device'), [('SER1', 'device')])
+        self.assertEqual(device_state.parse_devices(FASTBOOT_OUTPUT, 'fastboot'), [('FB1', 'fastboot')])
+        self.assertEqual(device_state.parse_devices("", 'device'), [])
+
+
+class ListDevicesTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = SimpleNamespace(_find_tool=lambda tool: None, native_adb=False)
+
+    def test_discover_devices_only_usable_states(self):
+        with fake_run({'adb': ADB_OUTPUT, 'fastboot': FASTBOOT_OUTPUT}):
+            self.assertEqual(fleet.discover_devices(self.executor), ['SER1', 'FB1'])
+
+    def test_single_device_serial_ignores_daemon_lines(self):
+        adb = "* daemon started successfully\nList of devices attached\nSER1\tdevice\n"
+        with fake_run({'adb': adb, 'fastboot': ""}):
+            self.assertEqual(device_state.single_device_serial(self.executor), 'SER1')
+        with fake_run({'adb': ADB_OUTPUT, 'fastboot': ""}):
+            self.assertIsNone(device_state.single_device_serial(self.executor))
+
+    def test_tool_missing(self):
+        def missing(cmd, **kwargs):
+            raise FileNotFoundError(cmd[0])
+        with mock.patch.object(device_state.subprocess, 'run', missing):
+            self.assertEqual(device_state.list_devices(self.executor, 'adb'), [])
+
+
+class DeviceSerialTest(unittest.TestCase):
+    def test_unresolved_serial_queried_once(self):
+        calls = []
+
+        def single_device_serial(executor):
+            calls.append(executor)
+            return None
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.dict(os.environ, {'AFC_STATE_DIR': str(Path(tmp) / "state")}), \
+                mock.patch.object(device_state, 'single_device_serial', single_device_serial):
+            script = Path(tmp) / "wait.AFC"
+            script.write_text("PRINT(start)\n", encoding='utf-8')
+            executor = bench_afc.make_executor(script, Path(tmp) / "tools")
+            # 没有设备或有多台设备时结果为None，同样只查询一次
+            self.assertIsNone(executor.device_serial())
+            self.assertIsNone(executor.device_serial())
+            self.assertIsNone(executor.fork().device_serial())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(executor.fork('SER9').device_serial(), 'SER9')
+
+
+if __name__ == '__main__':
+    unittest.main()
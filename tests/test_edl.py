@@ -0,0 +1,158 @@
+"""高通EDL刷写（commands/edl.py、commands/edl_protocol.py），通过 benchmarks/fake_tools.FakeFirehoseTarget 刷写"""
+
+import os
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_afc  # noqa: E402
+import fake_tools  # noqa: E402
+from commands import edl  # noqa: E402
+from commands.sparse import CHUNK_DONT_CARE, CHUNK_FILL, SparseImage, write_sparse  # noqa: E402
+
+SECTOR = 4096
+DISK_SECTORS = 1024
+SYSTEM_START, SYSTEM_SECTORS = 6, 512
+BOOT_START, BOOT_SECTORS = 600, 64
+
+
+def write_gpt(disk: Path, partitions) -> None:
+    """在LUN的第1扇区写入GPT头、第2扇区写入分区表（只包含read_gpt用到的字段）"""
+    entries = b''
+    for index, (name, first, sectors) in enumerate(partitions, 1):
+        entries += struct.pack('<16s16sQQQ72s', bytes([index]) * 16, os.urandom(16), first,
+                               first + sectors - 1, 0, name.encode('utf-16-le'))
+    header = struct.pack('<8sIIIIQQQQ16sQIII', b'EFI PART', 0x10000, 92, 0, 0, 1, DISK_SECTORS - 1,
+                         34, DISK_SECTORS - 34, os.urandom(16), 2, len(partitions), 128,
+                         zlib.crc32(entries))
+    with open(disk, 'r+b') as f:
+        f.seek(SECTOR)
+        f.write(header)
+        f.seek(2 * SECTOR)
+        f.write(entries)
+
+
+class EdlTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        patcher = mock.patch.dict(os.environ, {'AFC_STATE_DIR': str(self.tmp / "state")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # 磁盘原有内容为随机数据，sparse镜像的DONT_CARE区域应保持不变
+        self.disk = self.tmp / "lun0.bin"
+        self.disk.write_bytes(os.urandom(DISK_SECTORS * SECTOR))
+        write_gpt(self.disk, [('system', SYSTEM_START, SYSTEM_SECTORS), ('boot', BOOT_START, BOOT_SECTORS)])
+
+        self.package = self.tmp / "edl"
+        self.package.mkdir()
+        self.loader = fake_tools.make_loader(self.package / "prog_firehose_ddr.elf", size=64 * 1024)
+        self.system_raw = self.tmp / "system.raw"
+        # 随机数据、全零区（DONT_CARE）和填充区（FILL）交替
+        quarter = SYSTEM_SECTORS * SECTOR // 4
+        self.system_raw.write_bytes(os.urandom(quarter) + bytes(quarter) + b'\xde\xad\xbe\xef' * (quarter // 4)
+                                    + os.urandom(quarter // 2) + bytes(quarter // 2))
+        self.sparse = SparseImage.from_raw(self.system_raw, zero_dont_care=True)
+        with open(self.package / "system.img", 'wb') as f:
+            write_sparse(self.sparse, f)
+        self.boot = os.urandom(BOOT_SECTORS * SECTOR)
+        (self.package / "boot.img").write_bytes(self.boot)
+        (self.package / "rawprogram0.xml").write_text(
+            '<?xml version="1.0" ?>\n<data>\n'
+            f'  <program SECTOR_SIZE_IN_BYTES="{SECTOR}" filename="system.img" label="system" '
+            f'num_partition_sectors="{SYSTEM_SECTORS}" physical_partition_number="0" start_sector="{SYSTEM_START}"/>\n'
+            f'  <program SECTOR_SIZE_IN_BYTES="{SECTOR}" filename="boot.img" label="boot" '
+            f'num_partition_sectors="{BOOT_SECTORS}" physical_partition_number="0" start_sector="{BOOT_START}"/>\n'
+            '</data>\n', encoding='utf-8')
+        (self.package / "patch0.xml").write_text(
+            '<?xml version="1.0" ?>\n<patches>\n'
+            f'  <patch SECTOR_SIZE_IN_BYTES="{SECTOR}" byte_offset="32" filename="DISK" physical_partition_number="0" '
+            'size_in_bytes="8" start_sector="1" value="NUM_DISK_SECTORS-2." what="备份GPT头的位置"/>\n'
+            f'  <patch SECTOR_SIZE_IN_BYTES="{SECTOR}" byte_offset="16" filename="DISK" physical_partition_number="0" '
+            'size_in_bytes="4" start_sector="1" value="CRC32(1,92)" what="GPT头的CRC"/>\n'
+            '</patches>\n', encoding='utf-8')
+
+        self.target = fake_tools.FakeFirehoseTarget([self.disk], SECTOR, max_payload=64 * 1024)
+        self.target.__enter__()
+        self.addCleanup(self.target.__exit__)
+
+    def _run(self, body: str) -> bool:
+        script = self.tmp / "edl.AFC"
+        script.write_text(f"EDL_PORT={self.target.target}\nEDL_BATCH=256K\n{body}", encoding='utf-8')
+        executor = bench_afc.make_executor(script, self.tmp / "tools")
+        self.addCleanup(edl._close_session, executor)
+        with bench_afc.quiet():
+            return executor.execute_script()
+
+    def _expected_system(self, before: bytes) -> bytes:
+        """按sparse镜像的chunk计算写入后的分区内容：DONT_CARE保留原有数据"""
+        raw = self.system_raw.read_bytes()
+        out, block = bytearray(raw), 0
+        size = self.sparse.block_size
+        for chunk in self.sparse.chunks:
+            if chunk.type == CHUNK_DONT_CARE:
+                out[block * size:(block + chunk.blocks) * size] = before[block * size:(block + chunk.blocks) * size]
+            block += chunk.blocks
+        return bytes(out)
+
+    def test_flash_package(self):
+        types = {chunk.type for chunk in self.sparse.chunks}
+        self.assertTrue({CHUNK_FILL, CHUNK_DONT_CARE} <= types, types)
+        before = self.disk.read_bytes()
+        self.assertTrue(self._run("FLASHEDL(edl)\n"))
+
+        # Sahara按ELF程序头请求的引导程序与文件一致
+        self.assertEqual(self.target.loader, self.loader.read_bytes())
+        self.assertTrue(self.target.firehose)
+
+        disk = self.disk.read_bytes()
+        system = disk[SYSTEM_START * SECTOR:(SYSTEM_START + SYSTEM_SECTORS) * SECTOR]
+        self.assertEqual(system, self._expected_system(before[SYSTEM_START * SECTOR:]))
+        self.assertEqual(disk[BOOT_START * SECTOR:(BOOT_START + BOOT_SECTORS) * SECTOR], self.boot)
+        # 写入范围以外的数据不变，DONT_CARE区域没有发送
+        self.assertEqual(disk[(BOOT_START + BOOT_SECTORS) * SECTOR:], before[(BOOT_START + BOOT_SECTORS) * SECTOR:])
+        self.assertLess(self.target.bytes_written, (SYSTEM_SECTORS + BOOT_SECTORS) * SECTOR)
+
+        # patch中的表达式由设备按顺序计算：CRC覆盖的是第一条patch修改后、CRC字段仍为0的头
+        header = disk[SECTOR:2 * SECTOR]
+        self.assertEqual(struct.unpack_from('<Q', header, 32)[0], DISK_SECTORS - 2)
+        self.assertEqual(struct.unpack_from('<I', header, 16)[0], zlib.crc32(header[:16] + bytes(4) + header[20:92]))
+        self.assertEqual(self.target.counts.get('patch'), 2)
+
+    def test_selected_partition_skips_patches(self):
+        before = self.disk.read_bytes()
+        self.assertTrue(self._run("FLASHEDL(edl, boot)\n"))
+        disk = self.disk.read_bytes()
+        self.assertEqual(disk[BOOT_START * SECTOR:(BOOT_START + BOOT_SECTORS) * SECTOR], self.boot)
+        self.assertEqual(disk[:BOOT_START * SECTOR], before[:BOOT_START * SECTOR])
+        self.assertNotIn('patch', self.target.counts)
+
+    def test_read_round_trips_partition(self):
+        self.assertTrue(self._run("FLASHEDL(edl)\nEDL_READ(boot, out/boot.img)\nEDL_READ(system, out/system.img)\n"))
+        disk = self.disk.read_bytes()
+        self.assertEqual((self.tmp / "out" / "boot.img").read_bytes(), self.boot)
+        self.assertEqual((self.tmp / "out" / "system.img").read_bytes(),
+                         disk[SYSTEM_START * SECTOR:(SYSTEM_START + SYSTEM_SECTORS) * SECTOR])
+        self.assertFalse((self.tmp / "out" / "boot.img.part").exists())
+        # 同一进程中复用连接（使用前nop检查），不重新握手
+        self.assertEqual(self.target.counts.get('nop'), 2)
+
+    def test_missing_image_fails_before_connecting(self):
+        (self.package / "boot.img").unlink()
+        self.assertFalse(self._run("FLASHEDL(edl)\n"))
+        self.assertEqual(self.target.counts, {})
+        self.assertFalse(self.target.firehose)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""fastboot协议客户端（commands/fastboot_protocol.py），通过 benchmarks/fake_tools.FakeFastbootTcp 刷写"""
+
+import gzip
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_afc  # noqa: E402
+import fake_tools  # noqa: E402
+from bench_sparse import make_image  # noqa: E402
+from commands import fastboot_protocol  # noqa: E402
+
+MAX_DOWNLOAD = 1024 * 1024
+
+
+class FastbootTcpTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        patcher = mock.patch.dict(os.environ, {'AFC_STATE_DIR': str(self.tmp / "state")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = fake_tools.FakeFastbootTcp(max_download=MAX_DOWNLOAD, keep_data=True)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def _run(self, script_text: str) -> bool:
+        script = self.tmp / "flash.AFC"
+        script.write_text(script_text, encoding='utf-8')
+        executor = bench_afc.make_executor(script, self.tmp / "tools", serial=self.server.target)
+        with bench_afc.quiet():
+            return executor.execute_script()
+
+    def _downloads(self):
+        return [int(c[9:], 16) for c in self.server.commands if c.startswith('download:')]
+
+    def test_sparse_split_larger_than_max_download(self):
+        # 随机数据、填充区和空洞交替，拆分后的分片中有RAW、FILL和DONT_CARE
+        image = self.tmp / "system.img"
+        make_image(image, 6 * MAX_DOWNLOAD, segment=2 * MAX_DOWNLOAD)
+        self.assertTrue(self._run("FLASH(system, system.img)\n"))
+
+        downloads = self._downloads()
+        self.assertGreater(len(downloads), 1)
+        self.assertTrue(all(size <= MAX_DOWNLOAD for size in downloads), downloads)
+        self.assertEqual(self.server.commands.count('flash:system'), len(downloads))
+        self.assertEqual(bytes(self.server.partitions['system']), image.read_bytes())
+
+    def test_compressed_image_streams_in_pieces(self):
+        data = os.urandom(3 * MAX_DOWNLOAD) + bytes(MAX_DOWNLOAD)
+        with gzip.open(self.tmp / "vendor.img.gz", 'wb', compresslevel=1) as f:
+            f.write(data)
+        self.assertTrue(self._run("FLASH(vendor, vendor.img.gz)\n"))
+        self.assertGreater(len(self._downloads()), 1)
+        self.assertEqual(bytes(self.server.partitions['vendor']), data)
+
+    def test_erase_and_reboot(self):
+        (self.tmp / "boot.img").write_bytes(os.urandom(64 * 1024))
+        self.assertTrue(self._run("FLASH(boot, boot.img)\nERASE(boot)\nREBOOT(bootloader)\n"))
+        self.assertNotIn('boot', self.server.partitions)
+        self.assertEqual([c for c in self.server.commands if not c.startswith(('getvar:', 'download:'))],
+                         ['flash:boot', 'erase:boot', 'reboot-bootloader'])
+
+    def test_getvar(self):
+        self.assertEqual(fastboot_protocol.run_native(self.server.target, ['getvar', 'product']),
+                         (True, 'product: fake'))
+        self.assertEqual(fastboot_protocol.query_download_limit(self.server.target), MAX_DOWNLOAD)
+
+    def test_download_too_large_fails_without_flash(self):
+        client = fastboot_protocol.FastbootClient(fastboot_protocol.open_transport(self.server.target))
+        self.addCleanup(client.close)
+        client._max_download = 0  # 不按设备报告的大小拆分，由设备拒绝
+        with open(self.tmp / "big.img", 'wb') as f:
+            f.write(os.urandom(MAX_DOWNLOAD + 4096))
+        with self.assertRaises(fastboot_protocol.FastbootError):
+            client.flash_file('boot', self.tmp / "big.img")
+        self.assertNotIn('flash:boot', self.server.commands)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""执行记录和断点续刷（commands/journal.py、main.py --resume），通过 benchmarks/fake_tools.FakeFastbootTcp 刷写"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_afc  # noqa: E402
+import fake_tools  # noqa: E402
+from commands import journal  # noqa: E402
+
+MAX_DOWNLOAD = 1024 * 1024
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+        self.state = self.tmp / "state"
+        self.script = self.tmp / "flash.AFC"
+
+    def _journals(self):
+        return list((self.state / "journal").glob("*.jsonl"))
+
+    def _records(self, event: str):
+        records = []
+        for path in self._journals():
+            for line in path.read_text(encoding='utf-8').splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('event') == event:
+                    records.append(record)
+        return records
+
+    def _spawn(self, server, *options) -> subprocess.Popen:
+        env = dict(os.environ, AFC_STATE_DIR=str(self.state))
+        return subprocess.Popen([sys.executable, str(ROOT / 'main.py'), '--devices', server.target,
+                                 '--log-dir', str(self.tmp / "logs"), *options, str(self.script)],
+                                env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+
+    def test_kill_mid_transfer_and_resume(self):
+        system = os.urandom(6 * MAX_DOWNLOAD)
+        (self.tmp / "system.img").write_bytes(system)
+        (self.tmp / "boot.img").write_bytes(os.urandom(64 * 1024))
+        self.script.write_text("PRINT(start)\nFLASH(boot, boot.img)\nFLASH(system, system.img)\nPRINT(done)\n",
+                               encoding='utf-8')
+        with fake_tools.FakeFastbootTcp(max_download=MAX_DOWNLOAD, mbps=8, keep_data=True) as server:
+            process = self._spawn(server)
+            try:
+                deadline = time.monotonic() + 60
+                while len(self._records('piece')) < 2 and process.poll() is None and time.monotonic() < deadline:
+                    time.sleep(0.02)
+            finally:
+                process.kill()
+                process.wait()
+            pieces = self._records('piece')
+            self.assertGreaterEqual(len(pieces), 2, "分片刷写开始前进程已结束")
+            total = pieces[0]['total']
+            self.assertLess(len(pieces), total, "进程结束前已写入全部分片")
+            self.assertEqual(self._records('finish'), [])
+
+            sent_before = len(server.commands)
+            process = self._spawn(server, '--resume')
+            self.assertEqual(process.wait(timeout=120), 0)
+            resumed = server.commands[sent_before:]
+
+        # 已完成的步骤和已确认的分片不再发送，其余分片补齐后分区内容完整
+        self.assertNotIn('flash:boot', resumed)
+        self.assertEqual(resumed.count('flash:system'), total - len(pieces))
+        self.assertEqual(bytes(server.partitions['system']), system)
+        # 全部成功后不保留记录
+        self.assertEqual(self._journals(), [])
+
+    def test_failed_run_keeps_journal_for_resume(self):
+        self.script.write_text("PRINT(start)\nFLASH(boot, missing.img)\n", encoding='utf-8')
+        with mock.patch.dict(os.environ, {'AFC_STATE_DIR': str(self.state)}):
+            executor = bench_afc.make_executor(self.script, self.tmp / "tools", serial="tcp:127.0.0.1:1")
+            with bench_afc.quiet():
+                self.assertFalse(executor.execute_script())
+        self.assertEqual(len(self._journals()), 1)
+        self.assertEqual([r['ok'] for r in self._records('finish')], [False])
+
+    def test_only_device_steps_are_synced(self):
+        (self.tmp / "boot.img").write_bytes(os.urandom(64 * 1024))
+        self.script.write_text("PRINT(start)\nNAME=boot\nWAIT(0)\nFLASH($NAME, boot.img)\nPRINT(done)\n",
+                               encoding='utf-8')
+        synced = []
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            synced.append([r['line'] for r in self._records('step')])
+            real_fsync(fd)
+
+        with fake_tools.FakeFastbootTcp() as server, \
+                mock.patch.dict(os.environ, {'AFC_STATE_DIR': str(self.state)}), \
+                mock.patch.object(journal.os, 'fsync', fsync):
+            executor = bench_afc.make_executor(self.script, self.tmp / "tools", serial=server.target)
+            with bench_afc.quiet():
+                self.assertTrue(executor.execute_script())
+        # 只有FLASH（第4行）完成时fsync，此时之前的记录也一起写入磁盘
+        self.assertEqual(synced, [[1, 2, 3, 4]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+"""OTA payload.bin 解压（commands/payload.py），payload在测试中按CrAU格式生成"""
+
+import bz2
+import hashlib
+import lzma
+import os
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import mock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from commands import image_cache, payload  # noqa: E402
+from commands.image_cache import ImageStore  # noqa: E402
+
+BLOCK = 4096
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7f, value >> 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def _int(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _bytes(number: int, value: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def build_payload(path: Path, partitions) -> dict:
+    """
+    生成全量OTA的payload.bin：partitions 为 {分区名: [(操作类型, 块数), ...]}，
+    按顺序写入分区的连续块；返回 分区名 -> 预期的镜像内容
+    """
+    data = bytearray()
+    updates = b''
+    images = {}
+    for name, ops in partitions.items():
+        image = bytearray()
+        encoded_ops = b''
+        for op_type, blocks in ops:
+            content = bytes(BLOCK * blocks) if op_type == payload.OP_ZERO else os.urandom(BLOCK * blocks)
+            blob = {payload.OP_REPLACE: content, payload.OP_REPLACE_XZ: lzma.compress(content),
+                    payload.OP_REPLACE_BZ: bz2.compress(content), payload.OP_ZERO: b''}[op_type]
+            extent = _bytes(6, _int(1, len(image) // BLOCK) + _int(2, blocks))
+            op = _int(1, op_type) + extent
+            if blob:
+                op += _int(2, len(data)) + _int(3, len(blob)) + _bytes(8, hashlib.sha256(blob).digest())
+            encoded_ops += _bytes(8, op)
+            data += blob
+            image += content
+        info = _int(1, len(image)) + _bytes(2, hashlib.sha256(image).digest())
+        updates += _bytes(13, _bytes(1, name.encode('utf-8')) + _bytes(7, info) + encoded_ops)
+        images[name] = bytes(image)
+    manifest = _int(3, BLOCK) + updates
+    Path(path).write_bytes(payload.PAYLOAD_MAGIC + struct.pack('>QQI', 2, len(manifest), 0) + manifest + data)
+    return images
+
+
+ALL_OPS = [(payload.OP_REPLACE, 3), (payload.OP_ZERO, 2), (payload.OP_REPLACE_XZ, 4),
+           (payload.OP_REPLACE_BZ, 2), (payload.OP_ZERO, 1)]
+
+
+class PayloadTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def test_extract_all_operation_types(self):
+        images = build_payload(self.tmp / "payload.bin", {'boot': ALL_OPS, 'dtbo': [(payload.OP_REPLACE_XZ, 2)]})
+        # OTA zip中未压缩存储的payload.bin直接按偏移读取
+        with zipfile.ZipFile(self.tmp / "ota.zip", 'w', zipfile.ZIP_STORED) as zf:
+            zf.write(self.tmp / "payload.bin", payload.PAYLOAD_MEMBER)
+        for source in ("payload.bin", "ota.zip"):
+            parsed = payload.read_payload(self.tmp / source)
+            self.assertEqual(set(parsed.partitions), {'boot', 'dtbo'})
+            for name, expected in images.items():
+                out = self.tmp / f"{source}.{name}.img"
+                digest = payload.extract_partition(parsed, name, out)
+                self.assertEqual(out.read_bytes(), expected)
+                self.assertEqual(digest, hashlib.sha256(expected).hexdigest())
+
+    def test_incremental_operations_rejected(self):
+        build_payload(self.tmp / "payload.bin", {'boot': [(payload.OP_REPLACE, 1)]})
+        parsed = payload.read_payload(self.tmp / "payload.bin")
+        parsed.partitions['boot'].operations[0].type = 4  # SOURCE_COPY
+        with self.assertRaises(payload.PayloadError):
+            payload.extract_partition(parsed, 'boot', self.tmp / "boot.img")
+
+    def test_store_reuses_and_evicts_extractions(self):
+        images = build_payload(self.tmp / "payload.bin", {'boot': [(payload.OP_REPLACE, 64)],
+                                                           'system': [(payload.OP_REPLACE_XZ, 64)]})
+        parsed = payload.read_payload(self.tmp / "payload.bin")
+        store = ImageStore(self.tmp / "cache", max_bytes=BLOCK * 96)
+        pool = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(payload, '_get_pool', return_value=pool), \
+                mock.patch.object(image_cache, 'IN_USE_GRACE', 0.0):
+            boot, digest, elapsed = payload.submit_extract(parsed, 'boot', store).result()
+            self.assertEqual(boot.read_bytes(), images['boot'])
+            self.assertGreater(elapsed, 0)
+            # 再次请求同一分区时直接使用库中的镜像
+            again = payload.submit_extract(parsed, 'boot', store).result()
+            self.assertEqual(again, (boot, digest, 0.0))
+
+            system = payload.submit_extract(parsed, 'system', store).result()[0]
+            self.assertEqual(system.read_bytes(), images['system'])
+        # 两个镜像共128块，超过96块的上限：较早使用的boot被淘汰
+        self.assertFalse(boot.exists())
+        self.assertLessEqual(store.total_size(), store.max_bytes)
+        self.assertEqual(list(store.root.glob("incoming.*")), [])
+
+    def test_concurrent_requests_extract_once(self):
+        images = build_payload(self.tmp / "payload.bin", {'boot': ALL_OPS})
+        parsed = payload.read_payload(self.tmp / "payload.bin")
+        store = ImageStore(self.tmp / "cache", max_bytes=1 << 30)
+        release = threading.Event()
+        calls = []
+
+        class GatedPool(ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                calls.append(args[1])
+                return super().submit(lambda: release.wait(10) and fn(*args))
+
+        pool = GatedPool(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(payload, '_get_pool', return_value=pool):
+            futures = [payload.submit_extract(parsed, 'boot', store) for _ in range(3)]
+            self.assertIs(futures[1], futures[0])
+            self.assertIs(futures[2], futures[0])
+            release.set()
+            image, _digest, _elapsed = futures[0].result(timeout=10)
+        self.assertEqual(calls, ['boot'])
+        self.assertEqual(image.read_bytes(), images['boot'])
+        self.assertEqual(payload._inflight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
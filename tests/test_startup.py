@@ -0,0 +1,41 @@
+"""冷启动耗时和惰性导入（main.py --timings），预算与 benchmarks/bench_afc.py 的startup场景相同"""
+
+import re
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import bench_afc  # noqa: E402
+
+# 只用到PRINT的脚本不应导入的命令模块
+HEAVY_MODULES = {'flash', 'backup', 'payload', 'edl', 'edl_protocol', 'apk', 'scatter', 'sparse',
+                 'fastboot_protocol', 'adb_client', 'image_cache', 'image_source', 'verify', 'server', 'fleet'}
+MAX_COMMAND_MODULES = 10
+RUNS = 3
+
+
+class StartupTest(unittest.TestCase):
+    def test_cold_start_within_budget(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            work = Path(tmp)
+            script = work / "startup.AFC"
+            script.write_text("PRINT(hello)\n", encoding='utf-8')
+            # 每次都使用空的状态目录（没有计划缓存和签名缓存），取最快的一次以减少机器负载的影响
+            runs = [bench_afc._spawn_main(script, work / f"state{i}") for i in range(RUNS)]
+        elapsed, report = min(runs)
+        self.assertLessEqual(elapsed * 1000, bench_afc.STARTUP_BUDGET_MS,
+                             f"冷启动 {elapsed * 1000:.0f} ms 超过预算\n{report}")
+
+        match = re.search(r'已导入的commands模块\((\d+)\): (.*)', report)
+        self.assertIsNotNone(match, report)
+        modules = set(match.group(2).split(', '))
+        self.assertLessEqual(int(match.group(1)), MAX_COMMAND_MODULES, report)
+        self.assertFalse(modules & HEAVY_MODULES, report)
+
+
+if __name__ == '__main__':
+    unittest.main()